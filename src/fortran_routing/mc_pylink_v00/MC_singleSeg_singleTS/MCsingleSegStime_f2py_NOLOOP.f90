@@ -6,13 +6,79 @@ module muskingcunge_module
 contains
 
 subroutine muskingcungenwm(dt, qup, quc, qdp, ql, dx, bw, tw, twcc,&
-    n, ncc, cs, s0, velp, depthp, qdc, velc, depthc, ck, cn, X)
+    n, ncc, cs, s0, velp, depthp, qdc, velc, depthc, ck, cn, X, iters)
+
+    !* iters (optional) returns the total number of secant iterations
+
+    implicit none
+
+    real(prec), intent(in) :: dt
+    real(prec), intent(in) :: qup, quc, qdp, ql
+    real(prec), intent(in) :: dx, bw, tw, twcc, n, ncc, cs, s0
+    real(prec), intent(in) :: velp
+    real(prec), intent(in) :: depthp
+    real(prec), intent(out) :: qdc, velc, depthc
+    real(prec), intent(out) :: ck, cn, X
+    integer, intent(out), optional :: iters
+    integer :: niter
+    real(prec) :: mindepth, h, h_0
+
+    mindepth = 0.01_prec
+
+    depthc = max(depthp, 0.0_prec)
+    h     = (depthc * 1.33_prec) + mindepth !1.50 of  depthc
+    h_0   = (depthc * 0.67_prec)            !0.50 of depthc
+
+    call muskingcungenwm_seeded(dt, qup, quc, qdp, ql, dx, bw, tw, twcc,&
+    n, ncc, cs, s0, velp, depthp, h, h_0, qdc, velc, depthc, ck, cn, X, niter)
+    if (present(iters)) iters = niter
+
+end subroutine muskingcungenwm
+
+subroutine muskingcungenwm_warm(dt, qup, quc, qdp, ql, dx, bw, tw, twcc,&
+    n, ncc, cs, s0, velp, depthp, depthpp, qdc, velc, depthc, ck, cn, X, iters)
+
+    !* warm start: the secant is seeded from the depth of the last two timesteps,
+    !* depthpp being the depth of the timestep before depthp. The depth trend is
+    !* extrapolated one timestep (within the default bracket around depthp) and
+    !* bracketed tightly, so segments in slow recession converge in fewer
+    !* iterations. The secant stops at a 1% relative change in depth, so the
+    !* result differs from muskingcungenwm within that tolerance.
+
+    implicit none
+
+    real(prec), intent(in) :: dt
+    real(prec), intent(in) :: qup, quc, qdp, ql
+    real(prec), intent(in) :: dx, bw, tw, twcc, n, ncc, cs, s0
+    real(prec), intent(in) :: velp
+    real(prec), intent(in) :: depthp, depthpp
+    real(prec), intent(out) :: qdc, velc, depthc
+    real(prec), intent(out) :: ck, cn, X
+    integer, intent(out) :: iters
+    real(prec) :: mindepth, guess, h, h_0
+
+    mindepth = 0.01_prec
+
+    depthc = max(depthp, 0.0_prec)
+    guess = min(max(depthc + (depthc - max(depthpp, 0.0_prec)), depthc * 0.67_prec), depthc * 1.33_prec)
+    h     = (guess * 1.05_prec) + mindepth
+    h_0   = (guess * 0.95_prec)
+
+    call muskingcungenwm_seeded(dt, qup, quc, qdp, ql, dx, bw, tw, twcc,&
+    n, ncc, cs, s0, velp, depthp, h, h_0, qdc, velc, depthc, ck, cn, X, iters)
+
+end subroutine muskingcungenwm_warm
+
+subroutine muskingcungenwm_seeded(dt, qup, quc, qdp, ql, dx, bw, tw, twcc,&
+    n, ncc, cs, s0, velp, depthp, h_seed, h_0_seed, qdc, velc, depthc, ck, cn, X, iters)
 
     !* exactly follows SUBMUSKINGCUNGE in NWM:
     !* 1) qup and quc for a reach in upstream limit take zero values all the time
     !* 2) initial value of depth of time t of each reach is equal to the value at time t-1
     !* 3) qup as well as quc at time t for a downstream reach in a serial network takes
     !*    exactly the same value qdp at time t (or qdc at time t-1) for the upstream reach
+    !* The secant starts from the upper and lower depth estimates h_seed and h_0_seed;
+    !* iters returns the total number of secant iterations.
 
     implicit none
 
@@ -21,8 +87,10 @@ subroutine muskingcungenwm(dt, qup, quc, qdp, ql, dx, bw, tw, twcc,&
     real(prec), intent(in) :: dx, bw, tw, twcc, n, ncc, cs, s0
     real(prec), intent(in) :: velp
     real(prec), intent(in) :: depthp
+    real(prec), intent(in) :: h_seed, h_0_seed
     real(prec), intent(out) :: qdc, velc, depthc
     real(prec), intent(out) :: ck, cn, X
+    integer, intent(out) :: iters
     real(prec) :: z
     real(prec) :: bfd, C1, C2, C3, C4
 
@@ -67,11 +135,22 @@ subroutine muskingcungenwm(dt, qup, quc, qdp, ql, dx, bw, tw, twcc,&
     end if
 
     depthc = max(depthp, 0.0_prec)
-    h     = (depthc * 1.33_prec) + mindepth !1.50 of  depthc
-    h_0   = (depthc * 0.67_prec)            !0.50 of depthc
+    h     = h_seed
+    h_0   = h_0_seed
+    iters = 0
+    ! secant2_h reads the Qj_0 and C1-C4 of the previous estimate, so start
+    ! them from zero; otherwise the result depends on whatever an earlier call
+    ! left on the stack
+    Qj = 0.0_prec
+    Qj_0 = 0.0_prec
+    C1 = 0.0_prec
+    C2 = 0.0_prec
+    C3 = 0.0_prec
+    C4 = 0.0_prec
+    X = 0.0_prec
 
     if(ql .gt. 0.0_prec .or. qup .gt. 0.0_prec .or. quc .gt. 0.0_prec &
-        .or. qdp .gt. 0.0_prec .or. qdc .gt. 0.0_prec) then  !only solve if there's water to flux
+        .or. qdp .gt. 0.0_prec) then  !only solve if there's water to flux
 110 continue
 
         !Uncomment next two lines for old initialization
@@ -115,6 +194,7 @@ subroutine muskingcungenwm(dt, qup, quc, qdp, ql, dx, bw, tw, twcc,&
             h_0  = max(0.0_prec,h)
             h    = max(0.0_prec,h_1)
             iter = iter + 1
+            iters = iters + 1
                         !write(41,"(3i5,2x,8f15.4)") k, i, iter, dmy1, Qj_0, dmy2, Qj, h_0, h, rerror, aerror
                         !write(42,*) k, i, iter, dmy1, Qj_0, dmy2, Qj, h_0, h, rerror, aerror
             if( h .lt. mindepth) then  ! exit loop if depth is very small
@@ -182,7 +262,7 @@ subroutine muskingcungenwm(dt, qup, quc, qdp, ql, dx, bw, tw, twcc,&
     ! *************************************************************
     call courant(h, bfd, bw, twcc, ncc, s0, n, z, dx, dt, ck, cn)
 
-end subroutine muskingcungenwm
+end subroutine muskingcungenwm_seeded
 
 !**---------------------------------------------------**!
 !*                                                     *!
@@ -1,7 +1,7 @@
 module muskingcunge_interface
 
-use, intrinsic :: iso_c_binding, only: c_float
-use muskingcunge_module, only: muskingcungenwm
+use, intrinsic :: iso_c_binding, only: c_float, c_int
+use muskingcunge_module, only: muskingcungenwm, muskingcungenwm_warm
 
 implicit none
 contains
@@ -22,4 +22,30 @@ subroutine c_muskingcungenwm(dt, qup, quc, qdp, ql, dx, bw, tw, twcc,&
     n, ncc, cs, s0, velp, depthp, qdc, velc, depthc, ck, cn, X)
     
 end subroutine c_muskingcungenwm
+
+subroutine c_muskingcungenwm_warm(dt, qup, quc, qdp, ql, dx, bw, tw, twcc,&
+    n, ncc, cs, s0, velp, depthp, depthpp, warm_start, qdc, velc, depthc, iters) bind(c)
+
+    real(c_float), intent(in) :: dt
+    real(c_float), intent(in) :: qup, quc, qdp, ql
+    real(c_float), intent(in) :: dx, bw, tw, twcc, n, ncc, cs, s0
+    real(c_float), intent(in) :: velp, depthp, depthpp
+    integer(c_int), intent(in) :: warm_start
+    real(c_float), intent(out) :: qdc, velc, depthc
+    integer(c_int), intent(out) :: iters
+    real(c_float) :: ck, cn, X
+    integer :: niter
+
+    ! depthpp is the depth of the timestep before depthp; it seeds the
+    ! secant when warm_start is not 0 and is ignored otherwise.
+    if (warm_start .ne. 0) then
+        call muskingcungenwm_warm(dt, qup, quc, qdp, ql, dx, bw, tw, twcc,&
+        n, ncc, cs, s0, velp, depthp, depthpp, qdc, velc, depthc, ck, cn, X, niter)
+    else
+        call muskingcungenwm(dt, qup, quc, qdp, ql, dx, bw, tw, twcc,&
+        n, ncc, cs, s0, velp, depthp, qdc, velc, depthc, ck, cn, X, niter)
+    endif
+    iters = niter
+
+end subroutine c_muskingcungenwm_warm
 end module muskingcunge_interface
@@ -1,5 +1,12 @@
+import os
 import zipfile
+import pathlib
+import hashlib
+import threading
+from itertools import chain
+from functools import partial
 
+import numpy as np
 import xarray as xr
 import pandas as pd
 import geopandas as gpd
@@ -39,6 +46,92 @@ def read_mask(path, layer_string=None):
     return read_csv(path, header=None, layer_string=layer_string)
 
 
+def _row_spans(rows, max_gap):
+    """Split sorted rows into spans [a, b) that skip gaps of more than max_gap rows"""
+    breaks = np.flatnonzero(np.diff(rows) > max_gap) + 1
+    starts = rows[np.concatenate(([0], breaks))]
+    stops = rows[np.concatenate((breaks - 1, [len(rows) - 1]))] + 1
+    return list(zip(starts.tolist(), stops.tolist()))
+
+
+def _read_rows(var, rows, spans):
+    """Read rows of a 1D NetCDF variable, one contiguous read per span"""
+    if rows is None:
+        return var[:]
+    if not spans:
+        return var[:0]
+    parts = []
+    for a, b in spans:
+        span_rows = rows[(rows >= a) & (rows < b)]
+        parts.append(var[a:b][span_rows - a])
+    return np.ma.concatenate(parts)
+
+
+def read_routelink(
+    geo_file_path,
+    columns,
+    mask_ids=None,
+    layer_string=None,
+    driver_string=None,
+    max_gap=4096,
+):
+    """
+    Read the segment parameters of a supernetwork without loading the whole
+    RouteLink file.
+
+    geo_file_path: RouteLink NetCDF file, or any file read_geopandas can read
+    columns: column map of set_supernetwork_data (role -> variable); only these
+        variables are read
+    mask_ids: segment ids to keep (None for all segments)
+    max_gap: NetCDF rows are read in contiguous spans around the rows of
+        mask_ids; a gap of more than max_gap rows between them starts a new span
+
+    Returns a frame indexed by the key variable and sorted by it, with the
+    variables named as in the file. The key, downstream and waterbody
+    variables are int64 and all other variables float32. For NetCDF files,
+    the key variable is read in full to locate the rows of mask_ids, and only
+    the spans covering those rows are read from the other variables.
+    """
+    key = columns["key"]
+    id_variables = {columns[c] for c in ("key", "downstream", "waterbody") if c in columns}
+    variables = [v for v in dict.fromkeys(columns.values()) if v != key]
+
+    if geo_file_path.endswith(".nc"):
+        import netCDF4
+
+        with netCDF4.Dataset(geo_file_path) as ds:
+            ids = np.asarray(ds[key][:], dtype="int64")
+            rows = spans = None
+            if mask_ids is not None:
+                rows = np.flatnonzero(np.isin(ids, np.asarray(mask_ids, dtype="int64")))
+                ids = ids[rows]
+                spans = _row_spans(rows, max_gap) if len(rows) else []
+            data = {}
+            for v in variables:
+                values = _read_rows(ds[v], rows, spans)
+                if v in id_variables:
+                    data[v] = np.ma.getdata(values).astype("int64")
+                else:
+                    data[v] = np.ma.filled(values.astype("float32"), np.nan)
+        df = pd.DataFrame(data, index=pd.Index(ids, name=key))
+    else:
+        kwargs = {}
+        if layer_string is not None:
+            kwargs["layer"] = layer_string
+        if driver_string is not None:
+            kwargs["driver"] = driver_string
+        df = gpd.read_file(
+            geo_file_path, columns=[key] + variables, ignore_geometry=True, **kwargs
+        )
+        df = df.set_index(key)[variables]
+        if mask_ids is not None:
+            df = df[df.index.isin(mask_ids)]
+        df = df.astype({v: "int64" if v in id_variables else "float32" for v in variables})
+        df.index = df.index.astype("int64")
+
+    return df.sort_index()
+
+
 def read_custom_input(custom_input_file):
     if custom_input_file[-4:] == "yaml":
         with open(custom_input_file) as custom_file:
@@ -62,14 +155,27 @@ def read_custom_input(custom_input_file):
         run_parameters,
     )
 
-def replace_downstreams(data, downstream_col, terminal_code):
-    ds0_mask = data[downstream_col] == terminal_code
-    new_data = data.copy()
-    new_data.loc[ds0_mask, downstream_col] = ds0_mask.index[ds0_mask]
+def replace_downstreams(data, downstream_col, terminal_code, inplace=False):
+    """
+    Mark the terminal segments of data, whose downstream is terminal_code or a
+    segment that is not in data. Terminal segments get the negated id of
+    their downstream segment, or their own negated id for terminal_code.
+
+    With inplace=True the downstream column of data is replaced instead of
+    copying the whole table.
+    """
+    index = data.index.values
+    ds = data[downstream_col].values
+    ds0_mask = ds == terminal_code
+    missing = ~data[downstream_col].isin(index).values
+
+    new_ds = np.where(ds0_mask, index, ds)
+    new_ds[missing] *= -1
 
-    # Also set negative any nodes in downstream col not in data.index
-    new_data.loc[~data[downstream_col].isin(data.index), downstream_col] *= -1
-    return new_data
+    if not inplace:
+        data = data.copy()
+    data[downstream_col] = new_ds
+    return data
 
 
 def read_waterbody_df(waterbody_parameters, waterbodies_values, wbtype="level_pool"):
@@ -162,6 +268,316 @@ def get_ql_from_wrf_hydro(qlat_files, index_col="station_id", value_col="q_later
     return ql
 
 
+def _read_chrtout_columns(qlat_files, index, index_col, value_col):
+    """
+    Read value_col of each of qlat_files into a float32 array of
+    len(index) x len(qlat_files); features that are not in index are dropped.
+    Returns the array and the time of each file.
+    """
+    import netCDF4
+
+    values = np.zeros((len(index), len(qlat_files)), dtype="float32")
+    times = []
+    ids = rows = keep = None
+    for j, filename in enumerate(qlat_files):
+        with netCDF4.Dataset(filename) as ds:
+            feature_ids = ds[index_col][:]
+            # files of a run share their feature_id order; only map it again if it changes
+            if ids is None or not np.array_equal(feature_ids, ids):
+                ids = feature_ids
+                rows = np.minimum(np.searchsorted(index, ids), len(index) - 1)
+                keep = index[rows] == ids
+                rows = rows[keep]
+            values[rows, j] = np.ma.filled(ds[value_col][:], np.nan)[keep]
+            time = ds["time"]
+            times.append(
+                netCDF4.num2date(
+                    time[0],
+                    time.units,
+                    only_use_cftime_datetimes=False,
+                    only_use_python_datetimes=True,
+                )
+            )
+    return values, times
+
+
+def get_ql_from_chrtout(
+    qlat_files,
+    segments=None,
+    index_col="feature_id",
+    value_col="q_lateral",
+    max_workers=None,
+):
+    """
+    qlat_files: list of CHRTOUT files containing desired lateral inflows
+    segments: segment ids to read; if None, the features of the first file
+    index_col: variable in the CHRTOUT files with the segment/link id
+    value_col: variable in the CHRTOUT files with the lateral inflow value
+    max_workers: number of reader processes (default: one per cpu)
+
+    Returns the same segment x time table as `get_ql_from_wrf_hydro`, but only
+    index_col, value_col and time are read from each file and the values are
+    written straight into a float32 array, one column per file, instead of
+    converting every variable of every file to a frame and pivoting them.
+    The files are split into contiguous chunks read by a process pool. Segments
+    that are not in the files have 0 lateral inflow.
+    """
+    import netCDF4
+
+    qlat_files = list(qlat_files)
+    if segments is None:
+        with netCDF4.Dataset(qlat_files[0]) as ds:
+            segments = ds[index_col][:]
+    index = np.unique(np.asarray(segments, dtype="int64"))
+    ql = np.zeros((len(index), len(qlat_files)), dtype="float32")
+
+    workers = max(1, min(max_workers or os.cpu_count() or 1, len(qlat_files)))
+    bounds = np.linspace(0, len(qlat_files), workers + 1).astype(int)
+    chunks = [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+    times = []
+    if len(chunks) <= 1:
+        ql[:], times = _read_chrtout_columns(qlat_files, index, index_col, value_col)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+            futures = [
+                executor.submit(
+                    _read_chrtout_columns,
+                    qlat_files[a:b],
+                    index,
+                    index_col,
+                    value_col,
+                )
+                for a, b in chunks
+            ]
+            for (a, b), future in zip(chunks, futures):
+                ql[:, a:b], chunk_times = future.result()
+                times.extend(chunk_times)
+
+    times = pd.DatetimeIndex(times, name="time")
+    order = np.argsort(times, kind="stable")
+    if np.any(order != np.arange(len(order))):
+        ql = ql[:, order]
+        times = times[order]
+    return pd.DataFrame(ql, index=pd.Index(index, name=index_col), columns=times, copy=False)
+
+
+
+class QlatProvider:
+    """
+    Lateral inflows (segments x forcing timesteps) read lazily as the timestep
+    loop of compute_network advances, instead of holding the whole qlat table
+    in memory (see the qlat_provider argument of compute_network).
+
+    Subclasses set index (sorted segment ids) and ncols (number of forcing
+    timesteps) and implement read_columns(start, stop), returning a float32
+    array of len(index) x (stop - start). Columns are read in windows of
+    `window` forcing timesteps; with prefetch, the window following the last
+    requested one is read on a background thread while it is routed.
+    """
+
+    def __init__(self, index, ncols, window=1, prefetch=True):
+        self.index = np.asarray(index, dtype="int64")
+        self.ncols = ncols
+        self.window = max(1, window)
+        self._windows = {}
+        self._executor = None
+        if prefetch:
+            from concurrent.futures import ThreadPoolExecutor
+
+            self._executor = ThreadPoolExecutor(max_workers=1)
+
+    @property
+    def shape(self):
+        return (len(self.index), self.ncols)
+
+    def read_columns(self, start, stop):
+        raise NotImplementedError
+
+    def find_rows(self, segments):
+        """Rows of segments in index; -1 for segments without lateral inflow"""
+        segments = np.asarray(segments, dtype="int64")
+        if len(self.index) == 0:
+            return np.full(len(segments), -1, dtype="int64")
+        rows = np.minimum(np.searchsorted(self.index, segments), len(self.index) - 1)
+        return np.where(self.index[rows] == segments, rows, -1)
+
+    def _read_window(self, w):
+        start = w * self.window
+        return self.read_columns(start, min(start + self.window, self.ncols))
+
+    def _get_window(self, w):
+        values = self._windows.get(w)
+        if values is None:
+            values = self._windows[w] = self._read_window(w)
+        elif not isinstance(values, np.ndarray):
+            values = self._windows[w] = values.result()
+        return values
+
+    def columns(self, start, stop, rows):
+        """
+        Columns [start, stop) of rows (see find_rows) as a C-contiguous float32
+        array of len(rows) x (stop - start). Windows before start are released.
+        """
+        first = start // self.window
+        last = (stop - 1) // self.window
+        for w in [w for w in self._windows if w < first]:
+            del self._windows[w]
+        values = np.concatenate(
+            [self._get_window(w) for w in range(first, last + 1)], axis=1
+        )
+        offset = first * self.window
+        values = values[:, start - offset : stop - offset]
+
+        rows = np.asarray(rows)
+        out = np.ascontiguousarray(values[np.maximum(rows, 0)], dtype="float32")
+        out[rows < 0] = 0
+
+        nxt = last + 1
+        if (
+            self._executor is not None
+            and nxt * self.window < self.ncols
+            and nxt not in self._windows
+        ):
+            self._windows[nxt] = self._executor.submit(self._read_window, nxt)
+        return out
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._windows.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ArrayQlatProvider(QlatProvider):
+    """
+    Qlat provider over an in-memory or memory-mapped array
+    (e.g. np.load(path, mmap_mode="r")) of len(index) x forcing timesteps.
+    """
+
+    def __init__(self, index, values, window=1, prefetch=False):
+        super().__init__(index, values.shape[1], window=window, prefetch=prefetch)
+        self.values = values
+
+    def read_columns(self, start, stop):
+        return np.asarray(self.values[:, start:stop], dtype="float32")
+
+
+class ChrtoutQlatProvider(QlatProvider):
+    """
+    Qlat provider reading one CHRTOUT file per forcing timestep.
+
+    qlat_files: CHRTOUT files; they are ordered by file name, i.e. by time for
+        the standard YYYYMMDDHHMM.CHRTOUT_DOMAIN1 names
+    segments: segment ids to read; if None, the features of the first file
+    ncols: number of forcing timesteps; timesteps past the last file have no
+        lateral inflow (default: one per file)
+    """
+
+    def __init__(
+        self,
+        qlat_files,
+        segments=None,
+        index_col="feature_id",
+        value_col="q_lateral",
+        window=1,
+        prefetch=True,
+        ncols=None,
+    ):
+        import netCDF4
+
+        self.qlat_files = sorted(qlat_files, key=lambda f: pathlib.Path(f).name)
+        if segments is None:
+            with netCDF4.Dataset(self.qlat_files[0]) as ds:
+                segments = ds[index_col][:]
+        super().__init__(
+            np.unique(np.asarray(segments, dtype="int64")),
+            max(ncols or 0, len(self.qlat_files)),
+            window=window,
+            prefetch=prefetch,
+        )
+        self.index_col = index_col
+        self.value_col = value_col
+
+    def read_columns(self, start, stop):
+        values = np.zeros((len(self.index), stop - start), dtype="float32")
+        qlat_files = self.qlat_files[start:stop]
+        if qlat_files:
+            values[:, : len(qlat_files)], _ = _read_chrtout_columns(
+                qlat_files, self.index, self.index_col, self.value_col
+            )
+        return values
+
+
+class CsvQlatProvider(QlatProvider):
+    """
+    Qlat provider over a comma delimited file in the layout of get_ql_from_csv
+    (header giving timesteps, one row per segment). Only the columns of a
+    window are parsed when it is read.
+    """
+
+    def __init__(self, qlat_input_file, index_col=0, window=24, prefetch=True):
+        self.qlat_input_file = qlat_input_file
+        header = pd.read_csv(qlat_input_file, nrows=0, index_col=index_col)
+        ids = pd.read_csv(qlat_input_file, usecols=[index_col]).iloc[:, 0]
+        ids = ids.to_numpy().astype("int64")
+        order = np.argsort(ids, kind="stable")
+        self._file_rows = order
+        super().__init__(
+            ids[order], len(header.columns), window=window, prefetch=prefetch
+        )
+        self._index_col = index_col
+        self._columns = [
+            c for c in range(len(header.columns) + 1) if c != index_col
+        ]
+
+    def read_columns(self, start, stop):
+        ql = pd.read_csv(
+            self.qlat_input_file,
+            usecols=self._columns[start:stop],
+            dtype="float32",
+        )
+        return ql.to_numpy()[self._file_rows]
+
+
+
+class CatchmentQlatProvider(QlatProvider):
+    """
+    Qlat provider over the catchment outputs of the next generation water
+    modeling framework: one cat-<id>_*.csv file per catchment in path, with a
+    row of (time, flow) per forcing timestep. Only the rows of a window are
+    parsed from each file when it is read.
+    """
+
+    def __init__(self, path, window=24, prefetch=True):
+        files = {}
+        for file_name in os.listdir(path):
+            if file_name.startswith("cat-"):
+                catchment_id = int(file_name.split("_")[0][4:])
+                files[catchment_id] = os.path.join(path, file_name)
+        index = np.array(sorted(files), dtype="int64")
+        self.files = [files[i] for i in index]
+        with open(self.files[0]) as f:
+            ncols = sum(1 for line in f if line.strip())
+        super().__init__(index, ncols, window=window, prefetch=prefetch)
+
+    def read_columns(self, start, stop):
+        values = np.zeros((len(self.files), stop - start), dtype="float32")
+        for i, f in enumerate(self.files):
+            flow = pd.read_csv(
+                f, header=None, usecols=[1], skiprows=start, nrows=stop - start
+            )
+            values[i, : len(flow)] = flow.iloc[:, 0].to_numpy(dtype="float32")
+        return values
+
+
 def get_stream_restart_from_wrf_hydro(
     channel_initial_states_file,
     crosswalk_file,
@@ -195,32 +611,23 @@ def get_stream_restart_from_wrf_hydro(
     crosswalk file.
     """
 
-    with xr.open_dataset(crosswalk_file) as xds:
-        xdf = xds[channel_ID_column].to_dataframe()
-    xdf = xdf.reset_index()
-    xdf = xdf[[channel_ID_column]]
-    with xr.open_dataset(channel_initial_states_file) as qds:
-        if depth_column in qds:
-            qdf2 = qds[[us_flow_column, ds_flow_column, depth_column]].to_dataframe()
-        else:
-            qdf2 = qds[[us_flow_column, ds_flow_column]].to_dataframe()
-            qdf2[depth_column] = 0
-    qdf2 = qdf2.reset_index()
-    qdf2 = qdf2[[us_flow_column, ds_flow_column, depth_column]]
-    qdf2.rename(
-        columns={
-            us_flow_column: default_us_flow_column,
-            ds_flow_column: default_ds_flow_column,
-            depth_column: default_depth_column,
-        },
-        inplace=True,
-    )
-    qdf2[channel_ID_column] = xdf
-    qdf2 = qdf2.reset_index().set_index([channel_ID_column])
+    import netCDF4
+
+    with netCDF4.Dataset(crosswalk_file) as xds:
+        ids = np.asarray(xds[channel_ID_column][:])
+    # read the restart variables straight into the columns of the initial states
+    q0 = np.zeros((len(ids), 3), dtype="float32")
+    with netCDF4.Dataset(channel_initial_states_file) as qds:
+        for j, column in enumerate((us_flow_column, ds_flow_column, depth_column)):
+            if column in qds.variables:
+                q0[:, j] = qds[column][:]
 
-    q_initial_states = qdf2
-    
-    q_initial_states = q_initial_states.drop(columns = "index")
+    q_initial_states = pd.DataFrame(
+        q0,
+        index=pd.Index(ids, name=channel_ID_column),
+        columns=[default_us_flow_column, default_ds_flow_column, default_depth_column],
+        copy=False,
+    )
 
     return q_initial_states
 
@@ -282,3 +689,450 @@ def get_reservoir_restart_from_wrf_hydro(
     init_waterbody_states = mod
 
     return init_waterbody_states
+
+
+
+def write_restart(path, segments, state, waterbodies=None, timestep=None):
+    """
+    Write a t-route restart file: the channel state (qu0, qd0, h0) and the
+    waterbody state (qd0, h0) as flat arrays in an uncompressed .npz.
+
+    segments: segment ids of the rows of state
+    state: len(segments) x 3 array of qu0, qd0, h0 (see compute_network restart_sink)
+    waterbodies: ids of segments that are waterbodies; their qd0 (outflow) and
+        h0 (water elevation) are written as waterbody state
+    timestep: timestep of the state, recorded in the file
+    """
+    path = pathlib.Path(path)
+    segments = np.asarray(segments, dtype="int64")
+    state = np.asarray(state, dtype="float32")
+    order = np.argsort(segments)
+    segments, state = segments[order], state[order]
+    lakes = np.isin(segments, np.asarray(list(waterbodies or ()), dtype="int64"))
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp.npz")
+    np.savez(
+        tmp,
+        channel_ids=segments[~lakes],
+        channel_state=state[~lakes],
+        waterbody_ids=segments[lakes],
+        waterbody_state=state[lakes][:, 1:],
+        timestep=np.array(-1 if timestep is None else timestep),
+    )
+    os.replace(tmp, path)
+
+
+def read_restart(path):
+    """
+    Read a t-route restart file (see write_restart).
+
+    Returns (channel_states, waterbody_states): frames indexed by segment with
+    the qu0, qd0, h0 columns of get_stream_restart_from_wrf_hydro and the qd0, h0
+    columns of get_reservoir_restart_from_wrf_hydro.
+    """
+    with np.load(path) as data:
+        channel_states = pd.DataFrame(
+            data["channel_state"],
+            index=data["channel_ids"],
+            columns=["qu0", "qd0", "h0"],
+        )
+        waterbody_states = pd.DataFrame(
+            data["waterbody_state"], index=data["waterbody_ids"], columns=["qd0", "h0"],
+        )
+    return channel_states, waterbody_states
+
+
+class RestartSink:
+    """
+    Restart sink collecting the state emitted by compute_network (see its
+    restart_sink argument) from any number of networks, and writing one restart
+    file per timestep with write_restart on close.
+
+    path: restart file name; "{timestep}" in it is replaced by the timestep
+    waterbodies: ids of segments that are waterbodies
+    """
+
+    def __init__(self, path, waterbodies=None):
+        self.path = str(path)
+        self.waterbodies = waterbodies
+        self.lock = threading.Lock()
+        self.states = {}
+
+    def write(self, data_idx, timestep, state):
+        with self.lock:
+            self.states.setdefault(int(timestep), []).append(
+                (np.array(data_idx), np.array(state))
+            )
+
+    def close(self):
+        for timestep, parts in sorted(self.states.items()):
+            segments, states = zip(*parts)
+            write_restart(
+                self.path.format(timestep=timestep),
+                np.concatenate(segments),
+                np.concatenate(states),
+                self.waterbodies,
+                timestep,
+            )
+        self.states.clear()
+
+
+class MemmapOutputSink:
+    """
+    Output sink writing flowveldepth into a memory-mapped .npy file as timesteps
+    are computed. The file holds an array of segments x (3 * nsteps) with the
+    flow, velocity and depth of each timestep, in the same layout as the dense
+    flowveldepth returned by compute_network.
+
+    index: sorted segment ids of all rows of the file. The index is also saved
+    next to the output, with the suffix "_index.npy".
+    """
+
+    def __init__(self, path, index, nsteps):
+        path = pathlib.Path(path)
+        self.index = np.asarray(index)
+        np.save(path.with_name(path.stem + "_index.npy"), self.index)
+        self.values = np.lib.format.open_memmap(
+            path, mode="w+", dtype="float32", shape=(len(self.index), nsteps * 3)
+        )
+
+    def write(self, data_idx, tstart, values):
+        rows = np.searchsorted(self.index, data_idx)
+        self.values[rows, tstart * 3 : tstart * 3 + values.shape[1]] = values
+
+    def close(self):
+        self.values.flush()
+
+
+class NetCDFOutputSink:
+    """
+    Output sink writing flow, velocity and depth variables (feature_id x time)
+    into a chunked NetCDF file as timesteps are computed.
+
+    index: sorted segment ids of the feature_id dimension
+    chunk_timesteps: number of timesteps in a chunk of each variable
+    """
+
+    def __init__(self, path, index, nsteps, chunk_timesteps=12):
+        import netCDF4
+
+        self.index = np.asarray(index)
+        self.lock = threading.Lock()
+        self.ds = netCDF4.Dataset(str(path), "w")
+        self.ds.createDimension("feature_id", len(self.index))
+        self.ds.createDimension("time", nsteps)
+        self.ds.createVariable("feature_id", "i8", ("feature_id",))[:] = self.index
+        chunksizes = (len(self.index), min(chunk_timesteps, nsteps))
+        self.variables = [
+            self.ds.createVariable(
+                name, "f4", ("feature_id", "time"), chunksizes=chunksizes, zlib=True
+            )
+            for name in ("flow", "velocity", "depth")
+        ]
+
+    def write(self, data_idx, tstart, values):
+        rows = np.searchsorted(self.index, data_idx)
+        tend = tstart + values.shape[1] // 3
+        with self.lock:
+            for i, var in enumerate(self.variables):
+                var[rows, tstart:tend] = values[:, i::3]
+
+    def close(self):
+        self.ds.close()
+
+
+class SelectedSegmentsOutputSink:
+    """
+    Output sink keeping flowveldepth in memory for selected segments only
+    (e.g. gages or forecast points), discarding every other segment.
+
+    segments: segment ids to keep
+    """
+
+    def __init__(self, segments, nsteps):
+        self.index = np.unique(np.asarray(segments))
+        self.values = np.zeros((len(self.index), nsteps * 3), dtype="float32")
+
+    def write(self, data_idx, tstart, values):
+        rows = np.searchsorted(data_idx, self.index)
+        rows = np.minimum(rows, len(data_idx) - 1)
+        found = np.asarray(data_idx)[rows] == self.index
+        self.values[found, tstart * 3 : tstart * 3 + values.shape[1]] = values[
+            rows[found]
+        ]
+
+    def close(self):
+        pass
+
+    def to_dataframe(self):
+        columns = pd.MultiIndex.from_product(
+            [range(self.values.shape[1] // 3), ["q", "v", "d"]]
+        ).to_flat_index()
+        return pd.DataFrame(self.values, index=self.index, columns=columns)
+
+
+def get_output_sink(path, index, nsteps):
+    """
+    Choose an output sink from the file extension of path:
+    .npy for MemmapOutputSink, .nc for NetCDFOutputSink.
+    """
+    path = str(path)
+    if path.endswith(".npy"):
+        return MemmapOutputSink(path, index, nsteps)
+    elif path.endswith(".nc"):
+        return NetCDFOutputSink(path, index, nsteps)
+    else:
+        raise ValueError(f"unsupported output file type: {path}")
+
+
+FINGERPRINT_BLOCK = 1 << 20
+
+
+def file_fingerprint(path):
+    """
+    Identify a file by its size and a sha1 digest of its whole contents,
+    read in blocks.
+
+    Unlike a modification time, the digest is kept when a file is copied or
+    touched and changes whenever the file is rewritten with other contents,
+    including edits in place that keep its size.
+    """
+    path = pathlib.Path(path).resolve()
+    size = path.stat().st_size
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(partial(f.read, FINGERPRINT_BLOCK), b""):
+            digest.update(block)
+    return f"{size}:{digest.hexdigest()}"
+
+
+def topology_cache_path(cache_dir, source_files, **options):
+    """
+    Locate the topology cache entry for a set of source files and options.
+
+    The entry is named by a hash of the source paths and options, so a
+    modified source file maps to the same entry and is detected as stale by
+    read_topology_cache.
+
+    Arguments:
+        cache_dir (str): Cache directory
+        source_files (list): Geo file, mask file, ... (None entries are ignored)
+        options: Options that change the topology, e.g. break_at_waterbodies
+
+    Returns:
+        (pathlib.Path, str) the cache entry and the fingerprint of its sources
+    """
+    key, fingerprint = _cache_key(source_files, options)
+    return pathlib.Path(cache_dir, f"topology_{key}.npz"), fingerprint
+
+
+def _cache_key(source_files, options):
+    source_files = [pathlib.Path(f).resolve() for f in source_files if f]
+    name = json.dumps([list(map(str, source_files)), sorted(options.items())])
+    key = hashlib.sha1(name.encode()).hexdigest()[:16]
+    fingerprint = json.dumps(
+        [list(map(file_fingerprint, source_files)), sorted(options.items())]
+    )
+    return key, fingerprint
+
+
+def _offsets(lists):
+    offsets = np.zeros(len(lists) + 1, dtype="int64")
+    np.cumsum([len(l) for l in lists], out=offsets[1:])
+    return offsets
+
+
+def _flatten(lists):
+    offsets = _offsets(lists)
+    values = np.fromiter(chain.from_iterable(lists), dtype="int64", count=offsets[-1])
+    return offsets, values
+
+
+def _unflatten(offsets, values):
+    offsets = offsets.tolist()
+    values = values.tolist()
+    return [values[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
+
+
+def write_topology_cache(path, fingerprint, networks, reaches_bytw, network_deps=None):
+    """
+    Save decomposed networks to a topology cache entry as flat arrays.
+
+    Arguments:
+        path (str): Cache entry, see topology_cache_path
+        fingerprint (str): Fingerprint of the sources, see topology_cache_path
+        networks (dict): tailwater -> network (node -> upstream nodes)
+        reaches_bytw (dict): tailwater -> list of reaches
+        network_deps (dict): cut subnetwork -> downstream subnetwork
+    """
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tws = list(reaches_bytw)
+    network_deps = network_deps or {}
+
+    nodes = [list(networks[tw]) for tw in tws]
+    node_offsets, node_values = _flatten(nodes)
+    upstream_offsets, upstream = _flatten(
+        [networks[tw][n] for tw, ns in zip(tws, nodes) for n in ns]
+    )
+    network_offsets = _offsets([reaches_bytw[tw] for tw in tws])
+    reach_offsets, reach_segments = _flatten(
+        list(chain.from_iterable(reaches_bytw[tw] for tw in tws))
+    )
+
+    tmp = path.with_name(path.name + ".tmp.npz")
+    np.savez(
+        tmp,
+        fingerprint=np.array(fingerprint),
+        tailwaters=np.array(tws, dtype="int64"),
+        node_offsets=node_offsets,
+        nodes=node_values,
+        upstream_offsets=upstream_offsets,
+        upstream=upstream,
+        network_offsets=network_offsets,
+        reach_offsets=reach_offsets,
+        reach_segments=reach_segments,
+        deps=np.array(list(network_deps.items()), dtype="int64").reshape(-1, 2),
+    )
+    os.replace(tmp, path)
+
+
+def read_topology_cache(path, fingerprint):
+    """
+    Load decomposed networks from a topology cache entry.
+
+    An entry whose sources changed since it was written is deleted.
+
+    Arguments:
+        path (str): Cache entry, see topology_cache_path
+        fingerprint (str): Current fingerprint of the sources
+
+    Returns:
+        (networks, reaches_bytw, network_deps) as passed to
+        write_topology_cache, or None if there is no valid entry
+    """
+    path = pathlib.Path(path)
+    if not path.exists():
+        return None
+    with np.load(path) as data:
+        if str(data["fingerprint"]) != fingerprint:
+            data = None
+        else:
+            data = dict(data)
+    if data is None:
+        path.unlink()
+        return None
+
+    tws = data["tailwaters"].tolist()
+    node_offsets = data["node_offsets"].tolist()
+    nodes = data["nodes"].tolist()
+    upstream = _unflatten(data["upstream_offsets"], data["upstream"])
+    network_offsets = data["network_offsets"].tolist()
+    reaches = _unflatten(data["reach_offsets"], data["reach_segments"])
+
+    networks = {}
+    reaches_bytw = {}
+    for i, tw in enumerate(tws):
+        a, b = node_offsets[i], node_offsets[i + 1]
+        networks[tw] = dict(zip(nodes[a:b], upstream[a:b]))
+        reaches_bytw[tw] = reaches[network_offsets[i] : network_offsets[i + 1]]
+    network_deps = dict(data["deps"].tolist())
+    return networks, reaches_bytw, network_deps
+
+
+def frame_cache_path(cache_dir, name, source_files, **options):
+    """
+    Locate the frame cache entry `name` (e.g. "param" or "qlat") for a set of
+    source files and options; see topology_cache_path.
+
+    Returns:
+        (pathlib.Path, str) the cache entry and the fingerprint of its sources
+    """
+    key, fingerprint = _cache_key(source_files, options)
+    return pathlib.Path(cache_dir, f"{name}_{key}"), fingerprint
+
+
+def write_frame_cache(path, fingerprint, df):
+    """
+    Save a frame to a frame cache entry: a directory holding the index, the
+    column labels and one C-contiguous .npy block of the columns of each dtype,
+    so read_frame_cache maps the arrays without parsing anything.
+
+    Arguments:
+        path (str): Cache entry, see frame_cache_path
+        fingerprint (str): Fingerprint of the sources, see frame_cache_path
+        df (DataFrame): Frame to save
+    """
+    import shutil
+
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir()
+
+    if (df.dtypes == object).any():
+        raise ValueError("frame cache entries only hold numeric columns")
+    columns = np.asarray(df.columns)
+    if columns.dtype == object:
+        columns = columns.astype(str)
+    np.save(tmp / "index.npy", df.index.to_numpy())
+    np.save(tmp / "columns.npy", columns)
+    blocks = []
+    for i, dtype in enumerate(pd.unique(df.dtypes)):
+        positions = np.flatnonzero((df.dtypes == dtype).to_numpy())
+        np.save(
+            tmp / f"block_{i}.npy",
+            np.ascontiguousarray(df.iloc[:, positions].to_numpy(dtype=dtype)),
+        )
+        blocks.append(positions.tolist())
+    meta = {"fingerprint": fingerprint, "index_name": df.index.name, "blocks": blocks}
+    with open(tmp / "meta.json", "w") as f:
+        json.dump(meta, f)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+
+
+def read_frame_cache(path, fingerprint):
+    """
+    Load a frame from a frame cache entry. The blocks are memory-mapped
+    read-only; a frame of a single dtype is a view of its block.
+
+    An entry whose sources changed since it was written is deleted.
+
+    Arguments:
+        path (str): Cache entry, see frame_cache_path
+        fingerprint (str): Current fingerprint of the sources
+
+    Returns:
+        DataFrame as passed to write_frame_cache, or None if there is no valid entry
+    """
+    import shutil
+
+    path = pathlib.Path(path)
+    try:
+        with open(path / "meta.json") as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+    if meta["fingerprint"] != fingerprint:
+        shutil.rmtree(path, ignore_errors=True)
+        return None
+
+    index = pd.Index(np.load(path / "index.npy"), name=meta["index_name"])
+    columns = pd.Index(np.load(path / "columns.npy"))
+    blocks = [
+        np.load(path / f"block_{i}.npy", mmap_mode="r")
+        for i in range(len(meta["blocks"]))
+    ]
+    if len(blocks) == 1:
+        return pd.DataFrame(blocks[0], index=index, columns=columns, copy=False)
+    data = {}
+    for positions, block in zip(meta["blocks"], blocks):
+        for j, position in enumerate(positions):
+            data[position] = block[:, j]
+    df = pd.DataFrame({j: data[j] for j in range(len(columns))}, index=index)
+    df.columns = columns
+    return df
@@ -2,13 +2,273 @@ from collections import defaultdict, Counter, deque
 from itertools import chain
 from functools import reduce, partial
 from collections.abc import Iterable
+import heapq
+
+import numpy as np
+
+
+def _gather(indptr, indices, rows):
+    """Concatenate the adjacency lists indices[indptr[r]:indptr[r + 1]] of rows"""
+    starts = indptr[rows]
+    counts = indptr[rows + 1] - starts
+    total = counts.sum()
+    if not total:
+        return indices[:0]
+    # position of each gathered element: its row start plus its offset within the row
+    offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    return indices[offsets + np.arange(total)]
+
+
+class NetworkGraph:
+    """
+    A network stored as sorted int64 node ids and CSR adjacency.
+
+    The successors of nodes[i] are nodes[indices[indptr[i]:indptr[i + 1]]],
+    in the order of the list they were built from. Like the dict networks
+    used elsewhere in this module, edges point from a node to the nodes in
+    its list: downstream for connections, upstream for reversed networks.
+    The module functions accept a NetworkGraph wherever they accept a dict.
+    """
+
+    def __init__(self, nodes, indptr, indices):
+        self.nodes = nodes
+        self.indptr = indptr
+        self.indices = indices
+
+    @classmethod
+    def from_edges(cls, src, dst, nodes=None):
+        """
+        Build a graph from edge arrays. nodes defaults to the nodes of the edges;
+        pass it to include isolated nodes.
+        """
+        src = np.asarray(src, dtype="int64")
+        dst = np.asarray(dst, dtype="int64")
+        extra = () if nodes is None else (np.asarray(nodes, dtype="int64"),)
+        # One sort finds the nodes and the positions of both edge ends
+        nodes, inverse = np.unique(
+            np.concatenate((src, dst) + extra), return_inverse=True
+        )
+        si = inverse[: len(src)]
+        di = inverse[len(src) : len(src) + len(dst)]
+        order = np.argsort(si, kind="stable")
+        indptr = np.zeros(len(nodes) + 1, dtype="int64")
+        np.cumsum(np.bincount(si, minlength=len(nodes)), out=indptr[1:])
+        return cls(nodes, indptr, di[order])
+
+    @classmethod
+    def from_dict(cls, N):
+        """Build a graph from a dict network"""
+        keys = np.fromiter(N.keys(), dtype="int64", count=len(N))
+        counts = np.fromiter(map(len, N.values()), dtype="int64", count=len(N))
+        dst = np.fromiter(
+            chain.from_iterable(N.values()), dtype="int64", count=counts.sum()
+        )
+        return cls.from_edges(np.repeat(keys, counts), dst, keys)
+
+    def to_dict(self):
+        """Convert to a dict network with every node as a key"""
+        nodes = self.nodes.tolist()
+        dst = self.nodes[self.indices].tolist()
+        indptr = self.indptr.tolist()
+        return {n: dst[a:b] for n, a, b in zip(nodes, indptr[:-1], indptr[1:])}
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node):
+        i = np.searchsorted(self.nodes, node)
+        return i < len(self.nodes) and self.nodes[i] == node
+
+    def positions(self, nodes):
+        """Positions of node ids in self.nodes"""
+        return np.searchsorted(self.nodes, np.asarray(nodes, dtype="int64"))
+
+    def successors(self, node):
+        i = self.positions(node)
+        return self.nodes[self.indices[self.indptr[i] : self.indptr[i + 1]]]
+
+    __getitem__ = successors
+
+    def edges(self):
+        """Edges as (src, dst) arrays of node ids"""
+        src = np.repeat(self.nodes, np.diff(self.indptr))
+        return src, self.nodes[self.indices]
+
+    def in_degrees(self):
+        return np.bincount(self.indices, minlength=len(self.nodes))
+
+    def out_degrees(self):
+        return np.diff(self.indptr)
+
+    def headwaters(self):
+        return self.nodes[self.in_degrees() == 0]
+
+    def tailwaters(self):
+        return self.nodes[self.out_degrees() == 0]
+
+    def junctions(self):
+        return self.nodes[self.in_degrees() > 1]
+
+    def reverse(self):
+        """The graph with every edge reversed (CSC of this graph)"""
+        src = np.repeat(np.arange(len(self.nodes)), np.diff(self.indptr))
+        order = np.argsort(self.indices, kind="stable")
+        indptr = np.zeros(len(self.nodes) + 1, dtype="int64")
+        np.cumsum(self.in_degrees(), out=indptr[1:])
+        return NetworkGraph(self.nodes, indptr, src[order])
+
+    def toposort_levels(self):
+        """
+        Kahn's algorithm, one level at a time: level 0 holds the nodes without
+        predecessors and level k the nodes whose predecessors are all in lower levels.
+
+        Returns:
+            (list) sorted arrays of node ids of each level
+        """
+        degrees = self.in_degrees()
+        frontier = np.flatnonzero(degrees == 0)
+        levels = []
+        nsorted = 0
+        while frontier.size:
+            levels.append(self.nodes[frontier])
+            nsorted += frontier.size
+            succ = _gather(self.indptr, self.indices, frontier)
+            succ, counts = np.unique(succ, return_counts=True)
+            degrees[succ] -= counts
+            frontier = succ[degrees[succ] == 0]
+        if nsorted < len(self.nodes):
+            raise Exception("Cycle exists!")
+        return levels
+
+    def kahn_toposort(self):
+        levels = self.toposort_levels()
+        return np.concatenate(levels) if levels else self.nodes[:0]
+
+    def component_labels(self, sources=None):
+        """
+        Label each node with the source it is reachable from, in one sweep
+        from all sources at once.
+
+        Arguments:
+            sources (iterable): Source node ids; the headwaters if None
+
+        Returns:
+            (ndarray, ndarray, bool) the sources; for each node the position
+            of its source in sources, or -1 if it is not reachable; and
+            whether every node is reachable from at most one source
+        """
+        if sources is None:
+            sources = self.headwaters()
+        sources = np.fromiter(sources, dtype="int64")
+        if len(sources) and self.in_degrees().max(initial=0) <= 1:
+            return (sources,) + self._forest_labels(self.positions(sources))
+
+        labels = np.full(len(self.nodes), -1, dtype="int64")
+        frontier = self.positions(sources)
+        labels[frontier] = np.arange(len(sources))
+        disjoint = len(np.unique(frontier)) == len(frontier)
+        while frontier.size:
+            counts = self.indptr[frontier + 1] - self.indptr[frontier]
+            succ = _gather(self.indptr, self.indices, frontier)
+            succ_labels = np.repeat(labels[frontier], counts)
+            new = labels[succ] == -1
+            labels[succ[new]] = succ_labels[new]
+            if disjoint and (labels[succ] != succ_labels).any():
+                disjoint = False
+            frontier = np.unique(succ[new])
+        return sources, labels, disjoint
+
+    def _forest_labels(self, source_pos):
+        """
+        component_labels for a forest (every node has at most one predecessor),
+        by pointer jumping: each node finds its nearest source among its
+        predecessors in O(log depth) vectorized passes.
+        """
+        n = len(self.nodes)
+        parent = np.full(n, -1, dtype="int64")
+        parent[self.indices] = np.repeat(np.arange(n), np.diff(self.indptr))
+
+        # Sources and roots point to themselves
+        ptr = np.where(parent < 0, np.arange(n), parent)
+        is_source = np.zeros(n, dtype=bool)
+        is_source[source_pos] = True
+        ptr[source_pos] = source_pos
+        while True:
+            nxt = ptr[ptr]
+            if np.array_equal(nxt, ptr):
+                break
+            ptr = nxt
+
+        labels = np.full(n, -1, dtype="int64")
+        labels[source_pos] = np.arange(len(source_pos))
+        labels = np.where(is_source[ptr], labels[ptr], -1)
+
+        # A source below another source, or listed twice, is reached from both
+        has_parent = parent[source_pos] >= 0
+        nested = labels[parent[source_pos[has_parent]]] >= 0
+        disjoint = not nested.any() and len(np.unique(source_pos)) == len(source_pos)
+        return labels, disjoint
+
+    def component_nodes(self, sources=None):
+        """
+        Nodes reachable from each source, as views into one array sorted by
+        component (see component_labels).
+
+        Returns:
+            (dict, bool) source -> array of node ids, and whether the
+            components are disjoint
+        """
+        sources, labels, disjoint = self.component_labels(sources)
+        order = np.argsort(labels, kind="stable")
+        offsets = np.searchsorted(labels[order], np.arange(len(sources) + 1))
+        offsets = offsets.tolist()
+        nodes = self.nodes[order]
+        components = {
+            k: nodes[a:b]
+            for k, a, b in zip(sources.tolist(), offsets[:-1], offsets[1:])
+        }
+        return components, disjoint
+
+    def reachable(self, sources=None):
+        """
+        Nodes reachable from each source (the headwaters if sources is None).
+
+        Returns:
+            (dict) source -> sorted array of node ids
+        """
+        components, disjoint = self.component_nodes(sources)
+        if disjoint:
+            return components
+
+        # Components overlap: search from each source, resetting only the
+        # visited nodes of the shared seen array
+        rv = {}
+        seen = np.zeros(len(self.nodes), dtype=bool)
+        for h in components:
+            frontier = self.positions([h])
+            visited = []
+            while frontier.size:
+                seen[frontier] = True
+                visited.append(frontier)
+                frontier = _gather(self.indptr, self.indices, frontier)
+                frontier = np.unique(frontier[~seen[frontier]])
+            visited = np.sort(np.concatenate(visited))
+            seen[visited] = False
+            rv[h] = self.nodes[visited]
+        return rv
 
 
 def nodes(N):
+    if isinstance(N, NetworkGraph):
+        yield from N.nodes.tolist()
+        return
     yield from N.keys() | (v for v in chain.from_iterable(N.values()) if v not in N)
 
 
 def edges(N):
+    if isinstance(N, NetworkGraph):
+        yield from zip(*(e.tolist() for e in N.edges()))
+        return
     for i, v in N.items():
         for j in v:
             yield (i, j)
@@ -24,6 +284,8 @@ def in_degrees(N):
     Returns:
 
     """
+    if isinstance(N, NetworkGraph):
+        return Counter(dict(zip(N.nodes.tolist(), N.in_degrees().tolist())))
     degs = Counter(chain.from_iterable(N.values()))
     degs.update(dict.fromkeys(headwaters(N), 0))
     return degs
@@ -39,6 +301,8 @@ def out_degrees(N):
     Returns:
 
     """
+    if isinstance(N, NetworkGraph):
+        return Counter(dict(zip(N.nodes.tolist(), N.out_degrees().tolist())))
     return in_degrees(reverse_network(N))
 
 
@@ -53,16 +317,49 @@ def extract_connections(rows, target_col, terminal_code=0):
     Returns:
         (dict)
     """
+    src = rows.index.values.tolist()
+    dst = rows[target_col].values.tolist()
+    if rows.index.is_unique:
+        return {s: [d] if d > 0 else [] for s, d in zip(src, dst)}
+
     network = {}
-    for src, dst in rows[target_col].items():
-        if src not in network:
-            network[src] = []
+    for s, d in zip(src, dst):
+        if s not in network:
+            network[s] = []
 
-        if dst > 0:
-            network[src].append(dst)
+        if d > 0:
+            network[s].append(d)
     return network
 
 
+def extract_connection_graph(rows, target_col):
+    """Extract the connection network of a dataframe as a NetworkGraph.
+
+    Arguments:
+        rows (DataFrame): Dataframe indexed by segment id
+        target_col (str): Downstream segment, terminal if not positive
+
+    Returns:
+        (NetworkGraph)
+    """
+    src = rows.index.values
+    dst = rows[target_col].values
+    edge = dst > 0
+    src, dst = src[edge], dst[edge]
+
+    index = rows.index
+    if index.is_monotonic_increasing and index.is_unique:
+        # Sorted segment ids are the nodes unless a downstream segment is outside rows;
+        # edges are located with the hash table of the index.
+        pos = index.get_indexer(dst)
+        if not (pos < 0).any():
+            si = np.flatnonzero(edge)
+            indptr = np.zeros(len(index) + 1, dtype="int64")
+            np.cumsum(np.bincount(si, minlength=len(index)), out=indptr[1:])
+            return NetworkGraph(index.values.astype("int64"), indptr, pos)
+    return NetworkGraph.from_edges(src, dst, index.values)
+
+
 def extract_waterbodies(rows, target_col, waterbody_null=-9999):
     """Extract waterbody mapping from dataframe.
     """
@@ -78,6 +375,8 @@ def reverse_surjective_mapping(d):
 
 
 def reverse_network(N):
+    if isinstance(N, NetworkGraph):
+        return N.reverse()
     rg = defaultdict(list)
     for src, dst in N.items():
         rg[src]
@@ -88,15 +387,23 @@ def reverse_network(N):
 
 
 def junctions(N):
+    if isinstance(N, NetworkGraph):
+        return set(N.junctions().tolist())
     c = Counter(chain.from_iterable(N.values()))
     return {k for k, v in c.items() if v > 1}
 
 
 def headwaters(N):
+    if isinstance(N, NetworkGraph):
+        yield from N.headwaters().tolist()
+        return
     yield from N.keys() - chain.from_iterable(N.values())
 
 
 def tailwaters(N):
+    if isinstance(N, NetworkGraph):
+        yield from N.tailwaters().tolist()
+        return
     yield from chain.from_iterable(N.values()) - N.keys()
     yield from (m for m, n in N.items() if not n)
 
@@ -111,6 +418,12 @@ def reachable(N, sources=None, targets=None):
 
     Returns:
     """
+    if isinstance(N, NetworkGraph):
+        if targets is not None:
+            N = N.to_dict()
+        else:
+            return {h: set(r.tolist()) for h, r in N.reachable(sources).items()}
+
     if sources is None:
         sources = headwaters(N)
 
@@ -149,6 +462,22 @@ def reachable_network(N, sources=None, targets=None, check_disjoint=True):
     Returns:
 
     """
+    if targets is None:
+        # Label the component of every node in one sweep instead of a BFS per source
+        G = N if isinstance(N, NetworkGraph) else NetworkGraph.from_dict(N)
+        components, disjoint = G.component_nodes(sources)
+        if check_disjoint and not disjoint:
+            raise ValueError("Networks not disjoint")
+        if disjoint:
+            if isinstance(N, NetworkGraph):
+                N = N.to_dict()
+            return {
+                k: {m: N.get(m, []) for m in nodes.tolist()}
+                for k, nodes in components.items()
+            }
+
+    if isinstance(N, NetworkGraph):
+        N = N.to_dict()
     reached = reachable(N, sources=sources, targets=targets)
     if check_disjoint and reduce(set.intersection, reached.values()):
         raise ValueError("Networks not disjoint")
@@ -171,6 +500,16 @@ def split_at_waterbodies_and_junctions(waterbody_nodes, network, path, node):
     # return node not in waterbody_nodes and len(network[node]) == 1
 
 
+def split_at_collapsed_waterbodies(waterbody_nodes, network, path, node):
+    """
+    Path function for networks where each waterbody is a single node (see
+    collapse_waterbodies): a waterbody node is a reach on its own.
+    """
+    if path[-1] in waterbody_nodes or node in waterbody_nodes:
+        return False
+    return len(network[node]) == 1
+
+
 def dfs_decomposition_depth_tuple(N, path_func, source_nodes=None):
     """
     Decompose network into lists of simply connected nodes
@@ -200,6 +539,8 @@ def dfs_decomposition_depth_tuple(N, path_func, source_nodes=None):
         [List(tuple)]: List of tuples of (depth, path) to be processed 
         in order.
     """
+    if isinstance(N, NetworkGraph):
+        N = N.to_dict()
     if source_nodes is None:
         source_nodes = headwaters(N)
 
@@ -272,6 +613,8 @@ def dfs_decomposition(N, path_func, source_nodes=None):
     Returns:
         [List]: List of paths to be processed in order.
     """
+    if isinstance(N, NetworkGraph):
+        N = N.to_dict()
     if source_nodes is None:
         source_nodes = headwaters(N)
 
@@ -305,6 +648,179 @@ def dfs_decomposition(N, path_func, source_nodes=None):
     return paths
 
 
+class ReachLevels:
+    """
+    Reaches grouped by level, flattened for the multithreaded engine.
+
+    The level of a reach is the length, in reaches, of its longest upstream
+    path to a headwater, so each level only depends on lower levels and its
+    reaches can be routed concurrently. Level k holds the reaches
+    reach_ids[offsets[k]:offsets[k + 1]], where reach_ids are positions in
+    the reach list the levels were built from.
+    """
+
+    def __init__(self, offsets, reach_ids, reach_sizes, critical_path):
+        self.offsets = offsets
+        self.reach_ids = reach_ids
+        self.reach_sizes = reach_sizes
+        self.critical_path = critical_path
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def widths(self):
+        """Number of reaches in each level"""
+        return np.diff(self.offsets)
+
+    @property
+    def group_sizes(self):
+        """Number of segments in each level"""
+        sizes = np.zeros(len(self.reach_ids) + 1, dtype="int64")
+        np.cumsum(self.reach_sizes[self.reach_ids], out=sizes[1:])
+        return np.diff(sizes[self.offsets])
+
+    def order(self, reaches):
+        """The reaches rearranged so that each level is contiguous"""
+        return [reaches[i] for i in self.reach_ids.tolist()]
+
+    def engine_args(self, reaches):
+        """
+        (reaches, reach_groups, reach_group_cache_sizes) in the form taken by
+        compute_network_multithread.
+        """
+        return (
+            self.order(reaches),
+            self.widths.astype("int32"),
+            self.group_sizes.astype("int32"),
+        )
+
+    def statistics(self):
+        """
+        Summary of the available parallelism: the number of levels, the
+        widest level, the critical path (the largest number of segments on
+        any chain of dependent reaches) and the number of segments per
+        critical path segment, which bounds the achievable speedup.
+        """
+        widths = self.widths
+        total = int(self.reach_sizes.sum())
+        return {
+            "reaches": len(self.reach_ids),
+            "segments": total,
+            "levels": len(self),
+            "max_width": int(widths.max(initial=0)),
+            "mean_width": float(widths.mean()) if len(widths) else 0.0,
+            "critical_path": self.critical_path,
+            "parallelism": total / self.critical_path if self.critical_path else 0.0,
+        }
+
+
+def reach_levels(reaches, N):
+    """
+    Group reaches by their longest path from a headwater.
+
+    Arguments:
+        reaches (list): reaches as lists of segments ordered from upstream to
+            downstream (e.g. the output of dfs_decomposition)
+        N (Dict[obj: List[obj]]): the reversed (upstream) network
+    Returns:
+        ReachLevels: the reach positions in each level and the critical path.
+        Upstream segments that do not end a reach in reaches are ignored.
+    """
+    if isinstance(N, NetworkGraph):
+        N = N.to_dict()
+    nreaches = len(reaches)
+    reach_sizes = np.fromiter(map(len, reaches), dtype="int64", count=nreaches)
+    tail_reach = {r[-1]: i for i, r in enumerate(reaches)}
+    src = []
+    dst = []
+    for i, r in enumerate(reaches):
+        for u in N.get(r[0], ()):
+            j = tail_reach.get(u)
+            if j is not None:
+                src.append(j)
+                dst.append(i)
+    G = NetworkGraph.from_edges(
+        np.array(src, dtype="int64"),
+        np.array(dst, dtype="int64"),
+        np.arange(nreaches, dtype="int64"),
+    )
+    levels = G.toposort_levels()
+
+    # Longest chain of segments ending at each reach, one level at a time
+    path = reach_sizes.copy()
+    R = G.reverse()
+    upstream_counts = np.diff(R.indptr)
+    for level in levels[1:]:
+        upstream_longest = np.zeros(len(level), dtype="int64")
+        counts = upstream_counts[level]
+        upstream = path[_gather(R.indptr, R.indices, level)]
+        np.maximum.at(
+            upstream_longest, np.repeat(np.arange(len(level)), counts), upstream
+        )
+        path[level] += upstream_longest
+
+    offsets = np.zeros(len(levels) + 1, dtype="int64")
+    np.cumsum([len(l) for l in levels], out=offsets[1:])
+    reach_ids = np.concatenate(levels) if levels else np.zeros(0, dtype="int64")
+    return ReachLevels(offsets, reach_ids, reach_sizes, int(path.max(initial=0)))
+
+
+def split_network(N, max_size):
+    """
+    Cut a network into subnetworks of bounded size.
+
+    Junctions whose upstream network is larger than max_size are cut from
+    their largest upstream branches until the remainder fits. Each cut
+    branch becomes a subnetwork that must be routed before the subnetwork
+    downstream of it. The junction keeps the tailwater of the cut branch as
+    an upstream node outside its subnetwork, where the downstream subnetwork
+    receives the branch outflow. A subnetwork can still exceed max_size if
+    it contains a long stretch without junctions.
+
+    Arguments:
+        N (dict): An independent network, keyed by node with the upstream
+            nodes as values (see reachable_network)
+        max_size (int): Target number of nodes of a subnetwork
+
+    Returns:
+        (dict, dict) subnetworks keyed by their tailwater, ordered so that
+        upstream subnetworks come first, and the downstream subnetwork of
+        each cut subnetwork.
+    """
+    size = {}
+    cut = set()
+    for n in reversed(list(kahn_toposort(N))):
+        upstream = N.get(n, ())
+        size[n] = 1 + sum(size[u] for u in upstream)
+        if len(upstream) > 1 and size[n] > max_size:
+            for u in sorted(upstream, key=size.get, reverse=True):
+                if size[n] <= max_size:
+                    break
+                cut.add(u)
+                size[n] -= size[u]
+
+    deps = {}
+    subnetworks = {}
+    Q = deque(headwaters(N))
+    while Q:
+        tw = Q.popleft()
+        subnetworks[tw] = net = {}
+        stack = [tw]
+        while stack:
+            n = stack.pop()
+            net[n] = upstream = N.get(n, [])
+            for u in upstream:
+                if u in cut:
+                    deps[u] = tw
+                    Q.append(u)
+                else:
+                    stack.append(u)
+
+    subnetworks = dict(reversed(list(subnetworks.items())))
+    return subnetworks, deps
+
+
 def segment_deps(segments, connections):
     """Build a dependency graph of segments
 
@@ -328,6 +844,9 @@ def segment_deps(segments, connections):
 
 
 def kahn_toposort(N):
+    if isinstance(N, NetworkGraph):
+        yield from N.kahn_toposort().tolist()
+        return
     degrees = in_degrees(N)
     zero_degree = set(k for k, v in degrees.items() if v == 0)
 
@@ -372,9 +891,66 @@ def reservoir_boundary(connections, waterbodies, n):
     return False
 
 
-def separate_waterbodies(connections, waterbodies):
+class WaterbodyIndex:
+    """
+    Waterbody segments grouped by waterbody.
+
+    lakes holds the sorted waterbody ids and the members of lakes[i] are
+    segments[offsets[i]:offsets[i + 1]], sorted.
+    """
+
+    def __init__(self, lakes, offsets, segments):
+        self.lakes = lakes
+        self.offsets = offsets
+        self.segments = segments
+        order = np.argsort(segments, kind="stable")
+        self._sorted_segments = segments[order]
+        lake_of = np.repeat(np.arange(len(lakes)), np.diff(offsets))
+        self._sorted_lakes = lake_of[order]
+
+    @classmethod
+    def from_dict(cls, waterbodies):
+        """Build the index from a {segment: waterbody} mapping"""
+        n = len(waterbodies)
+        segments = np.fromiter(waterbodies.keys(), dtype="int64", count=n)
+        codes = np.fromiter(waterbodies.values(), dtype="int64", count=n)
+        order = np.lexsort((segments, codes))
+        lakes, counts = np.unique(codes[order], return_counts=True)
+        offsets = np.zeros(len(lakes) + 1, dtype="int64")
+        np.cumsum(counts, out=offsets[1:])
+        return cls(lakes, offsets, segments[order])
+
+    def __len__(self):
+        return len(self.lakes)
+
+    def members(self, lake):
+        i = np.searchsorted(self.lakes, lake)
+        return self.segments[self.offsets[i] : self.offsets[i + 1]]
+
+    def lake_positions(self, segments):
+        """Position in lakes of the waterbody of each segment, -1 if none"""
+        segments = np.asarray(segments, dtype="int64")
+        if not len(self._sorted_segments):
+            return np.full(len(segments), -1, dtype="int64")
+        i = np.searchsorted(self._sorted_segments, segments)
+        i[i == len(self._sorted_segments)] = 0
+        return np.where(self._sorted_segments[i] == segments, self._sorted_lakes[i], -1)
+
+    def to_dict(self):
+        """{waterbody: [segments]}, as reverse_surjective_mapping(waterbodies)"""
+        segments = self.segments.tolist()
+        offsets = self.offsets.tolist()
+        return {
+            wb: segments[a:b]
+            for wb, a, b in zip(self.lakes.tolist(), offsets[:-1], offsets[1:])
+        }
+
+
+def separate_waterbodies(connections, waterbodies, index=None):
+    if index is None:
+        index = WaterbodyIndex.from_dict(waterbodies)
     waterbody_nodes = {}
-    for wb, nodes in reverse_surjective_mapping(waterbodies).items():
+    for wb, nodes in index.to_dict().items():
         waterbody_nodes[wb] = net = {}
         for n in nodes:
             if n in connections:
@@ -382,38 +958,157 @@ def separate_waterbodies(connections, waterbodies):
     return waterbody_nodes
 
 
+def collapse_waterbodies(connections, waterbodies, index=None):
+    """
+    Use a single node to represent each waterbody. The node id is the
+    waterbody id.
+
+    Segments are grouped by waterbody once and every edge is classified with
+    array operations: edges inside a waterbody are dropped, edges leaving a
+    waterbody (its shore) become edges of the waterbody node, and edges into
+    a waterbody point to the waterbody node.
+
+    Arguments:
+        connections (Dict[obj: List[obj]]): The network, downstream
+        waterbodies (Dict[obj: obj]): waterbody id of each waterbody segment
+        index (WaterbodyIndex): prebuilt grouping of waterbodies (optional)
+
+    Returns:
+        (dict, WaterbodyIndex): a new copy of connections with the
+        transformation, and the segment to waterbody index. The outflows of
+        a waterbody node are sorted and unique.
+    """
+    if index is None:
+        index = WaterbodyIndex.from_dict(waterbodies)
+    G = (
+        connections
+        if isinstance(connections, NetworkGraph)
+        else NetworkGraph.from_dict(connections)
+    )
+    if isinstance(connections, NetworkGraph):
+        connections = connections.to_dict()
+    if not len(index):
+        return dict(connections), index
+
+    node_lake = index.lake_positions(G.nodes)
+    src = np.repeat(np.arange(len(G.nodes)), np.diff(G.indptr))
+    src_lake = node_lake[src]
+    dst_lake = node_lake[G.indices]
+    collapsed = np.where(dst_lake >= 0, index.lakes[dst_lake], G.nodes[G.indices])
+
+    # copy to new network unchanged
+    new_conn = {n: v for n, v in connections.items() if n not in waterbodies}
+
+    # one of the children of these nodes is a member of a waterbody:
+    # replace that child with the waterbody id.
+    boundary = np.unique(src[(src_lake < 0) & (dst_lake >= 0)]).tolist()
+    indptr = G.indptr.tolist()
+    for i, n in zip(boundary, G.nodes[boundary].tolist()):
+        new_conn[n] = collapsed[indptr[i] : indptr[i + 1]].tolist()
+
+    # waterbody shores: unique (lake, outflow) pairs grouped by lake
+    keys = np.fromiter(connections.keys(), dtype="int64", count=len(connections))
+    present = np.unique(index.lake_positions(keys))
+    present = present[present >= 0]
+    shore = (src_lake >= 0) & (dst_lake != src_lake)
+    pairs = np.unique(np.stack((src_lake[shore], collapsed[shore])), axis=1)
+    bounds = np.searchsorted(pairs[0], np.append(present, len(index))).tolist()
+    outflows = pairs[1].tolist()
+    for wb, a, b in zip(index.lakes[present].tolist(), bounds[:-1], bounds[1:]):
+        new_conn[wb] = outflows[a:b]
+    return new_conn, index
+
+
 def replace_waterbodies_connections(connections, waterbodies):
     """
     Use a single node to represent waterbodies. The node id is the
     waterbody id.
 
     This returns a new copy of connections with transformation
+    (see collapse_waterbodies)
     """
-    new_conn = {}
-    waterbody_nets = separate_waterbodies(connections, waterbodies)
+    return collapse_waterbodies(connections, waterbodies)[0]
 
-    for n in connections:
-        if n in waterbodies:
-            wbody_code = waterbodies[n]
-            if wbody_code in new_conn:
-                continue
 
-            # get all nodes from waterbody
-            wbody_nodes = [k for k, v in waterbodies.items() if v == wbody_code]
-            outgoing = reservoir_shore(connections, wbody_nodes)
-            new_conn[wbody_code] = outgoing
+# Cost of routing a level pool waterbody for a timestep relative to a channel
+# segment: on Pocono_TEST1, 52 junction segments routed as level pools took
+# 0.14 times as long per timestep as with Muskingum-Cunge.
+LEVELPOOL_WEIGHT = 0.15
 
-        elif reservoir_boundary(connections, waterbodies, n):
-            # one of the children of n is a member of a waterbody
-            # replace that child with waterbody code.
-            new_conn[n] = []
 
-            for child in connections[n]:
-                if child in waterbodies:
-                    new_conn[n].append(waterbodies[child])
-                else:
-                    new_conn[n].append(child)
-        else:
-            # copy to new network unchanged
-            new_conn[n] = connections[n]
-    return new_conn
+def network_costs(
+    reaches_bytw, nsteps=1, waterbodies=None, waterbody_weight=LEVELPOOL_WEIGHT
+):
+    """
+    Estimate the cost of routing each independent network.
+
+    The cost is the number of segments times the number of timesteps, with
+    waterbody segments counted waterbody_weight times.
+
+    Arguments:
+        reaches_bytw (dict): Reaches of each network, keyed by tailwater
+        nsteps (int): Number of timesteps
+        waterbodies (dict or set): Waterbody segments (segment -> waterbody
+            id), or the waterbody nodes of a collapsed network
+        waterbody_weight (float): Relative cost of a waterbody segment (see
+            LEVELPOOL_WEIGHT)
+
+    Returns:
+        (dict) tailwater -> estimated cost
+    """
+    costs = {}
+    for tw, reaches in reaches_bytw.items():
+        cost = sum(len(r) for r in reaches)
+        if waterbodies:
+            nwbody = sum(1 for r in reaches for n in r if n in waterbodies)
+            cost += (waterbody_weight - 1.0) * nwbody
+        costs[tw] = cost * nsteps
+    return costs
+
+
+def balance_networks(costs, nworkers, min_batch_cost=None):
+    """
+    Group networks into jobs for nworkers workers.
+
+    Networks cheaper than min_batch_cost are bin-packed into batches of
+    about min_batch_cost, so that tiny networks do not each pay the
+    per-job overhead. Batches are returned largest first (LPT order): a pool
+    that hands the next batch to the first idle worker then starts the
+    biggest basins first instead of finishing on one of them.
+
+    Arguments:
+        costs (dict): tailwater -> estimated cost, see network_costs
+        nworkers (int): Number of workers
+        min_batch_cost (float): Target cost of a batch of small networks.
+            Defaults to 1/16 of the average load of a worker.
+
+    Returns:
+        (list, list) batches of tailwaters, estimated load of each worker
+        under greedy LPT scheduling of the batches
+    """
+    nworkers = max(nworkers, 1)
+    if min_batch_cost is None:
+        min_batch_cost = sum(costs.values()) / (16 * nworkers)
+
+    batches = []
+    batch, batch_cost = [], 0
+    for tw in sorted(costs, key=costs.get, reverse=True):
+        if costs[tw] >= min_batch_cost:
+            batches.append(([tw], costs[tw]))
+            continue
+        batch.append(tw)
+        batch_cost += costs[tw]
+        if batch_cost >= min_batch_cost:
+            batches.append((batch, batch_cost))
+            batch, batch_cost = [], 0
+    if batch:
+        batches.append((batch, batch_cost))
+    batches.sort(key=lambda b: b[1], reverse=True)
+
+    loads = [(0, w) for w in range(nworkers)]
+    for _, cost in batches:
+        load, w = heapq.heappop(loads)
+        heapq.heappush(loads, (load + cost, w))
+    estimated = [load for load, _ in sorted(loads, key=lambda x: x[1])]
+
+    return [b for b, _ in batches], estimated
@@ -61,7 +61,7 @@ def set_supernetwork_data(
             "layer_string": 0,
             "waterbody_parameter_file_type": "Level_Pool",
             "waterbody_parameter_file_path": os.path.join(
-                geo_input_folder, "NWM_2.1_Sample_Datasets", "LAKEPARM_CONUS.nc"
+                geo_input_folder, "NWM_2.1_Sample_Datasets", "LAKEPARM_POCONO.nc"
             ),
             "waterbody_parameter_columns": {
                 "waterbody_area": "LkArea",  # area of reservoir
@@ -325,8 +325,8 @@ def set_supernetwork_data(
                 "outfall_weir_length": "WeirL",
                 "overall_dam_length": "DamL",
                 "orifice_elevation": "OrificeE",
-                "oriface_coefficient": "OrificeC",
-                "oriface_are": "OrifaceA",
+                "orifice_coefficient": "OrificeC",
+                "orifice_area": "OrificeA",
             },
             "waterbody_null_code": -9999,
             "title_string": "CONUS Full Resolution NWM v2.0",
@@ -14,6 +14,7 @@ A demonstration version of this code is stored in this Colaboratory notebook:
 import os
 import sys
 import time
+import threading
 import numpy as np
 import argparse
 import pathlib
@@ -21,6 +22,13 @@ import glob
 import pandas as pd
 from functools import partial
 from joblib import delayed, Parallel
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+    FIRST_COMPLETED,
+)
+from multiprocessing import shared_memory
 from itertools import chain, islice
 from operator import itemgetter
 
@@ -59,6 +67,19 @@ def _handle_args():
         dest="assume_short_ts",
         action="store_true",
     )
+    parser.add_argument(
+        "--warm-start",
+        help="Seed the Muskingum-Cunge depth solver from the depth trend of the previous timesteps (off by default). The solver stops at a 1%% relative change in depth, so results change within that tolerance: on Pocono_TEST1 total flow shifted by 1.7%% (48 timesteps) to 5.6%% (288 timesteps) for 3-7%% fewer secant iterations",
+        dest="warm_start",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--timestep-block",
+        help="Route each reach over this many timesteps before moving downstream (results are identical for any block size)",
+        dest="timestep_block",
+        default=1,
+        type=int,
+    )
     parser.add_argument(
         "-ocsv",
         "--write-output-csv",
@@ -67,6 +88,47 @@ def _handle_args():
         dest="csv_output_folder",
         const="../../test/output/text",
     )
+    parser.add_argument(
+        "--csv-output-segments",
+        nargs="+",
+        help="Only record and write output for these segments (e.g. gages or forecast points)",
+        dest="csv_output_segments",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--restart-file",
+        help="Initialize the channel and waterbody states from this t-route restart file (see --write-restart)",
+        dest="restart_file",
+    )
+    parser.add_argument(
+        "--write-restart",
+        help="Write the channel and waterbody states to this t-route restart file; {timestep} in the name is replaced by the timestep",
+        dest="restart_output_file",
+    )
+    parser.add_argument(
+        "--restart-timesteps",
+        nargs="+",
+        help="Timesteps to write restart files at (default: the last timestep)",
+        dest="restart_timesteps",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--topology-cache",
+        help="Directory to cache the decomposed network topology in; later runs on the same (unchanged) geo and mask files load it instead of recomputing it",
+        dest="topology_cache_dir",
+    )
+    parser.add_argument(
+        "--input-cache",
+        help="Directory to cache the decoded parameter and qlateral inputs in as memory-mappable arrays; later runs on the same (unchanged) source files load them instead of decoding the files",
+        dest="input_cache_dir",
+    )
+    parser.add_argument(
+        "--write-output-file",
+        help="Stream flow, velocity and depth into this file as they are computed instead of keeping them in memory (.npy for a memory-mapped array, .nc for NetCDF)",
+        dest="output_file",
+    )
     parser.add_argument(
         "-t",
         "--showtiming",
@@ -77,17 +139,31 @@ def _handle_args():
     parser.add_argument(
         "-w",
         "--break-at-waterbodies",
-        help="Use the waterbodies in the route-link dataset to divide the computation (leave blank for no splitting)",
+        help="Use the waterbodies in the route-link dataset to divide the computation and route each waterbody as a level pool reservoir (leave blank for no splitting)",
         dest="break_network_at_waterbodies",
         action="store_true",
     )
     parser.add_argument(
         "--parallel",
         nargs="?",
-        help="Use the parallel computation engine (omit flag for serial computation)",
+        help="Use the parallel computation engine (omit flag for serial computation). Options are by-network (default), by-network-process (by-network on a process pool with shared-memory inputs) and by-level (route the whole supernetwork at once, computing reaches of the same level concurrently)",
         dest="parallel_compute_method",
         const="by-network",
     )
+    parser.add_argument(
+        "--split-networks",
+        help="Cut independent networks larger than this number of segments into subnetworks at junctions, so that parts of a large basin can be routed concurrently (serial and by-network only)",
+        dest="max_network_size",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--waterbody-weight",
+        help="Cost of routing a waterbody for a timestep relative to a channel segment, used to balance networks across workers (default: %(default)s, measured for level pools)",
+        dest="waterbody_weight",
+        type=float,
+        default=nhd_network.LEVELPOOL_WEIGHT,
+    )
     parser.add_argument(
         "--cpu-pool",
         help="Assign the number of cores to multiprocess across.",
@@ -164,6 +240,12 @@ def _handle_args():
         dest="qlat_file_pattern_filter",
         default="q_lateral",
     )
+    parser.add_argument(
+        "--qlat-stream",
+        help="Read the --qlw or --qlf qlaterals as the routing advances instead of loading all timesteps first (requires --parallel by-level)",
+        dest="qlat_stream",
+        action="store_true",
+    )
     parser.add_argument("--ql", help="QLat input data", dest="ql", default=None)
     # TODO: uncomment custominput file
     # supernetwork_arg_group = parser.add_mutually_exclusive_group()
@@ -204,6 +286,384 @@ def constant_qlats(index_dataset, nsteps, qlat):
     return ql
 
 
+def read_cached_frame(cache_dir, name, source_files, read, **options):
+    """
+    Call read() for a frame of inputs, or load it from the frame cache in
+    cache_dir (see troute.nhd_io.frame_cache_path) if cache_dir is given.
+    """
+    if not cache_dir:
+        return read()
+    path, fingerprint = nhd_io.frame_cache_path(
+        cache_dir, name, source_files, **options
+    )
+    df = nhd_io.read_frame_cache(path, fingerprint)
+    if df is None:
+        df = read()
+        nhd_io.write_frame_cache(path, fingerprint, df)
+    return df
+
+
+def read_param_df(network_data):
+    """Read the masked segment parameters of a supernetwork, sorted by segment"""
+    cols = network_data["columns"]
+    mask_ids = None
+    if "mask_file_path" in network_data:
+        data_mask = nhd_io.read_mask(
+            network_data["mask_file_path"],
+            layer_string=network_data["mask_layer_string"],
+        )
+        mask_ids = data_mask.iloc[:, network_data["mask_key"]]
+
+    param_df = nhd_io.read_routelink(network_data["geo_file_path"], cols, mask_ids)
+    return nhd_io.replace_downstreams(param_df, cols["downstream"], 0, inplace=True)
+
+
+def network_contiguous_rows(index, reaches_bytw):
+    """
+    Order rows so that the segments of each independent network are a
+    contiguous, sorted block.
+
+    index: sorted segment ids of the parameter table
+    reaches_bytw: {tailwater: list of reaches}
+
+    Returns the rows of index in network-contiguous order and a
+    {tailwater: slice} mapping of each network into the reordered rows.
+    """
+    segments = [
+        np.sort(np.fromiter(chain.from_iterable(reach_list), dtype=index.dtype))
+        for reach_list in reaches_bytw.values()
+    ]
+    offsets = np.cumsum([0] + [len(seg) for seg in segments])
+    rows = np.searchsorted(index, np.concatenate(segments))
+    network_slices = {
+        tw: slice(offsets[i], offsets[i + 1]) for i, tw in enumerate(reaches_bytw)
+    }
+    return rows, network_slices
+
+
+def to_shared_memory(arr):
+    """
+    Copy arr into a new shared memory block.
+    Returns the block and a picklable (name, shape, dtype) descriptor of it.
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+
+def from_shared_memory(descriptor):
+    """Attach to a shared memory block created by to_shared_memory"""
+    name, shape, dtype = descriptor
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+# Per-process state of the by-network-process workers, set by _init_network_worker
+_network_worker = {}
+
+
+def _init_network_worker(shared, data_cols, topologies, network_slices, kwargs):
+    _network_worker["shared"] = {k: from_shared_memory(d) for k, d in shared.items()}
+    _network_worker["data_cols"] = data_cols
+    _network_worker["topologies"] = topologies
+    _network_worker["network_slices"] = network_slices
+    _network_worker["kwargs"] = kwargs
+
+
+def _compute_network_worker(batch):
+    """
+    Route the networks of batch from shared inputs and write their results to
+    the shared output. Returns the output rows, the elapsed time and the worker id.
+    """
+    start = time.time()
+    arrays = {k: a for k, (_, a) in _network_worker["shared"].items()}
+    batch_rows = []
+    for tw in batch:
+        s = _network_worker["network_slices"][tw]
+        data_idx = arrays["data_idx"][s]
+        out_idx, flowveldepth = mc_reach.compute_network(
+            reaches=None,
+            connections=None,
+            data_idx=data_idx,
+            data_cols=_network_worker["data_cols"],
+            data_values=arrays["data_values"][s],
+            qlat_values=arrays["qlat_values"][s],
+            initial_conditions=arrays["q0_values"][s],
+            topology=_network_worker["topologies"][tw],
+            **_network_worker["kwargs"],
+        )
+        out_rows = s.start + np.searchsorted(data_idx, out_idx)
+        arrays["flowveldepth"][arrays["output_rows"][out_rows]] = flowveldepth
+        batch_rows.append(out_rows)
+    return batch_rows, time.time() - start, os.getpid()
+
+
+def compute_network_batch(
+    compute_func,
+    batch,
+    topologies,
+    network_slices,
+    data_idx,
+    data_cols,
+    data_values,
+    qlat_values,
+    q0_values,
+    **kwargs,
+):
+    """
+    Route the networks of batch with compute_func on slices of the inputs.
+    Returns the list of results, the elapsed time and the worker (thread) id.
+    """
+    start = time.time()
+    results = []
+    for tw in batch:
+        s = network_slices[tw]
+        results.append(
+            compute_func(
+                reaches=None,
+                connections=None,
+                data_idx=data_idx[s],
+                data_cols=data_cols,
+                data_values=data_values[s],
+                qlat_values=qlat_values[s],
+                initial_conditions=q0_values[s],
+                topology=topologies[tw],
+                **kwargs,
+            )
+        )
+    return results, time.time() - start, threading.get_ident()
+
+
+def compute_networks_with_boundaries(
+    compute_func,
+    nworkers,
+    deps,
+    topologies,
+    network_slices,
+    data_idx,
+    data_cols,
+    data_values,
+    qlat_values,
+    q0_values,
+    nsteps,
+    output_sink=None,
+    output_idx=None,
+    **kwargs,
+):
+    """
+    Route networks that receive inflow from other networks (see nhd_network.split_network).
+
+    A network is started as soon as every network upstream of it is done, so
+    independent subnetworks are routed concurrently. The outflow of a cut
+    subnetwork for all timesteps is passed to its downstream subnetwork as
+    boundary flow. kwargs are passed to compute_func.
+
+    Returns a list of (segment ids, flowveldepth) for each network.
+    """
+    waiting = {}
+    for d in deps.values():
+        waiting[d] = waiting.get(d, 0) + 1
+    inflows = {}
+
+    def route(tw):
+        s = network_slices[tw]
+        topology = topologies[tw]
+        boundary_flows = None
+        if topology.boundary_idx is not None:
+            inflow = inflows.pop(tw)
+            boundary_flows = np.stack([inflow[b] for b in topology.boundary_idx])
+
+        # Cut subnetworks record every segment to find their outflow
+        feeds = tw in deps
+        out_idx, flowveldepth = compute_func(
+            nsteps=nsteps,
+            reaches=None,
+            connections=None,
+            data_idx=data_idx[s],
+            data_cols=data_cols,
+            data_values=data_values[s],
+            qlat_values=qlat_values[s],
+            initial_conditions=q0_values[s],
+            output_sink=None if feeds else output_sink,
+            output_idx=None if feeds else output_idx,
+            boundary_flows=boundary_flows,
+            topology=topology,
+            **kwargs,
+        )
+        if not feeds:
+            return tw, None, (out_idx, flowveldepth)
+
+        row = np.searchsorted(out_idx, tw)
+        outflow = np.concatenate(
+            ([q0_values[s][row, 1]], flowveldepth[row, ::3])
+        ).astype("float32")
+        if output_sink is not None:
+            output_sink.write(out_idx, 0, flowveldepth)
+            flowveldepth = None
+        elif output_idx is not None:
+            selected = np.isin(out_idx, output_idx)
+            out_idx, flowveldepth = out_idx[selected], flowveldepth[selected]
+        return tw, outflow, (out_idx, flowveldepth)
+
+    results = []
+    with ThreadPoolExecutor(max_workers=nworkers) as executor:
+        pending = {
+            executor.submit(route, tw) for tw in topologies if tw not in waiting
+        }
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                tw, outflow, result = future.result()
+                results.append(result)
+                if outflow is None:
+                    continue
+                d = deps[tw]
+                inflows.setdefault(d, {})[tw] = outflow
+                waiting[d] -= 1
+                if not waiting[d]:
+                    pending.add(executor.submit(route, d))
+    return results
+
+
+def level_pool_parameters(waterbodies_df, parameter_columns):
+    """
+    Level pool parameters of waterbodies_df as the wbody_idx, wbody_cols and
+    wbody_vals arguments of mc_reach.compute_network. parameter_columns maps
+    the supernetwork waterbody parameter names to columns of waterbodies_df;
+    the dam length is read from the "overall_dam_length" column (DamL) when
+    waterbodies_df has it.
+    """
+    kernel_names = {
+        "waterbody_area": "ar",
+        "weir_elevation": "we",
+        "waterbody_max_elevation": "maxh",
+        "outfall_weir_coefficient": "wc",
+        "outfall_weir_length": "wl",
+        "overall_dam_length": "dl",
+        "orifice_elevation": "oe",
+        "orifice_coefficient": "oc",
+        "orifice_area": "oa",
+    }
+    values = pd.DataFrame(index=waterbodies_df.index)
+    for name, col in parameter_columns.items():
+        if name in kernel_names and col in waterbodies_df:
+            values[kernel_names[name]] = waterbodies_df[col]
+    if "dl" not in values:
+        # LAKEPARM files without a dam length (DamL) column: assume a dam ten
+        # times as long as the outfall weir
+        values["dl"] = 10 * values["wl"]
+    return dict(
+        wbody_idx=values.index.values.astype("int64"),
+        wbody_cols=np.array(values.columns, dtype=object),
+        wbody_vals=values.values.astype("float32"),
+    )
+
+
+def print_worker_times(costs, batches, timings):
+    """
+    Compare the estimated cost of each batch with its measured time, and the
+    estimated load of each worker, the batches it actually ran, with its
+    measured time. Estimates are scaled to seconds by the total measured time.
+
+    Arguments:
+        costs (dict): tailwater -> estimated cost, see nhd_network.network_costs
+        batches (list): Batches of tailwaters, see nhd_network.balance_networks
+        timings (list): (elapsed, worker id) of each batch, in the order of batches
+    """
+    estimated = [sum(costs[tw] for tw in batch) for batch in batches]
+    scale = sum(elapsed for elapsed, _ in timings) / (sum(estimated) or 1)
+    workers = {}
+    print("batch  networks  worker  estimated (s)  actual (s)")
+    for i, (batch, cost, (elapsed, worker)) in enumerate(
+        zip(batches, estimated, timings)
+    ):
+        w = workers.setdefault(worker, len(workers))
+        print(f"{i:5d}  {len(batch):8d}  {w:6d}  {cost * scale:13.3f}  {elapsed:10.3f}")
+
+    loads = {}
+    for cost, (elapsed, worker) in zip(estimated, timings):
+        load = loads.setdefault(workers[worker], [0.0, 0.0])
+        load[0] += cost * scale
+        load[1] += elapsed
+    print("worker  estimated (s)  actual (s)")
+    for w, (e, a) in sorted(loads.items()):
+        print(f"{w:6d}  {e:13.3f}  {a:10.3f}")
+
+
+def compute_by_network_processes(
+    cpu_pool,
+    batches,
+    topologies,
+    network_slices,
+    data_idx,
+    data_cols,
+    data_values,
+    qlat_values,
+    q0_values,
+    output_sink=None,
+    **kwargs,
+):
+    """
+    Route independent networks on a process pool.
+
+    The input arrays are copied once into shared memory; jobs only send the
+    tailwater ids of a batch and workers write their results into a shared
+    flowveldepth array that holds the segments of kwargs["output_idx"] (all
+    segments if it is None). kwargs are passed to mc_reach.compute_network.
+
+    Returns a list of (segment ids, flowveldepth) for each network and the
+    (elapsed, worker id) of each batch. With an output_sink, the results of
+    each batch are written to it as the batch completes and are not returned.
+    """
+    nsteps = kwargs["nsteps"]
+    output_idx = kwargs.get("output_idx")
+    recorded = (
+        np.ones(len(data_idx), dtype=bool)
+        if output_idx is None
+        else np.isin(data_idx, output_idx)
+    )
+    # row of each recorded segment in the shared flowveldepth, -1 if not recorded
+    output_rows = np.full(len(data_idx), -1, dtype="int64")
+    output_rows[recorded] = np.arange(recorded.sum())
+    inputs = {
+        "data_idx": data_idx,
+        "data_values": data_values,
+        "qlat_values": qlat_values,
+        "q0_values": q0_values,
+        "output_rows": output_rows,
+        "flowveldepth": np.zeros((recorded.sum(), nsteps * 3), dtype="float32"),
+    }
+    blocks = {}
+    try:
+        shared = {}
+        for k, arr in inputs.items():
+            blocks[k], shared[k] = to_shared_memory(arr)
+        _, flowveldepth = from_shared_memory(shared["flowveldepth"])
+
+        with ProcessPoolExecutor(
+            max_workers=cpu_pool,
+            initializer=_init_network_worker,
+            initargs=(shared, data_cols, topologies, network_slices, kwargs),
+        ) as executor:
+            results, timings = [], []
+            for batch_rows, elapsed, worker in executor.map(
+                _compute_network_worker, batches
+            ):
+                for out_rows in batch_rows:
+                    out_idx = data_idx[out_rows]
+                    out = flowveldepth[output_rows[out_rows]]
+                    if output_sink is None:
+                        results.append((out_idx, out))
+                    else:
+                        output_sink.write(out_idx, 0, out)
+                timings.append((elapsed, worker))
+    finally:
+        for shm in blocks.values():
+            shm.close()
+            shm.unlink()
+    return results, timings
+
+
 def main():
 
     args = _handle_args()
@@ -215,7 +675,18 @@ def main():
     supernetwork = args.supernetwork
     break_network_at_waterbodies = args.break_network_at_waterbodies
     csv_output_folder = args.csv_output_folder
+    output_file = args.output_file
+    topology_cache_dir = args.topology_cache_dir
+    input_cache_dir = args.input_cache_dir
+    restart_file = args.restart_file
+    restart_output_file = args.restart_output_file
+    csv_output_segments = args.csv_output_segments
+    if csv_output_segments is not None:
+        csv_output_segments = np.array(csv_output_segments, dtype="int64")
     assume_short_ts = args.assume_short_ts
+    warm_start = args.warm_start
+    max_network_size = args.max_network_size
+    timestep_block = args.timestep_block
     # TODO: uncomment custominput file
     # custom_input_file = args.custom_input_file
     test_folder = pathlib.Path(root, "test")
@@ -249,6 +720,7 @@ def main():
     qlat_file_pattern_filter = args.qlat_file_pattern_filter
     qlat_file_index_col = args.qlat_file_index_col
     qlat_file_value_col = args.qlat_file_value_col
+    qlat_stream = args.qlat_stream and bool(qlat_input_folder or qlat_input_file)
     # print(forcing_parameters,qlat_const)
     # TODO: Make these commandline args
     """##NHD Subset (Brazos/Lower Colorado)"""
@@ -277,30 +749,62 @@ def main():
     )
 
     cols = network_data["columns"]
-    param_df = nhd_io.read(network_data["geo_file_path"])
-    param_df = param_df[list(cols.values())]
-    param_df = param_df.set_index(cols["key"])
-
-    if "mask_file_path" in network_data:
-        data_mask = nhd_io.read_mask(
-            network_data["mask_file_path"],
-            layer_string=network_data["mask_layer_string"],
-        )
-        param_df = param_df.filter(data_mask.iloc[:, network_data["mask_key"]], axis=0)
-
-    param_df = param_df.sort_index()
-    param_df = nhd_io.replace_downstreams(param_df, cols["downstream"], 0)
+    # the parameters (and the segments qlat is read for) depend on these
+    geo_sources = [network_data["geo_file_path"], network_data.get("mask_file_path")]
+    geo_options = dict(
+        columns=cols,
+        mask_layer_string=network_data.get("mask_layer_string"),
+        mask_key=network_data.get("mask_key"),
+    )
+    param_df = read_cached_frame(
+        input_cache_dir,
+        "param",
+        geo_sources,
+        partial(read_param_df, network_data),
+        **geo_options,
+    )
 
-    connections = nhd_network.extract_connections(param_df, cols["downstream"])
+    # Connections are built as array adjacency straight from the columns
+    connections = nhd_network.extract_connection_graph(param_df, cols["downstream"])
     wbodies = nhd_network.extract_waterbodies(
         param_df, cols["waterbody"], network_data["waterbody_null_code"]
     )
 
+    # Lateral inflows are read for the channel segments; waterbodies receive
+    # the inflows of all of their segments.
+    qlat_segments = param_df.index
+    waterbody_nodes = wbodies
+    wbody_kwargs = {}
+    if break_network_at_waterbodies and wbodies:
+        # Each waterbody becomes a single node, routed as a level pool reservoir
+        connections, waterbody_index = nhd_network.collapse_waterbodies(
+            connections, wbodies
+        )
+        waterbody_nodes = set(waterbody_index.lakes.tolist())
+        waterbodies_df = nhd_io.read_level_pool_waterbody_df(
+            network_data["waterbody_parameter_file_path"],
+            network_data.get("waterbody_parameter_id_field", "lake_id"),
+            waterbody_index.lakes,
+        )
+        wbody_kwargs = level_pool_parameters(
+            waterbodies_df, network_data["waterbody_parameter_columns"]
+        )
+        lake_rows = pd.DataFrame(
+            0, index=waterbody_index.lakes, columns=param_df.columns
+        ).astype(param_df.dtypes)
+        lake_rows.index.name = param_df.index.name
+        param_df = pd.concat([param_df.drop(index=list(wbodies)), lake_rows])
+        param_df = param_df.sort_index()
+
     # initial conditions, assume to be zero
     # TODO: Allow optional reading of initial conditions from WRF
     q0 = pd.DataFrame(
         0, index=param_df.index, columns=["qu0", "qd0", "h0"], dtype="float32"
     )
+    if restart_file:
+        channel_states, waterbody_states = nhd_io.read_restart(restart_file)
+        q0.update(channel_states)
+        q0.update(waterbody_states)
 
     if verbose:
         print("supernetwork connections set complete")
@@ -313,12 +817,61 @@ def main():
     if verbose:
         print("organizing connections into reaches ...")
 
-    rconn = nhd_network.reverse_network(connections)
-    independent_networks = nhd_network.reachable_network(rconn)
-    reaches_bytw = {}
-    for tw, net in independent_networks.items():
-        path_func = partial(nhd_network.split_at_junction, net)
-        reaches_bytw[tw] = nhd_network.dfs_decomposition(net, path_func)
+    topology_cache = cached = None
+    if topology_cache_dir:
+        topology_cache, fingerprint = nhd_io.topology_cache_path(
+            topology_cache_dir,
+            [network_data["geo_file_path"], network_data.get("mask_file_path")],
+            mask_layer_string=network_data.get("mask_layer_string"),
+            mask_key=network_data.get("mask_key"),
+            break_at_waterbodies=break_network_at_waterbodies,
+            max_network_size=max_network_size,
+        )
+        cached = nhd_io.read_topology_cache(topology_cache, fingerprint)
+
+    if cached is not None:
+        independent_networks, reaches_bytw, network_deps = cached
+        if verbose:
+            print(f"loaded topology from {topology_cache}")
+    else:
+        rconn = nhd_network.reverse_network(connections)
+        independent_networks = nhd_network.reachable_network(rconn)
+
+        # Cut large networks; network_deps maps each cut subnetwork to its downstream subnetwork
+        network_deps = {}
+        if max_network_size:
+            subnetworks = {}
+            for tw, net in independent_networks.items():
+                if len(net) > max_network_size:
+                    subnets, deps = nhd_network.split_network(net, max_network_size)
+                    subnetworks.update(subnets)
+                    network_deps.update(deps)
+                else:
+                    subnetworks[tw] = net
+            if verbose:
+                print(
+                    f"split {len(independent_networks)} networks into {len(subnetworks)} networks"
+                )
+            independent_networks = subnetworks
+
+        reaches_bytw = {}
+        for tw, net in independent_networks.items():
+            if wbody_kwargs:
+                path_func = partial(
+                    nhd_network.split_at_collapsed_waterbodies, waterbody_nodes, net
+                )
+            else:
+                path_func = partial(nhd_network.split_at_junction, net)
+            reaches_bytw[tw] = nhd_network.dfs_decomposition(net, path_func)
+
+        if topology_cache is not None:
+            nhd_io.write_topology_cache(
+                topology_cache,
+                fingerprint,
+                independent_networks,
+                reaches_bytw,
+                network_deps,
+            )
 
     if verbose:
         print("reach organization complete")
@@ -340,15 +893,47 @@ def main():
     if verbose:
         print("creating qlateral array ...")
 
-    if qlat_input_folder:
-        qlat_files = glob.glob(qlat_input_folder + qlat_file_pattern_filter)
-        qlat_df = nhd_io.get_ql_from_wrf_hydro(
-            qlat_files=qlat_files,
+    qlat_provider = None
+    if qlat_stream:
+        # The whole supernetwork is routed in one call, which reads every forcing
+        # timestep once; waterbodies would need the qlat of their segments summed.
+        if args.parallel_compute_method != "by-level":
+            raise ValueError("--qlat-stream requires --parallel by-level")
+        if wbody_kwargs:
+            raise ValueError("--qlat-stream is not supported with waterbodies")
+
+    if qlat_stream and qlat_input_folder:
+        # one file per timestep; timesteps past the last file have no lateral inflow
+        qlat_files = sorted(glob.glob(qlat_input_folder + qlat_file_pattern_filter))
+        qlat_provider = nhd_io.ChrtoutQlatProvider(
+            qlat_files,
+            segments=qlat_segments,
             index_col=qlat_file_index_col,
             value_col=qlat_file_value_col,
+            ncols=nts,
         )
 
-        qlat_df = qlat_df[qlat_df.index.isin(connections.keys())]
+    elif qlat_stream:
+        qlat_provider = nhd_io.CsvQlatProvider(qlat_input_file)
+
+    elif qlat_input_folder:
+        qlat_files = sorted(glob.glob(qlat_input_folder + qlat_file_pattern_filter))
+        qlat_df = read_cached_frame(
+            input_cache_dir,
+            "qlat",
+            geo_sources + qlat_files,
+            partial(
+                nhd_io.get_ql_from_chrtout,
+                qlat_files=qlat_files,
+                segments=qlat_segments,
+                index_col=qlat_file_index_col,
+                value_col=qlat_file_value_col,
+                max_workers=args.cpu_pool,
+            ),
+            index_col=qlat_file_index_col,
+            value_col=qlat_file_value_col,
+            **geo_options,
+        )
         df_length = len(qlat_df.columns)
 
         for x in range(df_length, 144):
@@ -356,14 +941,22 @@ def main():
             qlat_df = qlat_df.astype("float32")
 
     elif qlat_input_file:
-        qlat_df = nhd_io.get_ql_from_csv(qlat_input_file)
+        qlat_df = read_cached_frame(
+            input_cache_dir,
+            "qlat",
+            [qlat_input_file],
+            partial(nhd_io.get_ql_from_csv, qlat_input_file),
+        )
 
     else:
         qlat_df = pd.DataFrame(
-            qlat_const, index=connections.keys(), columns=range(nts), dtype="float32",
+            qlat_const, index=qlat_segments, columns=range(nts), dtype="float32",
         )
 
-    qlats = qlat_df
+    qlats = qlat_df if qlat_provider is None else None
+    if wbody_kwargs:
+        lake_of = pd.Series(wbodies).reindex(qlats.index, fill_value=-1).values
+        qlats = qlats.groupby(np.where(lake_of >= 0, lake_of, qlats.index.values)).sum()
 
     if verbose:
         print("qlateral array complete")
@@ -376,60 +969,219 @@ def main():
     cpu_pool = args.cpu_pool
     compute_method = args.compute_method
 
+    output_sink = None
+    if output_file:
+        output_sink = nhd_io.get_output_sink(output_file, param_df.index.values, nts)
+    restart_kwargs = {}
+    if restart_output_file:
+        if parallel_compute_method == "by-network-process":
+            raise ValueError("--write-restart is not supported by --parallel by-network-process")
+        restart_kwargs = dict(
+            restart_sink=nhd_io.RestartSink(
+                restart_output_file, waterbodies=waterbody_nodes if wbody_kwargs else None
+            ),
+            restart_timesteps=args.restart_timesteps,
+        )
+
     if compute_method == "standard cython compute network":
         compute_func = mc_reach.compute_network
     else:
         compute_func = mc_reach.compute_network
 
-    if parallel_compute_method == "by-network":
+    # Sort all inputs once so that every independent network is a contiguous block of rows;
+    # each network is then routed on zero-copy slices of the arrays.
+    param_cols = ["dt", "bw", "tw", "twcc", "dx", "n", "ncc", "cs", "s0"]
+    data_cols = np.array(param_cols, dtype=object)
+    rows, network_slices = network_contiguous_rows(param_df.index.values, reaches_bytw)
+    data_idx = param_df.index.values[rows]
+    data_values = param_df[param_cols].values[rows]
+    qlat_values = None if qlats is None else qlats.loc[param_df.index].values[rows]
+    q0_values = q0.values[rows]
+
+    # Build the reach topology of each network once; the engine then starts routing
+    # directly from the prebuilt row arrays. Cut subnetworks list as boundary the
+    # upstream subnetworks whose outflow they receive.
+    boundaries_bytw = {}
+    for u, d in sorted(network_deps.items()):
+        boundaries_bytw.setdefault(d, []).append(u)
+    topologies = {}
+    if parallel_compute_method != "by-level":
+        for tw, s in network_slices.items():
+            topologies[tw] = mc_reach.build_topology(
+                reaches_bytw[tw],
+                independent_networks[tw],
+                data_idx[s],
+                boundaries_bytw.get(tw),
+            )
+
+    if network_deps and parallel_compute_method not in (None, "by-network"):
+        raise ValueError(
+            f"--split-networks is not supported by --parallel {parallel_compute_method}"
+        )
+
+    timings = None
+    if not network_deps and parallel_compute_method in (
+        "by-network",
+        "by-network-process",
+    ):
+        # Largest networks first, tiny networks bin-packed into batches
+        costs = nhd_network.network_costs(
+            reaches_bytw, nts, waterbody_nodes, args.waterbody_weight
+        )
+        # joblib runs a single job for n_jobs=None, the process pool uses every cpu
+        nworkers = cpu_pool or (
+            os.cpu_count() if parallel_compute_method == "by-network-process" else 1
+        )
+        batches, _ = nhd_network.balance_networks(costs, nworkers)
+        network_kwargs = dict(
+            nsteps=nts,
+            assume_short_ts=assume_short_ts,
+            warm_start=warm_start,
+            timestep_block=timestep_block,
+            output_idx=csv_output_segments,
+            **wbody_kwargs,
+            **restart_kwargs,
+        )
+
+    if network_deps:
+        results = compute_networks_with_boundaries(
+            compute_func,
+            cpu_pool if parallel_compute_method == "by-network" else 1,
+            network_deps,
+            topologies,
+            network_slices,
+            data_idx,
+            data_cols,
+            data_values,
+            qlat_values,
+            q0_values,
+            nts,
+            assume_short_ts=assume_short_ts,
+            warm_start=warm_start,
+            timestep_block=timestep_block,
+            output_sink=output_sink,
+            output_idx=csv_output_segments,
+            **wbody_kwargs,
+            **restart_kwargs,
+        )
+
+    elif parallel_compute_method == "by-network":
         with Parallel(n_jobs=cpu_pool, backend="threading") as parallel:
             jobs = []
-            for twi, (tw, reach_list) in enumerate(reaches_bytw.items(), 1):
-                r = list(chain.from_iterable(reach_list))
-                param_df_sub = param_df.loc[
-                    r, ["dt", "bw", "tw", "twcc", "dx", "n", "ncc", "cs", "s0"]
-                ].sort_index()
-                qlat_sub = qlats.loc[r].sort_index()
-                q0_sub = q0.loc[r].sort_index()
+            for batch in batches:
                 jobs.append(
-                    delayed(compute_func)(
-                        nts,
-                        reach_list,
-                        independent_networks[tw],
-                        param_df_sub.index.values,
-                        param_df_sub.columns.values,
-                        param_df_sub.values,
-                        qlat_sub.values,
-                        q0_sub.values,
-                        assume_short_ts,
+                    delayed(compute_network_batch)(
+                        compute_func,
+                        batch,
+                        topologies,
+                        network_slices,
+                        data_idx,
+                        data_cols,
+                        data_values,
+                        qlat_values,
+                        q0_values,
+                        output_sink=output_sink,
+                        **network_kwargs,
                     )
                 )
-            results = parallel(jobs)
+            batch_results = parallel(jobs)
+        results = list(chain.from_iterable(r for r, _, _ in batch_results))
+        timings = [(elapsed, worker) for _, elapsed, worker in batch_results]
+
+    elif parallel_compute_method == "by-level":
+        # The whole supernetwork is routed in one call, one reach level at a time
+        reach_list = list(chain.from_iterable(reaches_bytw.values()))
+        rconn = nhd_network.reverse_network(connections)
+        rconn = (
+            rconn.to_dict()
+            if isinstance(rconn, nhd_network.NetworkGraph)
+            else dict(rconn)
+        )
+        levels = nhd_network.reach_levels(reach_list, rconn)
+        if verbose:
+            stats = levels.statistics()
+            print(
+                "%(reaches)d reaches in %(levels)d levels (widest %(max_width)d); "
+                "critical path %(critical_path)d of %(segments)d segments "
+                "(parallelism %(parallelism).1f)" % stats
+            )
+        reach_list, reach_groups, reach_group_sizes = levels.engine_args(reach_list)
+        results = [
+            mc_reach.compute_network_multithread(
+                nts,
+                reach_list,
+                rconn,
+                param_df.index.values,
+                data_cols,
+                param_df[param_cols].values,
+                None if qlats is None else qlats.loc[param_df.index].values,
+                q0.values,
+                reach_groups=reach_groups,
+                reach_group_cache_sizes=reach_group_sizes,
+                assume_short_ts=assume_short_ts,
+                warm_start=warm_start,
+                timestep_block=timestep_block,
+                output_sink=output_sink,
+                output_idx=csv_output_segments,
+                qlat_provider=qlat_provider,
+                **wbody_kwargs,
+                **restart_kwargs,
+            )
+        ]
+
+    elif parallel_compute_method == "by-network-process":
+        results, timings = compute_by_network_processes(
+            cpu_pool,
+            batches,
+            topologies,
+            network_slices,
+            data_idx,
+            data_cols,
+            data_values,
+            qlat_values,
+            q0_values,
+            output_sink=output_sink,
+            **network_kwargs,
+        )
 
     else:  # Execute in serial
         results = []
-        for twi, (tw, reach_list) in enumerate(reaches_bytw.items(), 1):
-            r = list(chain.from_iterable(reach_list))
-            param_df_sub = param_df.loc[
-                r, ["dt", "bw", "tw", "twcc", "dx", "n", "ncc", "cs", "s0"]
-            ].sort_index()
-            qlat_sub = qlats.loc[r].sort_index()
-            q0_sub = q0.loc[r].sort_index()
+        for tw, topology in topologies.items():
+            s = network_slices[tw]
             results.append(
                 compute_func(
                     nts,
-                    reach_list,
-                    independent_networks[tw],
-                    param_df_sub.index.values,
-                    param_df_sub.columns.values,
-                    param_df_sub.values,
-                    qlat_sub.values,
-                    q0_sub.values,
+                    None,
+                    None,
+                    data_idx[s],
+                    data_cols,
+                    data_values[s],
+                    qlat_values[s],
+                    q0_values[s],
                     assume_short_ts,
+                    warm_start=warm_start,
+                    timestep_block=timestep_block,
+                    output_sink=output_sink,
+                    output_idx=csv_output_segments,
+                    topology=topology,
+                    **wbody_kwargs,
+                    **restart_kwargs,
                 )
             )
 
-    if (debuglevel <= -1) or csv_output_folder:
+    if showtiming and timings is not None:
+        print_worker_times(costs, batches, timings)
+
+    if qlat_provider is not None:
+        qlat_provider.close()
+
+    if restart_kwargs:
+        restart_kwargs["restart_sink"].close()
+
+    if output_sink is not None:
+        output_sink.close()
+
+    elif (debuglevel <= -1) or csv_output_folder:
         qvd_columns = pd.MultiIndex.from_product(
             [range(nts), ["q", "v", "d"]]
         ).to_flat_index()
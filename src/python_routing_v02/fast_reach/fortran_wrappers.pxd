@@ -36,3 +36,24 @@ cdef extern from "pyMCsingleSegStime_NoLoop.h":
                                   float *velc,
                                   float *depthc) nogil;
 
+    void c_muskingcungenwm_warm(float *dt,
+                                  float *qup,
+                                  float *quc,
+                                  float *qdp,
+                                  float *ql,
+                                  float *dx,
+                                  float *bw,
+                                  float *tw,
+                                  float *twcc,
+                                  float *n,
+                                  float *ncc,
+                                  float *cs,
+                                  float *s0,
+                                  float *velp,
+                                  float *depthp,
+                                  float *depthpp,
+                                  int *warm_start,
+                                  float *qdc,
+                                  float *velc,
+                                  float *depthc,
+                                  int *iters) nogil;
@@ -14,6 +14,12 @@ from cython.parallel import prange
 #____pyx_f_5reach_muskingcunge
 #from reach cimport muskingcunge, QVD
 cimport reach
+cimport reservoir
+
+# Reach types (see compute_network)
+cpdef enum ReachType:
+    REACH_MC = 0
+    REACH_LEVELPOOL = 1
 
 @cython.boundscheck(False)
 cpdef object binary_find(object arr, object els):
@@ -50,42 +56,50 @@ cpdef object binary_find(object arr, object els):
 
 
 @cython.boundscheck(False)
-cdef void compute_reach_kernel(float qup, float quc, int nreach, const float[:,:] input_buf, float[:, :] output_buf, bint assume_short_ts) nogil:
+cdef void compute_reach_kernel(float qup, float quc, int nreach, const float[:,::1] params, const float[:,:] input_buf, float[:, :] output_buf, bint assume_short_ts, bint warm_start) nogil:
     """
     Kernel to compute reach.
+    Parameter store is array matching following description:
+    axis 0 is parameters in the following order:
+        dt, dx, bw, tw, twcc, n, ncc, cs, s0
+    axis 1 is reach
     Input buffer is array matching following description:
     axis 0 is reach
     axis 1 is inputs in th following order:
-        qlat, dt, dx, bw, tw, twcc, n, ncc, cs, s0, qdp, velp, depthp
-        qup and quc are initial conditions.
+        qlat, qdp, velp, depthp, depthpp
+        qup and quc are initial conditions. depthpp is the depth of the
+        timestep before depthp; with warm_start it seeds the secant solver
+        together with depthp.
     Output buffer matches the same dimsions as input buffer in axis 0
     Input is nxm (n reaches by m variables)
-    Ouput is nx3 (n reaches by 3 return values)
-        0: current flow, 1: current depth, 2: current velocity
+    Ouput is nx4 (n reaches by 4 return values)
+        0: current flow, 1: current depth, 2: current velocity,
+        3: number of secant iterations
     """
     cdef reach.QVD rv
     cdef reach.QVD *out = &rv
 
     cdef:
-        float dt, qlat, dx, bw, tw, twcc, n, ncc, cs, s0, qdp, velp, depthp
+        float dt, qlat, dx, bw, tw, twcc, n, ncc, cs, s0, qdp, velp, depthp, depthpp
         int i
 
     for i in range(nreach):
+        dt = params[0, i]
+        dx = params[1, i]
+        bw = params[2, i]
+        tw = params[3, i]
+        twcc = params[4, i]
+        n = params[5, i]
+        ncc = params[6, i]
+        cs = params[7, i]
+        s0 = params[8, i]
         qlat = input_buf[i, 0] # n x 1
-        dt = input_buf[i, 1] # n x 1
-        dx = input_buf[i, 2] # n x 1
-        bw = input_buf[i, 3]
-        tw = input_buf[i, 4]
-        twcc =input_buf[i, 5]
-        n = input_buf[i, 6]
-        ncc = input_buf[i, 7]
-        cs = input_buf[i, 8]
-        s0 = input_buf[i, 9]
-        qdp = input_buf[i, 10]
-        velp = input_buf[i, 11]
-        depthp = input_buf[i, 12]
-
-        reach.muskingcunge(
+        qdp = input_buf[i, 1]
+        velp = input_buf[i, 2]
+        depthp = input_buf[i, 3]
+        depthpp = input_buf[i, 4]
+
+        reach.muskingcunge_warm(
                     dt,
                     qup,
                     quc,
@@ -101,12 +115,15 @@ cdef void compute_reach_kernel(float qup, float quc, int nreach, const float[:,:
                     s0,
                     velp,
                     depthp,
+                    depthpp,
+                    warm_start,
                     out)
 
 #        output_buf[i, 0] = quc = out.qdc # this will ignore short TS assumption at seg-to-set scale?
         output_buf[i, 0] = out.qdc
         output_buf[i, 1] = out.velc
         output_buf[i, 2] = out.depthc
+        output_buf[i, 3] = out.iters
         
         qup = qdp
         
@@ -115,15 +132,41 @@ cdef void compute_reach_kernel(float qup, float quc, int nreach, const float[:,:
         else:
             quc = out.qdc        
 
-cdef void fill_buffer_column(const Py_ssize_t[:] srows,
-    const Py_ssize_t scol,
-    const Py_ssize_t[:] drows,
-    const Py_ssize_t dcol,
-    const float[:, :] src, float[:, ::1] out) nogil:
 
-    cdef Py_ssize_t i
-    for i in range(srows.shape[0]):
-        out[drows[i], dcol] = src[srows[i], scol]
+@cython.boundscheck(False)
+cdef void compute_levelpool_kernel(float qup, float quc, const float[:,::1] params, const float[:] lake_params, const float[:,:] input_buf, float[:, :] output_buf) nogil:
+    """
+    Kernel to compute a level pool reservoir, a reach of one segment.
+    params is the channel parameter store of the segment (only dt is used),
+    lake_params holds ar, we, maxh, wc, wl, dl, oe, oc, oa and input_buf the
+    qlat, qdp, velp, depthp of the segment, where depthp is the water elevation.
+    The output is the outflow, zero velocity, the new water elevation and
+    zero iterations.
+    """
+    cdef reservoir.QH rv
+    cdef reservoir.QH *out = &rv
+
+    reservoir.levelpool_physics(params[0, 0],
+        qup,
+        quc,
+        input_buf[0, 0],
+        lake_params[0],
+        lake_params[1],
+        lake_params[2],
+        lake_params[3],
+        lake_params[4],
+        lake_params[5],
+        lake_params[6],
+        lake_params[7],
+        lake_params[8],
+        input_buf[0, 3],
+        out)
+
+    output_buf[0, 0] = out.resoutflow
+    output_buf[0, 1] = 0.0
+    output_buf[0, 2] = out.reslevel
+    output_buf[0, 3] = 0.0
+
 
 cpdef object column_mapper(object src_cols):
     """Map source columns to columns expected by algorithm"""
@@ -140,205 +183,733 @@ cpdef object column_mapper(object src_cols):
     return rv
 
 
+cpdef object lake_column_mapper(object src_cols):
+    """Map source columns to the level pool parameters expected by algorithm"""
+    cdef object index = {label: i for i, label in enumerate(src_cols)}
+    return [index[label] for label in ['ar', 'we', 'maxh', 'wc', 'wl', 'dl', 'oe', 'oc', 'oa']]
+
+
+cpdef object build_lake_store(object data_idx, object reach_offsets, object reach_rows,
+    object wbody_idx=None, object wbody_cols=None, object wbody_vals=None, object reach_types=None):
+    """
+    Build the level pool parameter store of a network.
+    Args:
+        data_idx (ndarray): a 1D sorted index for data_values
+        reach_offsets, reach_rows: see build_reach_cache
+        wbody_idx (ndarray): a 1D sorted index of waterbody ids for wbody_vals
+        wbody_cols (ndarray): column labels of wbody_vals
+        wbody_vals (ndarray): a 2D array of level pool parameters (waterbodies x variables)
+        reach_types (ndarray): the ReachType of each reach. If None, a reach is routed as
+            a level pool when its only segment is in wbody_idx.
+    Returns:
+        (reach_types, reach_lakes, lake_params): the uint8 ReachType of each reach, the
+        row of each reach in lake_params and a C-contiguous float32 array of waterbodies
+        x ar, we, maxh, wc, wl, dl, oe, oc, oa. Channel reaches point to a trailing row
+        of zeros.
+    """
+    offsets = np.asarray(reach_offsets)
+    nreaches = len(offsets) - 1
+    if wbody_idx is None:
+        wbody_idx = np.zeros(0, dtype=np.int64)
+        lake_params = np.zeros((1, 9), dtype='float32')
+    else:
+        wbody_idx = np.asarray(wbody_idx)
+        lake_params = np.zeros((len(wbody_idx) + 1, 9), dtype='float32')
+        lake_params[:len(wbody_idx)] = np.asarray(wbody_vals, dtype='float32')[:, lake_column_mapper(wbody_cols)]
+
+    # the segment at the bottom of each reach; a level pool reach has no other segment
+    tails = np.asarray(data_idx)[np.asarray(reach_rows)[offsets[1:] - 1]]
+    lakes = np.searchsorted(wbody_idx, tails)
+    lakes[lakes == len(wbody_idx)] = 0
+    is_lake = wbody_idx[lakes] == tails if len(wbody_idx) else np.zeros(nreaches, dtype=bool)
+    if reach_types is None:
+        reach_types = np.where(is_lake, REACH_LEVELPOOL, REACH_MC).astype(np.uint8)
+    else:
+        reach_types = np.asarray(reach_types, dtype=np.uint8)
+        if len(reach_types) != nreaches:
+            raise ValueError(f"reach_types must have one value per reach ({nreaches})")
+    levelpool = reach_types == REACH_LEVELPOOL
+    if not np.all(is_lake[levelpool]):
+        raise ValueError("level pool reaches must be waterbodies in wbody_idx")
+    if np.any(np.diff(offsets)[levelpool] != 1):
+        raise ValueError("level pool reaches must have exactly one segment")
+    reach_lakes = np.where(levelpool, lakes, len(lake_params) - 1).astype(np.intp)
+    return reach_types, reach_lakes, lake_params
+
+
+cpdef object build_parameter_store(object data_values, object data_cols, object reach_rows):
+    """
+    Build the channel parameter store of a network.
+    Args:
+        data_values (ndarray): a 2D array of data inputs (nodes x variables)
+        data_cols (ndarray): column labels of data_values
+        reach_rows (ndarray): rows of data_values in reach order (see build_reach_cache)
+    Returns:
+        (ndarray): a C-contiguous float32 array of parameters x segments. Axis 0 is
+        dt, dx, bw, tw, twcc, n, ncc, cs, s0 and axis 1 follows reach_rows, so the
+        parameters of a reach are a contiguous slice of every row.
+    Notes:
+        The parameters are static during a run, so the store is built once per network
+        instead of being copied into the routing buffers every timestep.
+    """
+    scols = np.array(column_mapper(data_cols), dtype=np.intp)
+    return np.ascontiguousarray(np.asarray(data_values, dtype='float32')[np.ix_(np.asarray(reach_rows), scols)].T)
+
+
+cpdef object find_rows(const long[:] data_idx, object segments, object boundary_idx=None):
+    """
+    Find the rows of segments in data_idx.
+    Args:
+        data_idx (ndarray): a 1D sorted index
+        segments (ndarray): segment ids
+        boundary_idx (ndarray): segments that are not in data_idx (optional). The
+            segment boundary_idx[k] gets row len(data_idx) + k.
+    Returns:
+        (ndarray) rows
+    """
+    idx = np.asarray(data_idx)
+    segments = np.asarray(segments, dtype=idx.dtype)
+    rows = np.searchsorted(idx, segments)
+    missing = rows >= idx.shape[0]
+    missing[~missing] = idx[rows[~missing]] != segments[~missing]
+    if missing.any() and boundary_idx is not None and len(boundary_idx) > 0:
+        bidx = np.asarray(boundary_idx, dtype=idx.dtype)
+        order = np.argsort(bidx)
+        pos = np.minimum(np.searchsorted(bidx, segments[missing], sorter=order), bidx.shape[0] - 1)
+        found = bidx[order[pos]] == segments[missing]
+        brows = rows[missing]
+        brows[found] = idx.shape[0] + order[pos[found]]
+        rows[missing] = brows
+        missing[missing] = ~found
+    if missing.any():
+        raise ValueError(f"element {segments[missing][0]} not found in {idx}")
+    return rows.astype(np.intp)
+
+
+cpdef object build_reach_cache(list reaches, dict connections, const long[:] data_idx, object boundary_idx=None):
+    """
+    Flatten reaches and their upstream connections into prefix-offset arrays.
+    Args:
+        reaches (list): List of reaches (lists of segment ids), upstream reaches first
+        connections (dict): Network (segment -> upstream segments)
+        data_idx (ndarray): a 1D sorted index for data_values
+        boundary_idx (ndarray): upstream segments that are not in data_idx (optional)
+    Returns:
+        (reach_offsets, reach_rows, usreach_offsets, usreach_rows)
+        Rows of reach r are reach_rows[reach_offsets[r]:reach_offsets[r + 1]] and
+        the rows of its upstream segments are
+        usreach_rows[usreach_offsets[r]:usreach_offsets[r + 1]]. The upstream
+        segment boundary_idx[k] has row len(data_idx) + k.
+    """
+    cdef Py_ssize_t nreaches = len(reaches)
+    cdef list usreaches = [connections.get(reach[0], ()) for reach in reaches]
+
+    reach_offsets = np.zeros(nreaches + 1, dtype=np.intp)
+    usreach_offsets = np.zeros(nreaches + 1, dtype=np.intp)
+    np.cumsum(np.fromiter(map(len, reaches), np.intp, nreaches), out=reach_offsets[1:])
+    np.cumsum(np.fromiter(map(len, usreaches), np.intp, nreaches), out=usreach_offsets[1:])
+
+    reach_rows = find_rows(data_idx,
+        np.fromiter(chain.from_iterable(reaches), np.int64, reach_offsets[nreaches]))
+    usreach_rows = find_rows(data_idx,
+        np.fromiter(chain.from_iterable(usreaches), np.int64, usreach_offsets[nreaches]),
+        boundary_idx)
+
+    return reach_offsets, reach_rows, usreach_offsets, usreach_rows
+
+
+class ReachTopology:
+    """
+    The reach structure of a network as prefix-offset arrays of rows of data_idx
+    (see build_reach_cache). A topology is built once by build_topology and passed to
+    compute_network in place of reaches and connections; it can be pickled and reused
+    for every run over the same network.
+    """
+
+    def __init__(self, data_idx, reach_offsets, reach_rows, usreach_offsets, usreach_rows, boundary_idx=None):
+        self.data_idx = data_idx
+        self.reach_offsets = reach_offsets
+        self.reach_rows = reach_rows
+        self.usreach_offsets = usreach_offsets
+        self.usreach_rows = usreach_rows
+        self.boundary_idx = boundary_idx
+
+    @property
+    def nreaches(self):
+        return self.reach_offsets.shape[0] - 1
+
+    def check(self, data_idx, boundary_idx=None):
+        """Raise ValueError if the topology was not built for data_idx and boundary_idx"""
+        if not np.array_equal(self.data_idx, data_idx):
+            raise ValueError("topology was built for a different data_idx")
+        if boundary_idx is not None and not np.array_equal(self.boundary_idx, boundary_idx):
+            raise ValueError("topology was built for a different boundary_idx")
+
+
+cpdef object build_topology(list reaches, dict connections, const long[:] data_idx, object boundary_idx=None):
+    """
+    Build the ReachTopology of reaches.
+    Args:
+        reaches (list): List of reaches (lists of segment ids), upstream reaches first
+        connections (dict): Network (segment -> upstream segments)
+        data_idx (ndarray): a 1D sorted index for data_values
+        boundary_idx (ndarray): upstream segments outside the network (optional, see compute_network)
+    Returns:
+        (ReachTopology)
+    """
+    if boundary_idx is not None:
+        boundary_idx = np.asarray(boundary_idx, dtype=np.int64)
+    return ReachTopology(np.array(data_idx, dtype=np.int64),
+        *build_reach_cache(reaches, connections, data_idx, boundary_idx),
+        boundary_idx=boundary_idx)
+
+
+cpdef object topology_cache(object topology, list reaches, dict connections, const long[:] data_idx, object boundary_idx=None):
+    """
+    Return the reach cache of topology, checked against data_idx, or build it from
+    reaches and connections if topology is None.
+    """
+    if topology is None:
+        return boundary_idx, build_reach_cache(reaches, connections, data_idx, boundary_idx)
+    topology.check(np.asarray(data_idx), boundary_idx)
+    return topology.boundary_idx, (topology.reach_offsets, topology.reach_rows,
+        topology.usreach_offsets, topology.usreach_rows)
+
+
+cpdef object take_offsets(object offsets, object values, object order):
+    """
+    Reorder the groups of a prefix-offset array.
+    Args:
+        offsets (ndarray): group i is values[offsets[i]:offsets[i + 1]]
+        values (ndarray): flat group values
+        order (ndarray): new order of the groups
+    Returns:
+        (new_offsets, new_values)
+    """
+    offsets = np.asarray(offsets)
+    cdef Py_ssize_t ngroups = len(order)
+    lens = np.diff(offsets)[order]
+    new_offsets = np.zeros(ngroups + 1, dtype=np.intp)
+    np.cumsum(lens, out=new_offsets[1:])
+    take = np.repeat(offsets[:len(offsets) - 1][order] - new_offsets[:ngroups], lens) + np.arange(new_offsets[ngroups])
+    return new_offsets, np.asarray(values)[take]
+
+
+cpdef object check_reach_groups(object group_sizes,
+    object reach_offsets,
+    object reach_rows,
+    object usreach_offsets,
+    object usreach_rows):
+    """
+    Check that reaches grouped by group_sizes (reaches ordered by group) can be
+    computed one group after the other: every upstream reach of a reach must be in
+    a strictly earlier group.
+    Args:
+        group_sizes (ndarray): number of reaches in each group
+        reach_offsets, reach_rows, usreach_offsets, usreach_rows: see build_reach_cache
+    Raises:
+        ValueError: if the groups do not cover the reaches or break the upstream order
+    """
+    group_sizes = np.asarray(group_sizes)
+    reach_offsets = np.asarray(reach_offsets)
+    usreach_offsets = np.asarray(usreach_offsets)
+    usreach_rows = np.asarray(usreach_rows)
+    nreaches = len(reach_offsets) - 1
+    if (group_sizes < 0).any() or group_sizes.sum() != nreaches:
+        raise ValueError("reach_groups do not sum to the number of reaches")
+    reach_group = np.repeat(np.arange(len(group_sizes)), group_sizes)
+    # group of the reach each row belongs to; rows outside the reaches are never upstream
+    row_group = np.full(max(np.max(reach_rows, initial=-1), np.max(usreach_rows, initial=-1)) + 1, -1, dtype=np.intp)
+    row_group[reach_rows] = np.repeat(reach_group, np.diff(reach_offsets))
+    us_group = row_group[usreach_rows]
+    group = np.repeat(reach_group, np.diff(usreach_offsets))
+    bad = us_group >= group
+    if bad.any():
+        i = np.flatnonzero(bad)[0]
+        reach = np.searchsorted(usreach_offsets, i, side="right") - 1
+        raise ValueError(f"reach {reach} in reach group {group[i]} depends on a reach in group {us_group[i]}")
+
+
+@cython.boundscheck(False)
+cdef void compute_reach_timesteps(int tstart,
+    int tend,
+    int nsteps,
+    int nslots,
+    const Py_ssize_t[:] srows,
+    const Py_ssize_t[:] usrows,
+    const float[:, ::1] boundary_flows,
+    const float[:, ::1] params,
+    const float[:, :] qlat_values,
+    int qlat_ncols,
+    int qlat_offset,
+    const float[:,:] initial_conditions,
+    float[:, ::1] flowveldepth,
+    float[:, ::1] buf_view,
+    float[:, ::1] out_view,
+    bint assume_short_ts,
+    unsigned char reach_type,
+    const float[:] lake_params,
+    bint warm_start,
+    long[::1] iterations) nogil:
+    """
+    Route a single reach for the timesteps [tstart, tend).
+    srows are the rows of the reach segments and usrows the rows of the upstream
+    segments in data_values; an upstream row nrows + k refers to row k of boundary_flows
+    (see build_reach_cache). params is the slice of the parameter store holding
+    the reach. The upstream segments must already be computed up to tend. buf_view and
+    out_view must be at least len(srows) rows and are private to the reach.
+    flowveldepth holds nslots timesteps; timestep t is stored in slot t % nslots.
+    qlat_values holds the forcing timesteps from qlat_offset on of qlat_ncols in the run.
+    Level pool reaches are routed with lake_params (see build_lake_store).
+    The secant iterations of each segment are added to iterations unless it is empty.
+    """
+    cdef Py_ssize_t i
+    cdef Py_ssize_t reachlen = srows.shape[0]
+    cdef Py_ssize_t nrows = flowveldepth.shape[0]
+    cdef Py_ssize_t qlat_col
+    cdef int timestep, ts_offset, prev_offset, pprev_offset
+    cdef float qup, quc
+    cdef bint count_iterations = iterations.shape[0] > 0
+
+    for timestep in range(tstart, tend):
+        ts_offset = (timestep % nslots) * 3
+        prev_offset = ((timestep - 1) % nslots) * 3
+        pprev_offset = ((timestep - 2) % nslots) * 3
+        qup = 0.0
+        quc = 0.0
+        for i in range(usrows.shape[0]):
+            if usrows[i] >= nrows:
+                # upstream segment outside the network, column 0 holds its qd0
+                quc += boundary_flows[usrows[i] - nrows, timestep + 1]
+                qup += boundary_flows[usrows[i] - nrows, timestep]
+                continue
+            # upstream flow in the current timestep is equal the sum of flows
+            # in upstream segments, current timestep
+            quc += flowveldepth[usrows[i], ts_offset]
+            # upstream flow in the previous timestep is equal to the sum of flows
+            # in upstream segments, previous timestep, or qd0 when timestep == 0
+            if timestep > 0:
+                qup += flowveldepth[usrows[i], prev_offset]
+            else:
+                qup += initial_conditions[usrows[i], 1]
+
+        # qlat values are repeated for each of the finer routing timesteps
+        # within a WRF hydro timestep
+        qlat_col = int(timestep/(nsteps/qlat_ncols))
+        qlat_col -= qlat_offset
+        for i in range(reachlen):
+            buf_view[i, 0] = qlat_values[srows[i], qlat_col]
+            if timestep > 0:
+                buf_view[i, 1] = flowveldepth[srows[i], prev_offset]
+                buf_view[i, 2] = flowveldepth[srows[i], prev_offset + 1]
+                buf_view[i, 3] = flowveldepth[srows[i], prev_offset + 2]
+            else:
+                # qdp = qd0, velp is never used, depthp = h0
+                buf_view[i, 1] = initial_conditions[srows[i], 1]
+                buf_view[i, 2] = 0.0
+                buf_view[i, 3] = initial_conditions[srows[i], 2]
+            # depth of the timestep before; the slot of timestep - 2 is only
+            # overwritten by this reach after it is read here
+            if timestep > 1:
+                buf_view[i, 4] = flowveldepth[srows[i], pprev_offset + 2]
+            else:
+                buf_view[i, 4] = initial_conditions[srows[i], 2]
+
+        if assume_short_ts:
+            quc = qup
+
+        if reach_type == REACH_LEVELPOOL:
+            compute_levelpool_kernel(qup, quc, params, lake_params, buf_view, out_view)
+        else:
+            compute_reach_kernel(qup, quc, reachlen, params, buf_view, out_view, assume_short_ts, warm_start)
+
+        for i in range(reachlen):
+            flowveldepth[srows[i], ts_offset] = out_view[i, 0]
+            flowveldepth[srows[i], ts_offset + 1] = out_view[i, 1]
+            flowveldepth[srows[i], ts_offset + 2] = out_view[i, 2]
+            if count_iterations:
+                iterations[srows[i]] += <long> out_view[i, 3]
+
+
+@cython.boundscheck(False)
+cdef void compute_levelpool_timesteps(int tstart,
+    int tend,
+    int nsteps,
+    int nslots,
+    const Py_ssize_t[:] lake_rows,
+    const Py_ssize_t[:] usoffsets,
+    const Py_ssize_t[:] usrows,
+    const float[:] dt,
+    const float[:, ::1] lake_params,
+    const float[:, :] qlat_values,
+    int qlat_ncols,
+    int qlat_offset,
+    const float[:,:] initial_conditions,
+    float[:, ::1] flowveldepth,
+    float[:, ::1] inflow_buf,
+    float[:, ::1] out_buf,
+    bint assume_short_ts) nogil:
+    """
+    Route the level pool reservoirs in lake_rows for the timesteps [tstart, tend),
+    all of them in one reservoir.compute_reservoirs call per timestep. The reservoirs
+    must not depend on each other and their upstream segments must already be computed
+    up to tend. usoffsets and usrows hold the upstream rows of each reservoir, dt and
+    lake_params (ar, we, maxh, wc, wl, dl, oe, oc, oa) its parameters. inflow_buf
+    (4 x reservoirs, for qi0, qi1, ql, H0) and out_buf (reservoirs x 2) are scratch.
+    See compute_reach_timesteps for flowveldepth and qlat_values.
+    """
+    cdef Py_ssize_t i, k, row
+    cdef Py_ssize_t nlakes = lake_rows.shape[0]
+    cdef Py_ssize_t qlat_col
+    cdef int timestep, ts_offset, prev_offset
+    cdef float qup, quc
+
+    for timestep in range(tstart, tend):
+        ts_offset = (timestep % nslots) * 3
+        prev_offset = ((timestep - 1) % nslots) * 3
+        qlat_col = int(timestep/(nsteps/qlat_ncols))
+        qlat_col -= qlat_offset
+        for k in range(nlakes):
+            row = lake_rows[k]
+            qup = 0.0
+            quc = 0.0
+            for i in range(usoffsets[k], usoffsets[k + 1]):
+                quc += flowveldepth[usrows[i], ts_offset]
+                if timestep > 0:
+                    qup += flowveldepth[usrows[i], prev_offset]
+                else:
+                    qup += initial_conditions[usrows[i], 1]
+            if assume_short_ts:
+                quc = qup
+            inflow_buf[0, k] = qup
+            inflow_buf[1, k] = quc
+            inflow_buf[2, k] = qlat_values[row, qlat_col]
+            if timestep > 0:
+                inflow_buf[3, k] = flowveldepth[row, prev_offset + 2]
+            else:
+                inflow_buf[3, k] = initial_conditions[row, 2]
+
+        reservoir.compute_reservoirs(dt, inflow_buf[0], inflow_buf[1], inflow_buf[2],
+            lake_params, inflow_buf[3], out_buf, True)
+
+        for k in range(nlakes):
+            row = lake_rows[k]
+            flowveldepth[row, ts_offset] = out_buf[k, 1]
+            flowveldepth[row, ts_offset + 1] = 0.0
+            flowveldepth[row, ts_offset + 2] = out_buf[k, 0]
+
+
+cpdef object network_result(object out_idx, object output, object out_rows, object iterations=None):
+    """
+    The return value of compute_network: (out_idx, output) with output as a float32 array
+    (or None), followed by the iterations of the rows out_rows if iterations is not None.
+    """
+    if output is not None:
+        output = np.asarray(output, dtype='float32')
+    if iterations is None:
+        return out_idx, output
+    return out_idx, output, np.asarray(iterations)[out_rows]
+
+
+cpdef object select_output_rows(const long[:] data_idx, object output_idx=None):
+    """
+    Find the rows of data_idx to record.
+    Args:
+        data_idx (ndarray): a 1D sorted index for data_values
+        output_idx (ndarray): segments to record, or None for all segments.
+            Segments that are not in data_idx are ignored.
+    Returns:
+        (out_idx, out_rows): the recorded segments (sorted) and their rows in data_idx
+    """
+    if output_idx is None:
+        return np.asarray(data_idx, dtype=np.intp), np.arange(data_idx.shape[0], dtype=np.intp)
+    out_idx = np.intersect1d(np.asarray(output_idx), np.asarray(data_idx))
+    return out_idx.astype(np.intp), np.searchsorted(np.asarray(data_idx), out_idx).astype(np.intp)
+
+
+@cython.boundscheck(False)
+cdef void copy_output_rows(const float[:, ::1] flowveldepth,
+    const Py_ssize_t[:] out_rows,
+    float[:, ::1] output,
+    int tstart,
+    int tend,
+    int nslots) nogil:
+    """Copy the timesteps [tstart, tend) of out_rows in flowveldepth to output"""
+    cdef Py_ssize_t i, k
+    cdef int timestep, slot_offset
+    for i in range(out_rows.shape[0]):
+        for timestep in range(tstart, tend):
+            slot_offset = (timestep % nslots) * 3
+            for k in range(3):
+                output[i, timestep * 3 + k] = flowveldepth[out_rows[i], slot_offset + k]
+
+
+cdef object write_output_block(object output_sink, object out_idx, object out_rows,
+    float[:, ::1] flowveldepth, int tstart, int tend, int nslots):
+    """Pass the timesteps [tstart, tend) of out_rows held in flowveldepth to output_sink"""
+    cdef object cols = ((np.arange(tstart, tend) % nslots)[:, None] * 3 + np.arange(3)).ravel()
+    output_sink.write(out_idx, tstart, np.asarray(flowveldepth)[np.ix_(out_rows, cols)])
+
+
+cdef object restart_timestep_array(object restart_timesteps, int nsteps):
+    """Timesteps to emit the restart state at; the last timestep by default"""
+    if restart_timesteps is None:
+        return np.array([nsteps - 1])
+    steps = np.unique(np.asarray(restart_timesteps, dtype=np.int64))
+    if steps.shape[0] and (steps[0] < 0 or steps[steps.shape[0] - 1] >= nsteps):
+        raise ValueError(f"restart_timesteps must be in [0, {nsteps}), got {steps.tolist()}")
+    return steps
+
+
+cdef object write_restart_state(object restart_sink, object data_idx, object flowveldepth,
+    object reach_offsets, object reach_rows, object usreach_offsets, object usreach_rows,
+    object boundary_flows, int timestep, int nslots):
+    """
+    Pass the state of every segment after timestep to restart_sink, in the layout of
+    initial_conditions: qu0 (the flow of the segments upstream), qd0 and h0.
+    """
+    fvd = np.asarray(flowveldepth)
+    reach_offsets = np.asarray(reach_offsets)
+    reach_rows = np.asarray(reach_rows)
+    usreach_rows = np.asarray(usreach_rows)
+    slot = (timestep % nslots) * 3
+    state = np.zeros((fvd.shape[0], 3), dtype='float32')
+    state[:, 1] = fvd[:, slot]
+    state[:, 2] = fvd[:, slot + 2]
+
+    # within a reach, a segment receives the flow of the segment before it
+    inner = np.ones(reach_rows.shape[0], dtype=bool)
+    inner[reach_offsets[:reach_offsets.shape[0] - 1]] = False
+    state[reach_rows[inner], 0] = state[reach_rows[np.flatnonzero(inner) - 1], 1]
+    # reach heads receive the flow of the upstream reaches and boundary segments
+    flows = np.concatenate((state[:, 1], np.asarray(boundary_flows)[:, timestep + 1]))
+    nreaches = reach_offsets.shape[0] - 1
+    upstream_flow = np.bincount(np.repeat(np.arange(nreaches), np.diff(usreach_offsets)),
+        weights=flows[usreach_rows], minlength=nreaches)
+    state[reach_rows[reach_offsets[:nreaches]], 0] = upstream_flow
+    restart_sink.write(np.asarray(data_idx), timestep, state)
+
+
+cdef object check_qlat(const long[:] data_idx, int nsteps, const float[:, :] qlat_values, object qlat_provider):
+    """
+    Check the lateral inflows of a network. Returns the number of forcing timesteps
+    and the rows of data_idx in qlat_provider (None without a provider).
+    """
+    if qlat_provider is not None:
+        nqlat = qlat_provider.shape[1]
+        qlat_rows = qlat_provider.find_rows(np.asarray(data_idx))
+    elif qlat_values is None:
+        raise ValueError("qlat_values or qlat_provider is required")
+    else:
+        if qlat_values.shape[0] != data_idx.shape[0]:
+            raise ValueError(f"Number of rows in Qlat is incorrect: expected ({data_idx.shape[0]}), got ({qlat_values.shape[0]})")
+        nqlat = qlat_values.shape[1]
+        qlat_rows = None
+    if nqlat > nsteps:
+        raise ValueError(f"Number of columns (timesteps) in Qlat is incorrect: expected at most ({nsteps}), got ({nqlat}). The number of columns in Qlat must be equal to or less than the number of routing timesteps")
+    return nqlat, qlat_rows
+
+
+cdef object read_qlat_block(object qlat_provider, object qlat_rows, int nsteps, int nqlat, int tstart, int tend):
+    """
+    Read the forcing timesteps of the routing timesteps [tstart, tend) from qlat_provider.
+    Returns the first forcing timestep and the qlat of data_idx from it on.
+    """
+    cdef int first = int(tstart/(nsteps/nqlat))
+    cdef int last = int((tend - 1)/(nsteps/nqlat))
+    return first, qlat_provider.columns(first, last + 1, qlat_rows)
+
+
 cpdef object compute_network(int nsteps, list reaches, dict connections, 
     const long[:] data_idx, object[:] data_cols, const float[:,:] data_values, 
     const float[:, :] qlat_values, const float[:,:] initial_conditions, 
-    # const float[:] wbody_idx, object[:] wbody_cols, const float[:, :] wbody_vals,
-    bint assume_short_ts=False):
+    bint assume_short_ts=False,
+    int timestep_block=1,
+    object output_sink=None,
+    object output_idx=None,
+    object boundary_idx=None,
+    const float[:, ::1] boundary_flows=None,
+    object topology=None,
+    object wbody_idx=None,
+    object wbody_cols=None,
+    object wbody_vals=None,
+    object reach_types=None,
+    bint warm_start=False,
+    bint return_iterations=False,
+    object qlat_provider=None,
+    object restart_sink=None,
+    object restart_timesteps=None):
     """
     Compute network
     Args:
         nsteps (int): number of time steps
-        reaches (list): List of reaches
-        connections (dict): Network
+        reaches (list): List of reaches (may be None if topology is given)
+        connections (dict): Network (may be None if topology is given)
         data_idx (ndarray): a 1D sorted index for data_values
         data_values (ndarray): a 2D array of data inputs (nodes x variables)
-        qlats (ndarray): a 2D array of qlat values (nodes x nsteps). The index must be shared with data_values
+        qlats (ndarray): a 2D array of qlat values (nodes x nsteps). The index must be shared with data_values.
+            May be None if qlat_provider is given.
         initial_conditions (ndarray): an n x 3 array of initial conditions. n = nodes, column 1 = qu0, column 2 = qd0, column 3 = h0
         assume_short_ts (bool): Assume short time steps (quc = qup)
+        timestep_block (int): number of timesteps each reach is routed over before moving
+            downstream. Reaches only depend on upstream values of the same and previous
+            timestep and the kernel keeps no state between calls, so results are identical
+            for any block size; larger blocks keep a reach in cache over several timesteps
+            instead of sweeping the whole network every step.
+        output_sink (object): receives completed timesteps instead of keeping all of them in
+            memory. After every block, output_sink.write(out_idx, tstart, values) is called with
+            values of shape (nodes x 3 * block length); see troute.nhd_io for sinks.
+        output_idx (ndarray): segments to record (e.g. gages or forecast points). Other segments
+            are only kept for the timesteps the computation needs. If None, all segments
+            are recorded.
+        boundary_idx (ndarray): segments outside the network that flow into it, e.g. where
+            a larger network was cut into subnetworks (see troute.nhd_network.split_network).
+            They appear in connections as upstream segments of reach heads.
+        boundary_flows (ndarray): a len(boundary_idx) x (nsteps + 1) array of the flow of
+            each boundary segment; column 0 is its qd0 and column t + 1 the flow at timestep t.
+        topology (ReachTopology): the prebuilt reach structure of reaches and connections
+            for data_idx and boundary_idx (see build_topology). Its boundary_idx is used
+            when boundary_idx is None.
+        wbody_idx (ndarray): a 1D sorted index of waterbodies for wbody_vals. A waterbody
+            is a single segment of the network (see troute.nhd_network.collapse_waterbodies)
+            with a row in data_idx; its qlat is the inflow to the waterbody and its h0 the
+            initial water elevation.
+        wbody_cols (ndarray): column labels of wbody_vals; level pool parameters are
+            ar, we, maxh, wc, wl, dl, oe, oc, oa
+        wbody_vals (ndarray): a 2D array of waterbody parameters (waterbodies x variables)
+        reach_types (ndarray): ReachType of each reach (REACH_MC or REACH_LEVELPOOL). If
+            None, reaches made of a waterbody in wbody_idx are routed as level pools.
+        warm_start (bool): Seed the Muskingum-Cunge secant solver from the depth trend of
+            the two previous timesteps instead of from the previous depth alone, so segments
+            in slow recession converge in fewer iterations. Off by default: the solver stops at
+            a 1% relative change in depth, so results differ from the default seeding within
+            that tolerance (on Pocono_TEST1, total flow shifted by 1.7% over 48 timesteps to
+            5.6% over 288 timesteps, for 3-7% fewer secant iterations).
+        return_iterations (bool): Also return the total number of secant iterations of
+            each recorded segment over the run.
+        qlat_provider (QlatProvider): reads the qlat of each block of timesteps as the
+            computation advances instead of taking qlat_values (see troute.nhd_io for
+            providers). Its shape[1] forcing timesteps are spread over nsteps like the
+            columns of qlat_values; segments it does not hold have no lateral inflow.
+        restart_sink (object): receives the state of every segment after each of
+            restart_timesteps: restart_sink.write(data_idx, timestep, state) is called with
+            state of shape (nodes x 3) in the layout of initial_conditions (qu0, qd0, h0;
+            for a waterbody its outflow and water elevation). The state after timestep t
+            is the initial_conditions of a run that continues at timestep t + 1; see
+            troute.nhd_io.RestartSink.
+        restart_timesteps (list): timesteps to emit the state at (default: the last one)
+    Returns:
+        (out_idx, flowveldepth): out_idx are the recorded segments and flowveldepth is an
+        out_idx x (3 * nsteps) array of flow, velocity and depth for each timestep, or None
+        if output_sink is given. With return_iterations, (out_idx, flowveldepth, iterations)
+        where iterations is an int64 array following out_idx.
     Notes:
         Array dimensions are checked as a precondition to this method.
     """
     # Check shapes
-    if qlat_values.shape[0] != data_idx.shape[0]:
-        raise ValueError(f"Number of rows in Qlat is incorrect: expected ({data_idx.shape[0]}), got ({qlat_values.shape[0]})")
-    if qlat_values.shape[1] > nsteps:
-        raise ValueError(f"Number of columns (timesteps) in Qlat is incorrect: expected at most ({data_idx.shape[0]}), got ({qlat_values.shape[0]}). The number of columns in Qlat must be equal to or less than the number of routing timesteps")
+    cdef int nqlat
+    nqlat, qlat_rows = check_qlat(data_idx, nsteps, qlat_values, qlat_provider)
+    restart_steps = restart_timestep_array(restart_timesteps, nsteps)
     if data_values.shape[0] != data_idx.shape[0] or data_values.shape[1] != data_cols.shape[0]:
         raise ValueError(f"data_values shape mismatch")
+    if timestep_block < 1:
+        raise ValueError(f"timestep_block must be positive, got ({timestep_block})")
 
     # flowveldepth is 2D float array that holds results
     # columns: flow (qdc), velocity (velc), and depth (depthc) for each timestep
     # rows: indexed by data_idx
-    cdef float[:,::1] flowveldepth = np.zeros((data_idx.shape[0], nsteps * 3), dtype='float32')
+    # With an output sink or output_idx, only the current block and the timestep before it are kept.
+    cdef bint keep_all = output_sink is None and output_idx is None
+    cdef int nslots = nsteps if keep_all else timestep_block + 1
+    cdef float[:,::1] flowveldepth = np.zeros((data_idx.shape[0], nslots * 3), dtype='float32')
 
-    cdef:
-        Py_ssize_t[:] srows  # Source rows indexes
-        Py_ssize_t[:] drows_tmp
-    
-    # Buffers and buffer views
-    # These are C-contiguous.
-    cdef float[:, ::1] buf, buf_view
-    cdef float[:, ::1] out_buf, out_view
-
-    # Source columns
-    cdef Py_ssize_t[:] scols = np.array(column_mapper(data_cols), dtype=np.intp)
-    
-    # hard-coded column. Find a better way to do this
-    cdef int buf_cols = 13
+    # output holds the recorded segments when they are not written to output_sink
+    cdef Py_ssize_t[::1] out_rows
+    out_idx, out_rows = select_output_rows(data_idx, output_idx)
+    cdef float[:, ::1] output = flowveldepth
+    cdef bint record_output = not keep_all and output_sink is None
+    if record_output:
+        output = np.zeros((out_rows.shape[0], nsteps * 3), dtype='float32')
 
-    cdef:
-        Py_ssize_t i  # Temporary variable
-        Py_ssize_t ireach  # current reach index
-        Py_ssize_t ireach_cache  # current index of reach cache
-        Py_ssize_t iusreach_cache  # current index of upstream reach cache
-
-    # Measure length of all the reaches
-    cdef list reach_sizes = list(map(len, reaches))
-    # For a given reach, get number of upstream nodes
-    cdef list usreach_sizes = [len(connections.get(reach[0], ())) for reach in reaches]
+    # qlat, qdp, velp, depthp, depthpp
+    cdef int buf_cols = 5
 
     cdef:
-        list reach  # Temporary variable
-        list bf_results  # Temporary variable
+        Py_ssize_t[::1] reach_offsets
+        Py_ssize_t[::1] reach_rows
+        Py_ssize_t[::1] usreach_offsets
+        Py_ssize_t[::1] usreach_rows
+        float[:, ::1] params
+    boundary_idx, (reach_offsets, reach_rows, usreach_offsets, usreach_rows) = topology_cache(
+        topology, reaches, connections, data_idx, boundary_idx)
+    if boundary_idx is None:
+        boundary_flows = np.zeros((0, nsteps + 1), dtype='float32')
+    elif boundary_flows is None or boundary_flows.shape[0] != len(boundary_idx) or boundary_flows.shape[1] != nsteps + 1:
+        raise ValueError(f"boundary_flows must have shape ({len(boundary_idx)}, {nsteps + 1})")
 
-    cdef int reachlen, usreachlen
-    cdef Py_ssize_t bidx
+    params = build_parameter_store(data_values, data_cols, reach_rows)
 
     cdef:
-        Py_ssize_t[:] reach_cache
-        Py_ssize_t[:] usreach_cache
-
-    # reach cache is ordered 1D view of reaches
-    # [-len, item, item, item, -len, item, item, -len, item, item, ...]
-    reach_cache = np.empty(sum(reach_sizes) + len(reach_sizes), dtype=np.intp)
-    # upstream reach cache is ordered 1D view of reaches
-    # [-len, item, item, item, -len, item, item, -len, item, item, ...]
-    usreach_cache = np.empty(sum(usreach_sizes) + len(usreach_sizes), dtype=np.intp)
-
-    ireach_cache = 0
-    iusreach_cache = 0
-    # copy reaches into an array
-    for ireach in range(len(reaches)):
-        reachlen = reach_sizes[ireach]
-        usreachlen = usreach_sizes[ireach]
-        reach = reaches[ireach]
-
-        # set the length (must be negative to indicate reach boundary)
-        reach_cache[ireach_cache] = -reachlen
-        ireach_cache += 1
-        bf_results = binary_find(data_idx, reach)
-        for bidx in bf_results:
-            reach_cache[ireach_cache] = bidx
-            ireach_cache += 1
-
-        usreach_cache[iusreach_cache] = -usreachlen
-        iusreach_cache += 1
-        if usreachlen > 0:
-            for bidx in binary_find(data_idx, connections[reach[0]]):
-                usreach_cache[iusreach_cache] = bidx
-                iusreach_cache += 1
-
-    cdef int maxreachlen = max(reach_sizes)
-    buf = np.empty((maxreachlen, buf_cols), dtype='float32')
-    out_buf = np.empty((maxreachlen, 3), dtype='float32')
-
-    drows_tmp = np.arange(maxreachlen, dtype=np.intp)
-    cdef Py_ssize_t[:] drows
-    cdef float qup, quc
-    cdef int timestep = 0
-    cdef int ts_offset
-
-    with nogil:
-        while timestep < nsteps:
-            ts_offset = timestep * 3
-
-            ireach_cache = 0
-            iusreach_cache = 0
-            while ireach_cache < reach_cache.shape[0]:
-                reachlen = -reach_cache[ireach_cache]
-                usreachlen = -usreach_cache[iusreach_cache]
-
-                ireach_cache += 1
-                iusreach_cache += 1
-                
-                qup = 0.0
-                quc = 0.0
-                for i in range(usreachlen):
-                    
-                    '''
-                    New logic was added to handle initial conditions:
-                    When timestep == 0, the flow from the upstream segments in the previous timestep
-                    are equal to the initial conditions. 
-                    '''
-                        
-                    # upstream flow in the current timestep is equal the sum of flows 
-                    # in upstream segments, current timestep
-                    # Headwater reaches are computed before higher order reaches, so quc can
-                    # be evaulated even when the timestep == 0.
-                    quc += flowveldepth[usreach_cache[iusreach_cache + i], ts_offset]
-                    
-                    # upstream flow in the previous timestep is equal to the sum of flows 
-                    # in upstream segments, previous timestep
-                    if timestep > 0:
-                        qup += flowveldepth[usreach_cache[iusreach_cache + i], ts_offset - 3]
-                    else:
-                        # sum of qd0 (flow out of each segment) over all upstream reaches
-                        qup += initial_conditions[usreach_cache[iusreach_cache + i],1]
-                        
-                buf_view = buf[:reachlen, :]
-                out_view = out_buf[:reachlen, :]
-                drows = drows_tmp[:reachlen]
-                srows = reach_cache[ireach_cache:ireach_cache+reachlen]
-
-                """
-                qlat_values may have fewer columns than data_values if qlat data are taken from WRF hydro simulations,
-                which are often run at a coarser timestep than routing models. In the fill_buffer_columns call below, 
-                the second argument, which defines the column in qlat_values that data should be drawn from, is specified
-                such that qlat values are repeated for each of the finer routing timesteps within a WRF hydro timestep. 
-                """
-                fill_buffer_column(srows, 
-                                   int(timestep/(nsteps/qlat_values.shape[1])),  # adjust timestep to WRF-hydro timestep
-                                   drows, 
-                                   0, 
-                                   qlat_values, 
-                                   buf_view)
-                
-                for i in range(scols.shape[0]):
-                        fill_buffer_column(srows, scols[i], drows, i + 1, data_values, buf_view)
-                        
-                # fill buffer with qdp, depthp, velp
-                if timestep > 0:
-                    fill_buffer_column(srows, ts_offset - 3, drows, 10, flowveldepth, buf_view)
-                    fill_buffer_column(srows, ts_offset - 2, drows, 11, flowveldepth, buf_view)
-                    fill_buffer_column(srows, ts_offset - 1, drows, 12, flowveldepth, buf_view)
-                else:
-                    '''
-                    Changed made to accomodate initial conditions:
-                    when timestep == 0, qdp, and depthp are taken from the initial_conditions array, 
-                    using srows to properly index
-                    '''
-                    for i in range(drows.shape[0]):
-                        buf_view[drows[i], 10] = initial_conditions[srows[i],1] #qdp = qd0
-                        buf_view[drows[i], 11] = 0.0 # the velp argmument is never used, set to whatever
-                        buf_view[drows[i], 12] = initial_conditions[srows[i],2] #hdp = h0
-
-                if assume_short_ts:
-                    quc = qup
+        unsigned char[::1] rtypes
+        Py_ssize_t[::1] reach_lakes
+        float[:, ::1] lake_params
+    rtypes, reach_lakes, lake_params = build_lake_store(data_idx, reach_offsets, reach_rows,
+        wbody_idx, wbody_cols, wbody_vals, reach_types)
 
-                compute_reach_kernel(qup, quc, reachlen, buf_view, out_view, assume_short_ts)
+    cdef int maxreachlen = np.diff(reach_offsets).max()
+    cdef float[:, ::1] buf = np.empty((maxreachlen, buf_cols), dtype='float32')
+    cdef float[:, ::1] out_buf = np.empty((maxreachlen, 4), dtype='float32')
+    cdef long[::1] iterations = np.zeros(data_idx.shape[0] if return_iterations else 0, dtype=np.int64)
 
-                # copy out_buf results back to flowdepthvel
-                for i in range(3):
-                    fill_buffer_column(drows, i, srows, ts_offset + i, out_view, flowveldepth)
+    cdef:
+        Py_ssize_t ireach
+        Py_ssize_t reachlen
+        int tstart = 0
+        int tend
+        int qlat_offset = 0
+        const float[:, :] qlats = qlat_values
 
-                # Update indexes to point to next reach
-                ireach_cache += reachlen
-                iusreach_cache += usreachlen
-                
-            timestep += 1
+    while tstart < nsteps:
+        tend = min(tstart + timestep_block, nsteps)
+        if qlat_provider is not None:
+            qlat_offset, qlats = read_qlat_block(qlat_provider, qlat_rows, nsteps, nqlat, tstart, tend)
+        with nogil:
+            # Headwater reaches are computed before higher order reaches, so upstream
+            # flows of the whole block are available when a reach is computed.
+            for ireach in range(reach_offsets.shape[0] - 1):
+                reachlen = reach_offsets[ireach + 1] - reach_offsets[ireach]
+                compute_reach_timesteps(tstart,
+                    tend,
+                    nsteps,
+                    nslots,
+                    reach_rows[reach_offsets[ireach]:reach_offsets[ireach + 1]],
+                    usreach_rows[usreach_offsets[ireach]:usreach_offsets[ireach + 1]],
+                    boundary_flows,
+                    params[:, reach_offsets[ireach]:reach_offsets[ireach + 1]],
+                    qlats,
+                    nqlat,
+                    qlat_offset,
+                    initial_conditions,
+                    flowveldepth,
+                    buf[:reachlen],
+                    out_buf[:reachlen],
+                    assume_short_ts,
+                    rtypes[ireach],
+                    lake_params[reach_lakes[ireach]],
+                    warm_start,
+                    iterations)
+            if record_output:
+                copy_output_rows(flowveldepth, out_rows, output, tstart, tend, nslots)
+        if output_sink is not None:
+            write_output_block(output_sink, out_idx, out_rows, flowveldepth, tstart, tend, nslots)
+        if restart_sink is not None:
+            for t in restart_steps[(restart_steps >= tstart) & (restart_steps < tend)]:
+                write_restart_state(restart_sink, data_idx, flowveldepth, reach_offsets, reach_rows,
+                    usreach_offsets, usreach_rows, boundary_flows, t, nslots)
+        tstart = tend
 
-    return np.asarray(data_idx, dtype=np.intp), np.asarray(flowveldepth, dtype='float32')
+    return network_result(out_idx, None if output_sink is not None else output, out_rows,
+        iterations if return_iterations else None)
 
 #---------------------------------------------------------------------------------------------------------------#
 #---------------------------------------------------------------------------------------------------------------#
@@ -346,253 +917,215 @@ cpdef object compute_network(int nsteps, list reaches, dict connections,
 cpdef object compute_network_multithread(int nsteps, list reaches, dict connections, 
     const long[:] data_idx, object[:] data_cols, const float[:,:] data_values, 
     const float[:, :] qlat_values, const float[:,:] initial_conditions, 
-    const int[:] reach_groups,
-    const int[:] reach_group_cache_sizes,
-    bint assume_short_ts=False):
+    const int[:] reach_groups=None,
+    const int[:] reach_group_cache_sizes=None,
+    bint assume_short_ts=False,
+    int timestep_block=1,
+    object output_sink=None,
+    object output_idx=None,
+    object topology=None,
+    object wbody_idx=None,
+    object wbody_cols=None,
+    object wbody_vals=None,
+    object reach_types=None,
+    bint warm_start=False,
+    bint return_iterations=False,
+    object qlat_provider=None,
+    object restart_sink=None,
+    object restart_timesteps=None):
     """
-    Compute network
+    Compute network, routing reaches of the same level concurrently.
     Args:
         nsteps (int): number of time steps
-        reaches (list): List of reaches
-        connections (dict): Network
+        reaches (list): List of reaches (may be None if topology is given)
+        connections (dict): Network (may be None if topology is given)
         data_idx (ndarray): a 1D sorted index for data_values
         data_values (ndarray): a 2D array of data inputs (nodes x variables)
         qlats (ndarray): a 2D array of qlat values (nodes x nsteps). The index must be shared with data_values
         initial_conditions (ndarray): an n x 3 array of initial conditions. 
+        reach_groups (ndarray): number of reaches in each group. Reaches must be ordered by group
+            and each group may only depend on preceding groups (a ValueError is raised
+            otherwise). If None, reaches are grouped by troute.nhd_network.reach_levels.
+        reach_group_cache_sizes (ndarray): number of segments in each group (optional, checked
+            against reaches)
         assume_short_ts (bool): Assume short time steps (quc = qup)
+        timestep_block (int): number of timesteps each reach is routed over before moving
+            downstream (see compute_network)
+        output_sink (object): receives completed timesteps (see compute_network)
+        output_idx (ndarray): segments to record (see compute_network)
+        topology (ReachTopology): the prebuilt reach structure (see compute_network)
+        wbody_idx, wbody_cols, wbody_vals, reach_types: waterbodies routed as level pools
+            (see compute_network). reach_types follows reaches.
+        warm_start (bool): Warm start the secant solver (see compute_network)
+        return_iterations (bool): Also return secant iteration counts (see compute_network)
+        qlat_provider (QlatProvider): reads qlat as the computation advances (see compute_network)
+        restart_sink, restart_timesteps: emit the state of every segment (see compute_network)
     Notes:
         Array dimensions are checked as a precondition to this method.
+        The reach groups are computed with prange; set OMP_NUM_THREADS to limit the number of threads.
+        The level pool reaches of a group are routed after its channel reaches, all of them in one
+        reservoir.compute_reservoirs call per timestep.
     """
     # Check shapes
-    if qlat_values.shape[0] != data_idx.shape[0]:
-        raise ValueError(f"Number of rows in Qlat is incorrect: expected ({data_idx.shape[0]}), got ({qlat_values.shape[0]})")
-    if qlat_values.shape[1] > nsteps:
-        raise ValueError(f"Number of columns (timesteps) in Qlat is incorrect: expected at most ({data_idx.shape[0]}), got ({qlat_values.shape[0]}). The number of columns in Qlat must be equal to or less than the number of routing timesteps")
+    cdef int nqlat
+    nqlat, qlat_rows = check_qlat(data_idx, nsteps, qlat_values, qlat_provider)
+    restart_steps = restart_timestep_array(restart_timesteps, nsteps)
     if data_values.shape[0] != data_idx.shape[0] or data_values.shape[1] != data_cols.shape[0]:
         raise ValueError(f"data_values shape mismatch")
-    
-    cdef float[:,::1] flowveldepth = np.zeros((data_idx.shape[0], nsteps * 3), dtype='float32')
-    
-    cdef:
-        Py_ssize_t[:] srows  # Source rows indexes
-        Py_ssize_t[:] drows_tmp
-    
-    # hard-coded column. Find a better way to do this
-    cdef int buf_cols = 13
-    
-    # Buffers and buffer views
-    # These are C-contiguous.
-    cdef float[:, ::1] buf, buf_view
-    cdef float[:, ::1] out_buf, out_view
-    cdef int maxgrouplen = max(reach_group_cache_sizes)
-    buf = np.empty((maxgrouplen, buf_cols), dtype='float32')
-    out_buf = np.empty((maxgrouplen, 3), dtype='float32')
-    
-    # Source columns
-    cdef Py_ssize_t[:] scols = np.array(column_mapper(data_cols), dtype=np.intp)
+    if timestep_block < 1:
+        raise ValueError(f"timestep_block must be positive, got ({timestep_block})")
 
-    cdef:
-        Py_ssize_t i  # Temporary variable
-        Py_ssize_t ireach  # current reach index
-        Py_ssize_t ireach_cache  # current index of reach cache
-        Py_ssize_t iusreach_cache  # current index of upstream reach cache
+    cdef bint keep_all = output_sink is None and output_idx is None
+    cdef int nslots = nsteps if keep_all else timestep_block + 1
+    cdef float[:,::1] flowveldepth = np.zeros((data_idx.shape[0], nslots * 3), dtype='float32')
 
-    # Measure length of all the reaches
-    cdef list reach_sizes = list(map(len, reaches))
-    # For a given reach, get number of upstream nodes
-    cdef list usreach_sizes = [len(connections.get(reach[0], ())) for reach in reaches]
+    cdef Py_ssize_t[::1] out_rows
+    out_idx, out_rows = select_output_rows(data_idx, output_idx)
+    cdef float[:, ::1] output = flowveldepth
+    cdef bint record_output = not keep_all and output_sink is None
+    if record_output:
+        output = np.zeros((out_rows.shape[0], nsteps * 3), dtype='float32')
 
-    cdef:
-        list reach  # Temporary variable
-        list bf_results  # Temporary variable
+    # qlat, qdp, velp, depthp, depthpp
+    cdef int buf_cols = 5
 
-    cdef int reachlen, usreachlen
-    cdef int prevreachlen
-    cdef Py_ssize_t bidx
+    boundary_idx, (reach_offsets, reach_rows, usreach_offsets, usreach_rows) = topology_cache(
+        topology, reaches, connections, data_idx)
+    if boundary_idx is not None:
+        raise ValueError("compute_network_multithread does not support boundary segments")
+
+    reach_types, reach_lakes, lake_params = build_lake_store(data_idx, reach_offsets, reach_rows,
+        wbody_idx, wbody_cols, wbody_vals, reach_types)
+
+    if reach_groups is None:
+        if reaches is None or connections is None:
+            raise ValueError("reach_groups are required without reaches and connections")
+        from troute import nhd_network
+        levels = nhd_network.reach_levels(reaches, connections)
+        order = levels.reach_ids
+        group_sizes = levels.widths
+        # Regroup the cache so reaches of each level are contiguous
+        reach_offsets, reach_rows = take_offsets(reach_offsets, reach_rows, order)
+        usreach_offsets, usreach_rows = take_offsets(usreach_offsets, usreach_rows, order)
+        reach_types = reach_types[order]
+        reach_lakes = reach_lakes[order]
+    else:
+        group_sizes = np.asarray(reach_groups)
+        check_reach_groups(group_sizes, reach_offsets, reach_rows, usreach_offsets, usreach_rows)
+        if reach_group_cache_sizes is not None:
+            group_ends = np.cumsum(group_sizes)
+            if not np.array_equal(np.asarray(reach_group_cache_sizes), np.diff(reach_offsets[np.concatenate(([0], group_ends))])):
+                raise ValueError("reach_group_cache_sizes do not agree with reaches")
+
+    # The level pool reaches of a group are routed together after its channel reaches
+    ngroups = len(group_sizes)
+    reach_group = np.repeat(np.arange(ngroups), group_sizes)
+    order = np.lexsort((reach_types == REACH_LEVELPOOL, reach_group))
+    reach_offsets, reach_rows = take_offsets(reach_offsets, reach_rows, order)
+    usreach_offsets, usreach_rows = take_offsets(usreach_offsets, usreach_rows, order)
+    reach_types = reach_types[order]
+    reach_lakes = reach_lakes[order]
+    lake_reaches = np.flatnonzero(reach_types == REACH_LEVELPOOL)
+    group_lakes = np.bincount(reach_group[lake_reaches], minlength=ngroups)
+    lake_rows = np.ascontiguousarray(reach_rows[reach_offsets[lake_reaches]])
+    lake_usoffsets, lake_usrows = take_offsets(usreach_offsets, usreach_rows, lake_reaches)
 
     cdef:
-        Py_ssize_t[:] reach_cache
-        Py_ssize_t[:] usreach_cache
-        Py_ssize_t[:] ireach_cache_array
-        Py_ssize_t[:] iusreach_cache_array
-
-    # reach cache is ordered 1D view of reaches
-    # [-len, item, item, item, -len, item, item, -len, item, item, ...]
-    reach_cache = np.empty(sum(reach_sizes) + len(reach_sizes), dtype=np.intp)
-    # upstream reach cache is ordered 1D view of reaches
-    # [-len, item, item, item, -len, item, item, -len, item, item, ...]
-    usreach_cache = np.empty(sum(usreach_sizes) + len(usreach_sizes), dtype=np.intp)
-    
-    # ireach_cache_array
-    ireach_cache_array = np.empty(len(reach_sizes), dtype=np.intp)
-    iusreach_cache_array = np.empty(len(reach_sizes), dtype=np.intp)
-
-    ireach_cache = 0
-    iusreach_cache = 0
-    
-    ireach_cache_array[0] = 0
-    iusreach_cache_array[0] = 0
-    # copy reaches into an array
-    for ireach in range(len(reaches)):
-        reachlen = reach_sizes[ireach]
-        usreachlen = usreach_sizes[ireach]
-        reach = reaches[ireach]
-
-        # set the length (must be negative to indicate reach boundary)
-        reach_cache[ireach_cache] = -reachlen
-        ireach_cache += 1
-        bf_results = binary_find(data_idx, reach)
-        for bidx in bf_results:
-            reach_cache[ireach_cache] = bidx
-            ireach_cache += 1
-
-        usreach_cache[iusreach_cache] = -usreachlen
-        iusreach_cache += 1
-        if usreachlen > 0:
-            for bidx in binary_find(data_idx, connections[reach[0]]):
-                usreach_cache[iusreach_cache] = bidx
-                iusreach_cache += 1
-                
-        if ireach < max(range(len(reaches))):
-            ireach_cache_array[ireach+1] = ireach_cache
-            iusreach_cache_array[ireach+1] = iusreach_cache
-
-    drows_tmp = np.arange(maxgrouplen, dtype=np.intp)
-    
-    cdef Py_ssize_t[:] drows
-    cdef int timestep = 0
-    cdef int ts_offset
-
-    cdef int maxgroupsize = max(reach_groups)
-    cdef float[:] qu_buf = np.empty(maxgroupsize, dtype = "float32")
-    cdef float[:] quc_view 
-    cdef float[:] qup_view
-    cdef float quc, qup
-    cdef int qu_idx
-    cdef int buf_idx
-    cdef Py_ssize_t[:] srowsgroup_buf = np.empty(maxgrouplen, dtype = np.intp)
-    cdef int srows_idx
-    
+        Py_ssize_t[::1] roffsets = reach_offsets
+        Py_ssize_t[::1] rrows = reach_rows
+        Py_ssize_t[::1] usoffsets = usreach_offsets
+        Py_ssize_t[::1] usrows = usreach_rows
+        Py_ssize_t[::1] group_offsets = np.concatenate(([0], np.cumsum(group_sizes))).astype(np.intp)
+        # channel reaches of group g are [group_offsets[g], channel_ends[g])
+        Py_ssize_t[::1] channel_ends = (np.cumsum(group_sizes) - group_lakes).astype(np.intp)
+        Py_ssize_t[::1] lake_offsets = np.concatenate(([0], np.cumsum(group_lakes))).astype(np.intp)
+        Py_ssize_t[::1] lrows = lake_rows
+        Py_ssize_t[::1] lusoffsets = lake_usoffsets
+        Py_ssize_t[::1] lusrows = lake_usrows
+        float[::1] lake_dt = build_parameter_store(data_values, data_cols, lake_rows)[0]
+        float[:, ::1] lake_store = np.ascontiguousarray(lake_params[reach_lakes[lake_reaches]])
+        float[:, ::1] lake_inflows = np.zeros((4, len(lake_reaches)), dtype='float32')
+        float[:, ::1] lake_out = np.zeros((len(lake_reaches), 2), dtype='float32')
+        float[:, ::1] params = build_parameter_store(data_values, data_cols, reach_rows)
+        unsigned char[::1] rtypes = reach_types
+        Py_ssize_t[::1] rlakes = reach_lakes
+        float[:, ::1] lparams = lake_params
+
+    # Each reach owns the rows [roffsets[r], roffsets[r + 1]) of the buffers,
+    # so reaches in a group never share buffer space.
+    cdef float[:, ::1] buf = np.empty((rrows.shape[0], buf_cols), dtype='float32')
+    cdef float[:, ::1] out_buf = np.empty((rrows.shape[0], 4), dtype='float32')
+    # reaches in a group never share rows either
+    cdef long[::1] iterations = np.zeros(data_idx.shape[0] if return_iterations else 0, dtype=np.int64)
+
+    cdef const float[:, ::1] no_boundary_flows = np.zeros((0, nsteps + 1), dtype='float32')
     cdef:
-        Py_ssize_t istart  
-        Py_ssize_t iend
-        int r
-    
-    with nogil:
-        while timestep < nsteps:
-            ts_offset = timestep * 3
-
-            istart = 0
-            iend = -1
-            for group_i in range(len(reach_group_cache_sizes)):
-                
-                # index of final reach entry in reach_cache for this group
-                iend += reach_groups[group_i]
-                
-                # prepare group buffers
-                buf_view = buf[:reach_group_cache_sizes[group_i],:]
-                out_view = out_buf[:reach_group_cache_sizes[group_i],:]
-                quc_view = qu_buf[:reach_groups[group_i]]
-                qup_view = qu_buf[:reach_groups[group_i]]
-                srows = srowsgroup_buf[:reach_group_cache_sizes[group_i]]
-                drows = drows_tmp[:reach_group_cache_sizes[group_i]]
-                
-                # extract upstream flows and populate srows
-                qu_idx = 0
-                srows_idx = 0
-                for r in range(istart,iend+1):
-                    
-                    ireach_cache = ireach_cache_array[r]
-                    iusreach_cache = iusreach_cache_array[r]
-                    reachlen = -reach_cache[ireach_cache]
-                    usreachlen = -usreach_cache[iusreach_cache]
-                    iusreach_cache += 1
-                    ireach_cache += 1
-                    
-                    quc = 0.0
-                    qup = 0.0
-                    for i in range(usreachlen):
-                        quc = quc + flowveldepth[usreach_cache[iusreach_cache + i], ts_offset]
-                        if timestep > 0:
-                            qup += flowveldepth[usreach_cache[iusreach_cache + i], ts_offset - 3]
-                        else:
-                            qup += initial_conditions[usreach_cache[iusreach_cache + i],1]
-                            
-                    quc_view[qu_idx] = quc
-                    qup_view[qu_idx] = qup
-                    qu_idx += 1
-                    
-                    # build srows
-                    for i in range(reachlen):
-                        srows[srows_idx] = reach_cache[ireach_cache + i]
-                        srows_idx += 1
-                             
-                # fill buf_view with qlat, parameter and initial conditions data
-                # qlats    
-                fill_buffer_column(srows, 
-                           int(timestep/(nsteps/qlat_values.shape[1])),
-                           drows, 
-                           0, 
-                           qlat_values, 
-                           buf_view)
-            
-                # parameters
-                for i in range(scols.shape[0]):
-                    fill_buffer_column(srows, scols[i], drows, i + 1, data_values, buf_view)
-
-                # initial conditions
-                if timestep > 0:
-                    fill_buffer_column(srows, ts_offset - 3, drows, 10, flowveldepth, buf_view)
-                    fill_buffer_column(srows, ts_offset - 2, drows, 11, flowveldepth, buf_view)
-                    fill_buffer_column(srows, ts_offset - 1, drows, 12, flowveldepth, buf_view)
-                else:
-                    for i in range(drows.shape[0]):
-                        buf_view[drows[i], 10] = initial_conditions[srows[i],1]
-                        buf_view[drows[i], 11] = 0.0
-                        buf_view[drows[i], 12] = initial_conditions[srows[i],2]
-                
+        int tstart = 0
+        int tend
+        int qlat_offset = 0
+        const float[:, :] qlats = qlat_values
+        Py_ssize_t igroup, r, gstart, gend, lstart, lend
+
+    while tstart < nsteps:
+        tend = min(tstart + timestep_block, nsteps)
+        if qlat_provider is not None:
+            qlat_offset, qlats = read_qlat_block(qlat_provider, qlat_rows, nsteps, nqlat, tstart, tend)
+        with nogil:
+            for igroup in range(group_offsets.shape[0] - 1):
+                gstart = group_offsets[igroup]
+                gend = channel_ends[igroup]
                 # ------ !!!!! MULTITHREAD LOOP !!!!! ------ #
-                # compute each reach
-                for r in prange(istart,iend+1):
-                    
-                    # reach length for reach r of group
-                    ireach_cache = ireach_cache_array[r]
-                    reachlen = -reach_cache[ireach_cache]
-                    
-                    # total reach length of reaches preceeding reach r in group
-                    if r > istart:
-                        prevreachlen = 0
-                        for i in range((r-istart)):
-                            prevreachlen = prevreachlen + -reach_cache[ireach_cache_array[(r-(i+1))]]
-                    else:
-                        prevreachlen = 0
-                            
-                    # compute reach routing
-                    if assume_short_ts:    
-                        compute_reach_kernel(qup_view[r-istart], 
-                                             quc_view[r-istart], # quc = qup
-                                             reachlen, 
-                                             buf_view[prevreachlen:prevreachlen+reachlen,:],
-                                             out_view[prevreachlen:prevreachlen+reachlen,:],
-                                             assume_short_ts)
-                        
-                    else:
-                        compute_reach_kernel(qup_view[r-istart], 
-                                             quc_view[r-istart], 
-                                             reachlen, 
-                                             buf_view[prevreachlen:prevreachlen+reachlen,:],
-                                             out_view[prevreachlen:prevreachlen+reachlen,:],
-                                             assume_short_ts)
+                for r in prange(gstart, gend, schedule='dynamic'):
+                    compute_reach_timesteps(tstart,
+                        tend,
+                        nsteps,
+                        nslots,
+                        rrows[roffsets[r]:roffsets[r + 1]],
+                        usrows[usoffsets[r]:usoffsets[r + 1]],
+                        no_boundary_flows,
+                        params[:, roffsets[r]:roffsets[r + 1]],
+                        qlats,
+                        nqlat,
+                        qlat_offset,
+                        initial_conditions,
+                        flowveldepth,
+                        buf[roffsets[r]:roffsets[r + 1]],
+                        out_buf[roffsets[r]:roffsets[r + 1]],
+                        assume_short_ts,
+                        rtypes[r],
+                        lparams[rlakes[r]],
+                        warm_start,
+                        iterations)
                 # END ------ !!!!! MULTITHREAD LOOP !!!!! ------ #
-                        
-                        
-                # place out_view results into flowveldepth
-                for i in range(3):
-                    fill_buffer_column(drows, i, srows, ts_offset + i, out_view, flowveldepth)
-                
-                    
-                istart = istart + reach_groups[group_i]
-                
-            timestep += 1
-
-    return np.asarray(data_idx, dtype=np.intp), np.asarray(flowveldepth, dtype='float32')
\ No newline at end of file
+                lstart = lake_offsets[igroup]
+                lend = lake_offsets[igroup + 1]
+                if lend > lstart:
+                    compute_levelpool_timesteps(tstart,
+                        tend,
+                        nsteps,
+                        nslots,
+                        lrows[lstart:lend],
+                        lusoffsets[lstart:lend + 1],
+                        lusrows,
+                        lake_dt[lstart:lend],
+                        lake_store[lstart:lend],
+                        qlats,
+                        nqlat,
+                        qlat_offset,
+                        initial_conditions,
+                        flowveldepth,
+                        lake_inflows[:, lstart:lend],
+                        lake_out[lstart:lend],
+                        assume_short_ts)
+            if record_output:
+                copy_output_rows(flowveldepth, out_rows, output, tstart, tend, nslots)
+        if output_sink is not None:
+            write_output_block(output_sink, out_idx, out_rows, flowveldepth, tstart, tend, nslots)
+        if restart_sink is not None:
+            for t in restart_steps[(restart_steps >= tstart) & (restart_steps < tend)]:
+                write_restart_state(restart_sink, data_idx, flowveldepth, roffsets, rrows,
+                    usoffsets, usrows, no_boundary_flows, t, nslots)
+        tstart = tend
+
+    return network_result(out_idx, None if output_sink is not None else output, out_rows,
+        iterations if return_iterations else None)
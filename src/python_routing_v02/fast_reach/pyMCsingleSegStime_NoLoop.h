@@ -15,4 +15,25 @@ extern void c_muskingcungenwm(float *dt,
                               float *depthp,
                               float *qdc,
                               float *velc,
-                              float *depthc);
\ No newline at end of file
+                              float *depthc);
+extern void c_muskingcungenwm_warm(float *dt,
+                                   float *qup,
+                                   float *quc,
+                                   float *qdp,
+                                   float *ql,
+                                   float *dx,
+                                   float *bw,
+                                   float *tw,
+                                   float *twcc,
+                                   float *n,
+                                   float *ncc,
+                                   float *cs,
+                                   float *s0,
+                                   float *velp,
+                                   float *depthp,
+                                   float *depthpp,
+                                   int *warm_start,
+                                   float *qdc,
+                                   float *velc,
+                                   float *depthc,
+                                   int *iters);
@@ -2,6 +2,7 @@ cdef struct QVD:
     float qdc
     float velc
     float depthc
+    int iters
 
 
 cdef void muskingcunge(float dt,
@@ -21,6 +22,25 @@ cdef void muskingcunge(float dt,
         float depthp,
         QVD *rv) nogil
 
+cdef void muskingcunge_warm(float dt,
+        float qup,
+        float quc,
+        float qdp,
+        float ql,
+        float dx,
+        float bw,
+        float tw,
+        float twcc,
+        float n,
+        float ncc,
+        float cs,
+        float s0,
+        float velp,
+        float depthp,
+        float depthpp,
+        bint warm_start,
+        QVD *rv) nogil
+
 cpdef float[:,:] compute_reach(const float[:] boundary,
                                 const float[:,:] previous_state,
                                 const float[:,:] parameter_inputs,
@@ -1,6 +1,6 @@
 import cython
 
-from fortran_wrappers cimport c_muskingcungenwm
+from fortran_wrappers cimport c_muskingcungenwm_warm
 
 @cython.boundscheck(False)
 cdef void muskingcunge(float dt,
@@ -19,12 +19,41 @@ cdef void muskingcunge(float dt,
         float velp,
         float depthp,
         QVD *rv) nogil:
+    muskingcunge_warm(dt, qup, quc, qdp, ql, dx, bw, tw, twcc, n, ncc, cs, s0,
+        velp, depthp, depthp, False, rv)
+
+@cython.boundscheck(False)
+cdef void muskingcunge_warm(float dt,
+        float qup,
+        float quc,
+        float qdp,
+        float ql,
+        float dx,
+        float bw,
+        float tw,
+        float twcc,
+        float n,
+        float ncc,
+        float cs,
+        float s0,
+        float velp,
+        float depthp,
+        float depthpp,
+        bint warm_start,
+        QVD *rv) nogil:
+    """
+    muskingcunge that also returns the number of secant iterations in rv.iters.
+    With warm_start, the secant is seeded from the depth trend of depthpp (the
+    depth of the timestep before depthp) and depthp instead of from depthp alone.
+    """
     cdef:
         float qdc = 0.0
         float depthc = 0.0
         float velc = 0.0
+        int warm = warm_start
+        int iters = 0
 
-    c_muskingcungenwm(
+    c_muskingcungenwm_warm(
         &dt,
         &qup,
         &quc,
@@ -40,12 +69,16 @@ cdef void muskingcunge(float dt,
         &s0,
         &velp,
         &depthp,
+        &depthpp,
+        &warm,
         &qdc,
         &velc,
-        &depthc)
+        &depthc,
+        &iters)
     rv.qdc = qdc
     rv.depthc = depthc
     rv.velc = velc
+    rv.iters = iters
 
 cpdef dict compute_reach_kernel(float dt,
         float qup,
@@ -61,12 +94,14 @@ cpdef dict compute_reach_kernel(float dt,
         float cs,
         float s0,
         float velp,
-        float depthp):
+        float depthp,
+        float depthpp=0.0,
+        bint warm_start=False):
 
     cdef QVD rv
     cdef QVD *out = &rv
 
-    muskingcunge(
+    muskingcunge_warm(
         dt,
         qup,
         quc,
@@ -82,6 +117,8 @@ cpdef dict compute_reach_kernel(float dt,
         s0,
         velp,
         depthp,
+        depthpp,
+        warm_start,
         out)
 
     return rv
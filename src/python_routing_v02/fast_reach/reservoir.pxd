@@ -22,3 +22,12 @@ cpdef float[:,:] compute_reservoir(const float[:] boundary,
                                     const float[:,:] previous_state,
                                     const float[:,:] parameter_inputs,
                                     float[:,:] output_buffer) nogil
+
+cpdef float[:,:] compute_reservoirs(const float[:] dt,
+                                     const float[:] qi0,
+                                     const float[:] qi1,
+                                     const float[:] ql,
+                                     const float[:,:] parameter_inputs,
+                                     const float[:] H0,
+                                     float[:,:] output_buffer,
+                                     bint parallel=*) nogil
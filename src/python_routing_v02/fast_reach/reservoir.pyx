@@ -1,4 +1,5 @@
 import cython
+from cython.parallel import prange
 
 from fortran_wrappers cimport c_levelpool_physics
 
@@ -174,3 +175,80 @@ cpdef float[:,:] compute_reservoir(const float[:] boundary,
         output_buffer[i, 1] = out.resoutflow
 
     return output_buffer
+
+
+@cython.boundscheck(False)
+cpdef float[:,:] compute_reservoirs(const float[:] dt,
+                                     const float[:] qi0,
+                                     const float[:] qi1,
+                                     const float[:] ql,
+                                     const float[:,:] parameter_inputs,
+                                     const float[:] H0,
+                                     float[:,:] output_buffer,
+                                     bint parallel=False) nogil:
+    """
+    Compute many independent reservoirs over one timestep
+
+    Arguments:
+        dt: routing period of each reservoir
+        qi0, qi1: inflow of each reservoir at the previous and current timestep
+        ql: lateral inflow of each reservoir
+        parameter_inputs: Parameterization of each reservoir.
+            ar,we,maxh,wc,wl,dl,oe,oc,oa
+            (LkArea, WeirE, LkMxE, WeirC, WeirL, DamL, OrificeE, OrificeC, OrificeA)
+        H0: water elevation of each reservoir at the previous timestep
+        output_buffer: Current state of each reservoir [H1, qo1]
+        parallel: route the reservoirs concurrently with prange
+    """
+    cdef Py_ssize_t i, rows = H0.shape[0]
+
+    # check that all inputs have the same axis 0
+    if (dt.shape[0] != rows or qi0.shape[0] != rows or qi1.shape[0] != rows or ql.shape[0] != rows
+            or parameter_inputs.shape[0] != rows or output_buffer.shape[0] != rows):
+        raise ValueError("axis 0 of input arguments do not agree")
+
+    # check bounds
+    if parameter_inputs.shape[1] < 9:
+        raise IndexError
+    if output_buffer.shape[1] < 2:
+        raise IndexError
+
+    if parallel:
+        for i in prange(rows, schedule='static'):
+            compute_reservoir_row(dt, qi0, qi1, ql, parameter_inputs, H0, output_buffer, i)
+    else:
+        for i in range(rows):
+            compute_reservoir_row(dt, qi0, qi1, ql, parameter_inputs, H0, output_buffer, i)
+
+    return output_buffer
+
+
+@cython.boundscheck(False)
+cdef inline void compute_reservoir_row(const float[:] dt,
+                                       const float[:] qi0,
+                                       const float[:] qi1,
+                                       const float[:] ql,
+                                       const float[:,:] parameter_inputs,
+                                       const float[:] H0,
+                                       float[:,:] output_buffer,
+                                       Py_ssize_t i) nogil:
+    cdef QH rv
+
+    levelpool_physics(dt[i],
+        qi0[i],
+        qi1[i],
+        ql[i],
+        parameter_inputs[i, 0],
+        parameter_inputs[i, 1],
+        parameter_inputs[i, 2],
+        parameter_inputs[i, 3],
+        parameter_inputs[i, 4],
+        parameter_inputs[i, 5],
+        parameter_inputs[i, 6],
+        parameter_inputs[i, 7],
+        parameter_inputs[i, 8],
+        H0[i],
+        &rv)
+
+    output_buffer[i, 0] = rv.reslevel
+    output_buffer[i, 1] = rv.resoutflow
@@ -21,15 +21,23 @@ reach = Extension("reach",
         sources = ["fast_reach/reach.{}".format(ext)],
         extra_objects = ['fast_reach/mc_single_seg.o', 'fast_reach/pymc_single_seg.o' ])
 
+reservoir = Extension("reservoir",
+        sources = ["fast_reach/reservoir.{}".format(ext)],
+        extra_objects = ['fast_reach/module_levelpool.o', 'fast_reach/pymodule_levelpool.o'],
+        extra_compile_args=['-fopenmp'],
+        extra_link_args=['-fopenmp'])
+
 mc_reach = Extension("mc_reach",
           sources = ["fast_reach/mc_reach.{}".format(ext)],
           include_dirs = [np.get_include()],
           libraries=[],
           library_dirs=[],
-          extra_objects=[])
+          extra_objects=[],
+          extra_compile_args=['-fopenmp'],
+          extra_link_args=['-fopenmp'])
 
 ext_modules=[
-    reach, mc_reach
+    reach, reservoir, mc_reach
     ]
 
 if USE_CYTHON:
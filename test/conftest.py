@@ -0,0 +1,74 @@
+import glob
+import pathlib
+import sys
+from functools import partial
+
+import numpy as np
+import pytest
+
+root = pathlib.Path(__file__).resolve().parents[1]
+# compiled extensions on PYTHONPATH (e.g. a build directory) take precedence
+sys.path.append(str(root.joinpath("src", "python_framework_v02")))
+sys.path.append(str(root.joinpath("src", "python_routing_v02")))
+
+pocono_folder = root.joinpath(
+    "test", "input", "geo", "NWM_2.1_Sample_Datasets", "Pocono_TEST1"
+)
+pocono_columns = {
+    "key": "link",
+    "downstream": "to",
+    "dx": "Length",
+    "n": "n",
+    "ncc": "nCC",
+    "s0": "So",
+    "bw": "BtmWdth",
+    "tw": "TopWdth",
+    "twcc": "TopWdthCC",
+    "cs": "ChSlp",
+}
+param_cols = ["dt", "bw", "tw", "twcc", "dx", "n", "ncc", "cs", "s0"]
+
+
+@pytest.fixture(scope="session")
+def pocono_routelink():
+    return str(pocono_folder.joinpath("primary_domain", "DOMAIN", "Route_Link.nc"))
+
+
+@pytest.fixture(scope="session")
+def pocono_chrtout():
+    return sorted(glob.glob(str(pocono_folder.joinpath("example_CHRTOUT", "*CHRTOUT*"))))
+
+
+@pytest.fixture(scope="session")
+def pocono(pocono_routelink, pocono_chrtout):
+    """
+    Routing inputs of the Pocono_TEST1 sample domain: the RouteLink channels,
+    split into reaches at junctions, with the CHRTOUT lateral inflows.
+    """
+    from troute import nhd_io, nhd_network
+
+    param_df = nhd_io.read_routelink(pocono_routelink, pocono_columns)
+    param_df = nhd_io.replace_downstreams(param_df, "to", 0)
+    connections = nhd_network.extract_connections(param_df, "to")
+    rconn = nhd_network.reverse_network(connections)
+    reaches = []
+    for tw, net in nhd_network.reachable_network(rconn).items():
+        reaches.extend(
+            nhd_network.dfs_decomposition(
+                net, partial(nhd_network.split_at_junction, net)
+            )
+        )
+
+    param_df["dt"] = 300.0
+    param_df = param_df.rename(columns={v: k for k, v in pocono_columns.items()})
+    ql = nhd_io.get_ql_from_chrtout(pocono_chrtout, segments=param_df.index)
+    return dict(
+        connections=connections,
+        rconn=dict(rconn),
+        reaches=reaches,
+        data_idx=param_df.index.values.astype("int64"),
+        data_cols=np.array(param_cols, dtype=object),
+        data_values=param_df[param_cols].values.astype("float32"),
+        qlat_values=np.ascontiguousarray(ql.values, dtype="float32"),
+        initial_conditions=np.zeros((len(param_df), 3), dtype="float32"),
+    )
@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("mc_reach")
+import compute_nhd_routing_SingleSeg_v02 as routing
+from troute import nhd_network_utilities_v02 as nnu
+
+lakes = pd.DataFrame(
+    {
+        "LkArea": [1.5, 0.2],
+        "LkMxE": [12.0, 6.0],
+        "OrificeA": [1.0, 0.5],
+        "OrificeC": [0.1, 0.1],
+        "OrificeE": [8.0, 3.0],
+        "WeirC": [0.4, 0.4],
+        "WeirE": [10.0, 5.0],
+        "WeirL": [10.0, 4.0],
+    },
+    index=pd.Index([7, 3], name="lake_id"),
+)
+columns = nnu.set_supernetwork_data("Pocono_TEST1", geo_input_folder="")[
+    "waterbody_parameter_columns"
+]
+
+
+def dam_length(wbody):
+    return wbody["wbody_vals"][:, list(wbody["wbody_cols"]).index("dl")]
+
+
+def test_level_pool_parameters_dam_length():
+    wbody = routing.level_pool_parameters(lakes.assign(DamL=[50.0, 20.0]), columns)
+    assert wbody["wbody_idx"].tolist() == [7, 3]
+    assert sorted(wbody["wbody_cols"]) == sorted(
+        ["ar", "we", "maxh", "wc", "wl", "dl", "oe", "oc", "oa"]
+    )
+    np.testing.assert_array_equal(dam_length(wbody), [50.0, 20.0])
+
+
+def test_level_pool_parameters_without_dam_length():
+    wbody = routing.level_pool_parameters(lakes, columns)
+    np.testing.assert_array_equal(dam_length(wbody), [100.0, 40.0])
+
+
+def test_network_contiguous_rows():
+    index = np.array([1, 2, 3, 4, 5, 6, 7, 8])
+    reaches_bytw = {8: [[7, 8]], 6: [[1, 3, 4], [2], [5], [6]]}
+    rows, network_slices = routing.network_contiguous_rows(index, reaches_bytw)
+    assert index[rows].tolist() == [7, 8, 1, 2, 3, 4, 5, 6]
+    assert index[rows][network_slices[8]].tolist() == [7, 8]
+    assert index[rows][network_slices[6]].tolist() == [1, 2, 3, 4, 5, 6]
+
+
+def test_print_worker_times(capsys):
+    costs = {1: 6, 2: 3, 3: 1}
+    # batch [2] ran on the same thread as batch [1]
+    routing.print_worker_times(
+        costs, [[1], [2], [3]], [(6.0, 1234), (3.0, 1234), (1.0, 99)]
+    )
+    lines = capsys.readouterr().out.splitlines()
+    rows = [line.split() for line in lines[1:4]]
+    assert [row[2] for row in rows] == ["0", "0", "1"]
+    workers = [list(map(float, line.split())) for line in lines[5:]]
+    assert workers == [[0, 9.0, 9.0], [1, 1.0, 1.0]]
@@ -0,0 +1,172 @@
+import pickle
+
+import numpy as np
+import pytest
+
+mc_reach = pytest.importorskip("mc_reach")
+
+nsteps = 48
+
+
+def route(pocono, compute=None, **kwargs):
+    compute = compute or mc_reach.compute_network
+    args = dict(
+        data_idx=pocono["data_idx"],
+        data_cols=pocono["data_cols"],
+        data_values=pocono["data_values"],
+        qlat_values=pocono["qlat_values"],
+        initial_conditions=pocono["initial_conditions"],
+    )
+    args.update(kwargs)
+    return compute(nsteps, pocono["reaches"], pocono["rconn"], **args)
+
+
+@pytest.mark.parametrize("timestep_block", [2, 5, 7, nsteps])
+def test_timestep_blocks_are_identical(pocono, timestep_block):
+    _, expected = route(pocono)
+    _, flowveldepth = route(pocono, timestep_block=timestep_block)
+    np.testing.assert_array_equal(flowveldepth, expected)
+
+
+def test_output_idx_with_timestep_blocks(pocono):
+    _, expected = route(pocono)
+    output_idx = pocono["data_idx"][::5]
+    out_idx, flowveldepth = route(pocono, timestep_block=7, output_idx=output_idx)
+    np.testing.assert_array_equal(out_idx, output_idx)
+    np.testing.assert_array_equal(flowveldepth, expected[::5])
+
+
+@pytest.mark.parametrize("timestep_block", [1, 7])
+def test_multithread_matches_compute_network(pocono, timestep_block):
+    _, expected = route(pocono)
+    _, flowveldepth = route(
+        pocono,
+        mc_reach.compute_network_multithread,
+        timestep_block=timestep_block,
+    )
+    np.testing.assert_array_equal(flowveldepth, expected)
+
+
+def reach_groups(pocono):
+    """
+    Reaches ordered by their level in the network and the number of reaches
+    in each level.
+    """
+    level = {}
+    for reach in pocono["reaches"]:
+        level[reach[-1]] = 1 + max(
+            (level[us] for us in pocono["rconn"].get(reach[0], ())), default=-1
+        )
+    ordered = sorted(pocono["reaches"], key=lambda r: level[r[-1]])
+    sizes = np.bincount([level[r[-1]] for r in ordered]).astype("int32")
+    return ordered, sizes
+
+
+def test_multithread_reach_groups(pocono):
+    _, expected = route(pocono)
+    reaches, sizes = reach_groups(pocono)
+    pocono = dict(pocono, reaches=reaches)
+    _, flowveldepth = route(
+        pocono, mc_reach.compute_network_multithread, reach_groups=sizes
+    )
+    np.testing.assert_array_equal(flowveldepth, expected)
+
+
+def test_multithread_rejects_unordered_reach_groups(pocono):
+    reaches, sizes = reach_groups(pocono)
+    pocono = dict(pocono, reaches=reaches)
+    # the first reach of level 1 moved into the headwater group
+    merged = sizes.copy()
+    merged[0] += 1
+    merged[1] -= 1
+    with pytest.raises(ValueError, match="depends on a reach"):
+        route(pocono, mc_reach.compute_network_multithread, reach_groups=merged)
+    with pytest.raises(ValueError, match="sum"):
+        route(pocono, mc_reach.compute_network_multithread, reach_groups=sizes[1:])
+
+
+def test_multithread_levelpool_matches_compute_network(pocono):
+    # single segment reaches below a junction become level pool reservoirs
+    lakes = np.array(
+        sorted(
+            r[0]
+            for r in pocono["reaches"]
+            if len(r) == 1 and len(pocono["rconn"].get(r[0], ())) > 1
+        ),
+        dtype="int64",
+    )
+    assert len(lakes) > 1
+    wbody_cols = np.array(["ar", "we", "maxh", "wc", "wl", "dl", "oe", "oc", "oa"])
+    wbody_vals = np.tile(
+        np.array([1.5, 10.0, 12.0, 0.4, 10.0, 100.0, 8.0, 0.1, 1.0], dtype="float32"),
+        (len(lakes), 1),
+    )
+    initial_conditions = pocono["initial_conditions"].copy()
+    initial_conditions[np.searchsorted(pocono["data_idx"], lakes), 2] = 10.5
+    kwargs = dict(
+        initial_conditions=initial_conditions,
+        wbody_idx=lakes,
+        wbody_cols=wbody_cols,
+        wbody_vals=wbody_vals,
+    )
+    _, expected = route(pocono, **kwargs)
+    lake_rows = np.searchsorted(pocono["data_idx"], lakes)
+    assert (expected[lake_rows, ::3] > 0).all()
+    for timestep_block in (1, 7):
+        _, flowveldepth = route(
+            pocono,
+            mc_reach.compute_network_multithread,
+            timestep_block=timestep_block,
+            **kwargs,
+        )
+        np.testing.assert_array_equal(flowveldepth, expected)
+
+
+def test_data_column_order(pocono):
+    # parameters are gathered by name into the parameter store
+    _, expected = route(pocono)
+    order = np.arange(len(pocono["data_cols"]))[::-1]
+    _, flowveldepth = route(
+        pocono,
+        data_cols=pocono["data_cols"][order],
+        data_values=np.ascontiguousarray(pocono["data_values"][:, order]),
+    )
+    np.testing.assert_array_equal(flowveldepth, expected)
+
+
+def test_prebuilt_topology(pocono):
+    _, expected = route(pocono)
+    topology = mc_reach.build_topology(
+        pocono["reaches"], pocono["rconn"], pocono["data_idx"]
+    )
+    topology = pickle.loads(pickle.dumps(topology))
+    assert topology.nreaches == len(pocono["reaches"])
+    _, flowveldepth = mc_reach.compute_network(
+        nsteps,
+        None,
+        None,
+        pocono["data_idx"],
+        pocono["data_cols"],
+        pocono["data_values"],
+        pocono["qlat_values"],
+        pocono["initial_conditions"],
+        topology=topology,
+    )
+    np.testing.assert_array_equal(flowveldepth, expected)
+
+    with pytest.raises(ValueError, match="different data_idx"):
+        topology.check(pocono["data_idx"][1:])
+
+
+def test_warm_start(pocono):
+    _, expected, iterations = route(pocono, return_iterations=True)
+    _, flowveldepth, warm_iterations = route(
+        pocono, warm_start=True, return_iterations=True
+    )
+    # a different seed of the secant converges within its stopping tolerance
+    assert not np.array_equal(flowveldepth, expected)
+    assert abs(flowveldepth[:, ::3].sum() / expected[:, ::3].sum() - 1) < 0.05
+    assert warm_iterations.sum() < iterations.sum()
+    for compute in (mc_reach.compute_network, mc_reach.compute_network_multithread):
+        _, blocked = route(pocono, compute, warm_start=True, timestep_block=7)
+        np.testing.assert_array_equal(blocked, flowveldepth)
@@ -0,0 +1,314 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from troute import nhd_io
+
+
+@pytest.fixture(scope="module")
+def routed(pocono):
+    mc_reach = pytest.importorskip("mc_reach")
+
+    def route(**kwargs):
+        return mc_reach.compute_network(
+            48,
+            pocono["reaches"],
+            pocono["rconn"],
+            pocono["data_idx"],
+            pocono["data_cols"],
+            pocono["data_values"],
+            pocono["qlat_values"],
+            pocono["initial_conditions"],
+            **kwargs,
+        )
+
+    return route
+
+
+@pytest.mark.parametrize("suffix", [".npy", ".nc"])
+def test_file_output_sinks(pocono, routed, tmp_path, suffix):
+    _, expected = routed()
+    path = tmp_path / f"out{suffix}"
+    sink = nhd_io.get_output_sink(path, pocono["data_idx"], 48)
+    out_idx, flowveldepth = routed(output_sink=sink, timestep_block=5)
+    assert flowveldepth is None
+    np.testing.assert_array_equal(out_idx, pocono["data_idx"])
+    sink.close()
+    if suffix == ".npy":
+        np.testing.assert_array_equal(np.load(path), expected)
+        np.testing.assert_array_equal(
+            np.load(tmp_path / "out_index.npy"), pocono["data_idx"]
+        )
+    else:
+        import xarray as xr
+
+        with xr.open_dataset(path) as ds:
+            np.testing.assert_array_equal(ds.feature_id, pocono["data_idx"])
+            for i, name in enumerate(("flow", "velocity", "depth")):
+                np.testing.assert_array_equal(ds[name], expected[:, i::3])
+
+
+def test_selected_segments_output_sink(pocono, routed):
+    _, expected = routed()
+    segments = pocono["data_idx"][[40, 3, 17, 3]]
+    sink = nhd_io.SelectedSegmentsOutputSink(np.append(segments, -1), 48)
+    routed(output_sink=sink, timestep_block=7)
+    df = sink.to_dataframe()
+    assert df.index.tolist() == [-1] + sorted(set(segments.tolist()))
+    rows = np.searchsorted(pocono["data_idx"], df.index[1:])
+    np.testing.assert_array_equal(df.values[1:], expected[rows])
+    assert not df.values[0].any()
+
+
+def test_get_output_sink_rejects_unknown_types(tmp_path):
+    with pytest.raises(ValueError):
+        nhd_io.get_output_sink(tmp_path / "out.csv", np.arange(3), 2)
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "source.bin"
+    path.write_bytes(np.arange(100000, dtype="int64").tobytes())
+    return path
+
+
+def test_file_fingerprint_follows_contents(source, tmp_path):
+    fingerprint = nhd_io.file_fingerprint(source)
+    # copies and touched files are the same input
+    copy = tmp_path / "copy.bin"
+    shutil.copyfile(source, copy)
+    os.utime(copy, (0, 0))
+    assert nhd_io.file_fingerprint(copy) == fingerprint
+    # rewritten contents of the same size are not, wherever the edit is
+    data = bytearray(source.read_bytes())
+    for offset in (60001, len(data) - 1):
+        data[offset] ^= 1
+        source.write_bytes(bytes(data))
+        assert nhd_io.file_fingerprint(source) != fingerprint
+        fingerprint = nhd_io.file_fingerprint(source)
+
+    small = tmp_path / "small.bin"
+    small.write_bytes(b"abc")
+    before = nhd_io.file_fingerprint(small)
+    small.write_bytes(b"abd")
+    assert nhd_io.file_fingerprint(small) != before
+
+
+def test_frame_cache_round_trip(source, tmp_path):
+    df = pd.DataFrame(
+        {
+            "a": np.arange(5, dtype="float32"),
+            "b": np.arange(5, dtype="int64"),
+            "c": np.linspace(0, 1, 5),
+        },
+        index=pd.Index([5, 7, 9, 11, 13], name="link"),
+    )
+    cache = tmp_path / "cache"
+    path, fingerprint = nhd_io.frame_cache_path(cache, "param", [source], nts=12)
+    assert nhd_io.read_frame_cache(path, fingerprint) is None
+    nhd_io.write_frame_cache(path, fingerprint, df)
+    pd.testing.assert_frame_equal(nhd_io.read_frame_cache(path, fingerprint), df)
+
+    # single dtype frames are a view of the mapped block
+    single = df[["a"]]
+    nhd_io.write_frame_cache(path, fingerprint, single)
+    pd.testing.assert_frame_equal(nhd_io.read_frame_cache(path, fingerprint), single)
+
+    # other options are other entries
+    other, _ = nhd_io.frame_cache_path(cache, "param", [source], nts=24)
+    assert other != path
+
+
+def test_frame_cache_invalidation(source, tmp_path):
+    df = pd.DataFrame({"a": [1.0, 2.0]}, index=[1, 2])
+    path, fingerprint = nhd_io.frame_cache_path(tmp_path, "qlat", [source])
+    nhd_io.write_frame_cache(path, fingerprint, df)
+    source.write_bytes(b"rewritten")
+    same_path, new_fingerprint = nhd_io.frame_cache_path(tmp_path, "qlat", [source])
+    assert same_path == path
+    assert nhd_io.read_frame_cache(path, new_fingerprint) is None
+    assert not path.exists()
+
+
+def test_topology_cache_round_trip(source, tmp_path):
+    networks = {
+        4: {4: [3], 3: [1, 2], 2: [], 1: []},
+        6: {6: [4, 5], 5: []},
+        8: {8: [7], 7: []},
+    }
+    reaches_bytw = {4: [[1, 3, 4], [2]], 6: [[5], [6]], 8: [[7, 8]]}
+    path, fingerprint = nhd_io.topology_cache_path(
+        tmp_path, [source, None], break_at_waterbodies=False
+    )
+    assert nhd_io.read_topology_cache(path, fingerprint) is None
+    nhd_io.write_topology_cache(path, fingerprint, networks, reaches_bytw, {4: 6})
+    assert nhd_io.read_topology_cache(path, fingerprint) == (
+        networks,
+        reaches_bytw,
+        {4: 6},
+    )
+
+    other, _ = nhd_io.topology_cache_path(tmp_path, [source], break_at_waterbodies=True)
+    assert other != path
+
+
+def test_topology_cache_invalidation(source, tmp_path):
+    path, fingerprint = nhd_io.topology_cache_path(tmp_path, [source])
+    nhd_io.write_topology_cache(path, fingerprint, {2: {2: [1], 1: []}}, {2: [[1, 2]]})
+    assert nhd_io.read_topology_cache(path, fingerprint)[2] == {}
+    source.write_bytes(b"rewritten")
+    same_path, new_fingerprint = nhd_io.topology_cache_path(tmp_path, [source])
+    assert same_path == path
+    assert nhd_io.read_topology_cache(path, new_fingerprint) is None
+    assert not path.exists()
+
+
+def test_array_qlat_provider():
+    values = np.arange(20, dtype="float32").reshape(4, 5)
+    with nhd_io.ArrayQlatProvider([2, 4, 6, 8], values, window=2) as provider:
+        assert provider.shape == (4, 5)
+        rows = provider.find_rows([8, 3, 2])
+        assert rows.tolist() == [3, -1, 0]
+        # segments without lateral inflow get zeros
+        expected = np.array([[16, 17, 18, 19], [0, 0, 0, 0], [1, 2, 3, 4]])
+        np.testing.assert_array_equal(provider.columns(1, 5, rows), expected)
+        np.testing.assert_array_equal(provider.columns(4, 5, rows), expected[:, 3:])
+
+
+def test_chrtout_qlat_provider(pocono, pocono_chrtout):
+    segments = pocono["data_idx"][::-1]
+    ncols = len(pocono_chrtout) + 3
+    with nhd_io.ChrtoutQlatProvider(
+        pocono_chrtout[::-1], segments, window=5, ncols=ncols
+    ) as provider:
+        assert provider.shape == (len(segments), ncols)
+        rows = provider.find_rows(pocono["data_idx"])
+        values = np.hstack([provider.columns(t, t + 1, rows) for t in range(ncols)])
+    np.testing.assert_array_equal(
+        values[:, : len(pocono_chrtout)], pocono["qlat_values"]
+    )
+    assert not values[:, len(pocono_chrtout) :].any()
+
+
+def test_csv_qlat_provider(pocono, tmp_path):
+    path = tmp_path / "qlat.csv"
+    df = pd.DataFrame(pocono["qlat_values"], index=pocono["data_idx"])
+    df.iloc[::-1].to_csv(path)
+    with nhd_io.CsvQlatProvider(path, window=7) as provider:
+        assert provider.shape == pocono["qlat_values"].shape
+        rows = provider.find_rows(pocono["data_idx"])
+        values = np.hstack([provider.columns(t, t + 5, rows) for t in range(0, 24, 5)])
+    np.testing.assert_array_equal(values, pocono["qlat_values"])
+
+
+def test_catchment_qlat_provider(tmp_path):
+    flows = {12: [1.0, 2.0, 3.0], 3: [4.0, 5.0, 6.0]}
+    for catchment, flow in flows.items():
+        pd.DataFrame({"time": range(3), "flow": flow}).to_csv(
+            tmp_path / f"cat-{catchment}_output.csv", header=False, index=False
+        )
+    (tmp_path / "nexus_data.csv").write_text("unrelated\n")
+    with nhd_io.CatchmentQlatProvider(tmp_path, window=2) as provider:
+        assert provider.index.tolist() == [3, 12]
+        assert provider.shape == (2, 3)
+        rows = provider.find_rows([12, 3])
+        np.testing.assert_array_equal(
+            provider.columns(0, 3, rows), [flows[12], flows[3]]
+        )
+        np.testing.assert_array_equal(provider.columns(2, 3, rows), [[3.0], [6.0]])
+
+
+def test_compute_network_with_qlat_provider(pocono, routed):
+    _, expected = routed()
+    provider = nhd_io.ArrayQlatProvider(
+        pocono["data_idx"], pocono["qlat_values"], window=5, prefetch=True
+    )
+    with provider:
+        _, flowveldepth = routed(timestep_block=7, qlat_provider=provider)
+    np.testing.assert_array_equal(flowveldepth, expected)
+
+
+@pytest.mark.parametrize("max_gap", [0, 4096])
+def test_read_routelink_mask(pocono_routelink, max_gap):
+    columns = {"key": "link", "downstream": "to", "dx": "Length", "n": "n"}
+    full = nhd_io.read_routelink(pocono_routelink, columns)
+    assert full.index.is_monotonic_increasing
+    assert full["to"].dtype == "int64" and full["Length"].dtype == "float32"
+
+    mask_ids = np.append(full.index.values[[20, 3, 4, 11]], -1)
+    df = nhd_io.read_routelink(pocono_routelink, columns, mask_ids, max_gap=max_gap)
+    pd.testing.assert_frame_equal(df, full.iloc[[3, 4, 11, 20]])
+
+    df = nhd_io.read_routelink(pocono_routelink, columns, [], max_gap=max_gap)
+    assert df.empty and list(df.columns) == list(full.columns)
+
+
+def test_restart_round_trip(tmp_path):
+    segments = np.array([30, 10, 20, 40])
+    state = np.arange(12, dtype="float32").reshape(4, 3)
+    path = tmp_path / "restart.npz"
+    nhd_io.write_restart(path, segments, state, waterbodies=[20], timestep=5)
+    channel_states, waterbody_states = nhd_io.read_restart(path)
+    assert channel_states.index.tolist() == [10, 30, 40]
+    np.testing.assert_array_equal(channel_states.values, state[[1, 0, 3]])
+    assert waterbody_states.index.tolist() == [20]
+    np.testing.assert_array_equal(waterbody_states.values, state[[2], 1:])
+    with np.load(path) as data:
+        assert data["timestep"] == 5
+
+
+def test_restart_sink_continues_run(pocono, routed, tmp_path):
+    _, expected = routed()
+    sink = nhd_io.RestartSink(tmp_path / "restart_{timestep}.npz")
+    routed(restart_sink=sink, restart_timesteps=[23, 47], timestep_block=5)
+    sink.close()
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "restart_23.npz",
+        "restart_47.npz",
+    ]
+
+    # the state after timestep 23 starts the second half of the run
+    channel_states, waterbody_states = nhd_io.read_restart(tmp_path / "restart_23.npz")
+    assert waterbody_states.empty
+    np.testing.assert_array_equal(channel_states.index, pocono["data_idx"])
+    mc_reach = pytest.importorskip("mc_reach")
+    _, flowveldepth = mc_reach.compute_network(
+        24,
+        pocono["reaches"],
+        pocono["rconn"],
+        pocono["data_idx"],
+        pocono["data_cols"],
+        pocono["data_values"],
+        np.ascontiguousarray(pocono["qlat_values"][:, 12:]),
+        channel_states.values,
+    )
+    np.testing.assert_array_equal(flowveldepth, expected[:, 24 * 3 :])
+
+
+@pytest.mark.parametrize("max_workers", [1, 3])
+def test_get_ql_from_chrtout(pocono_chrtout, max_workers):
+    expected = nhd_io.get_ql_from_wrf_hydro(pocono_chrtout, index_col="feature_id")
+    # files are ordered by time whatever order they are listed in
+    ql = nhd_io.get_ql_from_chrtout(pocono_chrtout[::-1], max_workers=max_workers)
+    pd.testing.assert_frame_equal(
+        ql, expected, check_freq=False, check_index_type=False
+    )
+
+    segments = np.append(expected.index.values[[7, 2]], -1)
+    ql = nhd_io.get_ql_from_chrtout(pocono_chrtout, segments, max_workers=max_workers)
+    assert ql.index.tolist() == sorted(segments.tolist())
+    np.testing.assert_array_equal(ql.values[1:], expected.values[[2, 7]])
+    assert not ql.values[0].any()
+
+
+def test_replace_downstreams():
+    df = pd.DataFrame({"to": [3, 3, 0, 9], "n": 0.1}, index=[1, 2, 3, 4])
+    # 3 drains to the terminal code, 4 to a segment outside the table
+    out = nhd_io.replace_downstreams(df, "to", 0)
+    assert out["to"].tolist() == [3, 3, -3, -9]
+    assert df["to"].tolist() == [3, 3, 0, 9]
+    assert nhd_io.replace_downstreams(df, "to", 0, inplace=True) is df
+    assert df["to"].tolist() == [3, 3, -3, -9]
@@ -0,0 +1,161 @@
+from itertools import chain
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from troute import nhd_network
+
+# 1 -> 3 <- 2, 3 -> 4 -> 6 <- 5; 7 -> 8 is a separate network
+connections = {1: [3], 2: [3], 3: [4], 4: [6], 5: [6], 6: [], 7: [8], 8: []}
+
+
+def as_lists(components):
+    return {k: sorted(np.asarray(v).tolist()) for k, v in components.items()}
+
+
+def test_graph_from_dict():
+    G = nhd_network.NetworkGraph.from_dict(connections)
+    assert G.to_dict() == connections
+    assert G.reverse().to_dict() == nhd_network.reverse_network(connections)
+    assert G.headwaters().tolist() == [1, 2, 5, 7]
+    assert G.tailwaters().tolist() == [6, 8]
+    assert G.junctions().tolist() == [3, 6]
+    levels = [level.tolist() for level in G.toposort_levels()]
+    assert levels == [[1, 2, 5, 7], [3, 8], [4], [6]]
+    with pytest.raises(Exception, match="Cycle"):
+        nhd_network.NetworkGraph.from_dict({1: [2], 2: [1]}).toposort_levels()
+
+
+def test_graph_reachable_disjoint():
+    G = nhd_network.NetworkGraph.from_dict(nhd_network.reverse_network(connections))
+    assert as_lists(G.reachable()) == {6: [1, 2, 3, 4, 5, 6], 8: [7, 8]}
+
+
+def test_graph_reachable_overlapping():
+    G = nhd_network.NetworkGraph.from_dict(connections)
+    expected = {
+        1: [1, 3, 4, 6],
+        2: [2, 3, 4, 6],
+        5: [5, 6],
+        7: [7, 8],
+    }
+    assert as_lists(G.reachable()) == expected
+    # the shared visited marks are reset between sources
+    assert as_lists(G.reachable([3, 1, 3])) == {3: [3, 4, 6], 1: [1, 3, 4, 6]}
+    assert as_lists(G.reachable()) == as_lists(nhd_network.reachable(connections))
+
+
+def test_reach_levels():
+    # reaches (upstream first) of connections: two headwater reaches join in
+    # [3, 4], which joins the headwater reach [5] in [6]
+    reaches = [[1], [2], [3, 4], [5], [6], [7, 8]]
+    rconn = nhd_network.reverse_network(connections)
+    levels = nhd_network.reach_levels(reaches, rconn)
+    assert levels.reach_ids.tolist() == [0, 1, 3, 5, 2, 4]
+    assert levels.widths.tolist() == [4, 1, 1]
+    assert levels.critical_path == 4
+    ordered, groups, group_segments = levels.engine_args(reaches)
+    assert ordered == [[1], [2], [5], [7, 8], [3, 4], [6]]
+    assert groups.tolist() == [4, 1, 1]
+    assert group_segments.tolist() == [5, 2, 1]
+    stats = levels.statistics()
+    assert stats["levels"] == 3 and stats["max_width"] == 4 and stats["segments"] == 8
+
+
+def test_network_costs():
+    reaches_bytw = {6: [[1], [2], [3, 4], [5], [6]], 8: [[7, 8]]}
+    assert nhd_network.network_costs(reaches_bytw, nsteps=10) == {6: 60, 8: 20}
+    costs = nhd_network.network_costs(
+        reaches_bytw, nsteps=10, waterbodies={3: 30, 4: 30}, waterbody_weight=3.0
+    )
+    assert costs == {6: 100, 8: 20}
+    # level pools are cheaper than channel segments by default
+    costs = nhd_network.network_costs(reaches_bytw, nsteps=10, waterbodies={3, 4})
+    assert costs[6] == pytest.approx(10 * (4 + 2 * nhd_network.LEVELPOOL_WEIGHT))
+
+
+def test_balance_networks():
+    costs = {1: 100, 2: 60, 3: 50, 4: 4, 5: 3, 6: 2, 7: 1}
+    batches, estimated = nhd_network.balance_networks(costs, 2, min_batch_cost=5)
+    # every network in exactly one batch, large networks alone, largest first
+    assert sorted(chain.from_iterable(batches)) == sorted(costs)
+    assert batches[:3] == [[1], [2], [3]]
+    batch_costs = [sum(costs[tw] for tw in b) for b in batches]
+    assert batch_costs == sorted(batch_costs, reverse=True)
+    assert all(c >= 5 for c in batch_costs[:-1])
+    # LPT: 100 | 60 + 50, then the small batches on the lighter worker
+    assert estimated == [110, 110]
+    assert sum(estimated) == sum(costs.values())
+
+    batches, estimated = nhd_network.balance_networks(costs, 0)
+    assert estimated == [sum(costs.values())]
+
+
+def test_split_network():
+    N = nhd_network.reachable_network(nhd_network.reverse_network(connections))[6]
+    subnetworks, deps = nhd_network.split_network(N, 3)
+    # the branch above junction 6 is cut; 6 receives its outflow from 4
+    assert list(subnetworks) == [4, 6]
+    assert as_lists(subnetworks[4]) == {4: [3], 3: [1, 2], 2: [], 1: []}
+    assert as_lists(subnetworks[6]) == {6: [4, 5], 5: []}
+    assert deps == {4: 6}
+
+    subnetworks, deps = nhd_network.split_network(N, len(N))
+    assert subnetworks == {6: N}
+    assert deps == {}
+
+
+def test_collapse_waterbodies():
+    waterbodies = {3: 100, 4: 100, 8: 200}
+    expected = {1: [100], 2: [100], 5: [6], 6: [], 7: [200], 100: [6], 200: []}
+    collapsed, index = nhd_network.collapse_waterbodies(connections, waterbodies)
+    assert as_lists(collapsed) == expected
+    assert index.lakes.tolist() == [100, 200]
+    assert index.members(100).tolist() == [3, 4]
+    assert index.lake_positions([4, 5, 8]).tolist() == [0, -1, 1]
+
+    G = nhd_network.NetworkGraph.from_dict(connections)
+    collapsed, _ = nhd_network.collapse_waterbodies(G, waterbodies, index)
+    assert as_lists(collapsed) == expected
+
+    collapsed, _ = nhd_network.collapse_waterbodies(connections, {})
+    assert collapsed == connections
+
+
+def test_component_labels():
+    G = nhd_network.NetworkGraph.from_dict(connections)
+    # segments downstream of a junction are reachable from several headwaters
+    sources, labels, disjoint = G.component_labels()
+    assert sources.tolist() == [1, 2, 5, 7]
+    assert labels[G.positions([1, 2, 5, 7, 8])].tolist() == [0, 1, 2, 3, 3]
+    assert not disjoint
+    sources, labels, disjoint = G.reverse().component_labels()
+    assert sources.tolist() == [6, 8]
+    assert labels.tolist() == [0, 0, 0, 0, 0, 0, 1, 1]
+    assert disjoint
+    _, labels, _ = G.component_labels([3, 7])
+    assert labels.tolist() == [-1, -1, 0, 0, -1, 0, 1, 1]
+
+
+def test_reachable_network():
+    rconn = nhd_network.reverse_network(connections)
+    networks = nhd_network.reachable_network(rconn)
+    assert networks == {
+        6: {1: [], 2: [], 3: [1, 2], 4: [3], 5: [], 6: [4, 5]},
+        8: {7: [], 8: [7]},
+    }
+    networks = nhd_network.reachable_network(connections, check_disjoint=False)
+    assert networks[1] == {1: [3], 3: [4], 4: [6], 6: []}
+    assert networks[2] == {2: [3], 3: [4], 4: [6], 6: []}
+
+
+def test_extract_connection_graph():
+    rows = pd.DataFrame({"to": [v[0] if v else -n for n, v in connections.items()]})
+    rows.index = list(connections)
+    G = nhd_network.extract_connection_graph(rows, "to")
+    assert G.to_dict() == nhd_network.extract_connections(rows, "to") == connections
+    # unsorted rows and downstream segments outside the table
+    rows = pd.DataFrame({"to": [4, 9, 3]}, index=[3, 4, 1])
+    G = nhd_network.extract_connection_graph(rows, "to")
+    assert G.to_dict() == {1: [3], 3: [4], 4: [9], 9: []}
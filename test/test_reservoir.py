@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+reservoir = pytest.importorskip("reservoir")
+
+# ar, we, maxh, wc, wl, dl, oe, oc, oa
+lake_params = np.array(
+    [
+        [1.5, 10.0, 12.0, 0.4, 10.0, 100.0, 8.0, 0.1, 1.0],
+        [0.2, 5.0, 6.0, 0.4, 4.0, 40.0, 3.0, 0.1, 0.5],
+        [8.0, 100.0, 101.0, 0.4, 50.0, 500.0, 98.0, 0.1, 2.0],
+    ],
+    dtype="float32",
+)
+
+
+@pytest.mark.parametrize("parallel", [False, True])
+def test_compute_reservoirs_matches_kernel(parallel):
+    dt = np.array([300, 300, 3600], dtype="float32")
+    qi0 = np.array([5.0, 0.0, 40.0], dtype="float32")
+    qi1 = np.array([6.0, 0.5, 45.0], dtype="float32")
+    ql = np.array([0.1, 0.0, 1.0], dtype="float32")
+    H0 = np.array([10.5, 4.0, 99.0], dtype="float32")
+    out = np.zeros((3, 2), dtype="float32")
+    reservoir.compute_reservoirs(dt, qi0, qi1, ql, lake_params, H0, out, parallel)
+    for i in range(3):
+        expected = reservoir.compute_reservoir_kernel(
+            dt[i], qi0[i], qi1[i], ql[i], *lake_params[i], H0[i]
+        )
+        assert out[i, 0] == expected["reslevel"]
+        assert out[i, 1] == expected["resoutflow"]
+
+
+def test_compute_reservoirs_checks_shapes():
+    one = np.zeros(1, dtype="float32")
+    with pytest.raises(ValueError):
+        reservoir.compute_reservoirs(
+            one, one, one, one, lake_params, one, np.zeros((1, 2), dtype="float32")
+        )